@@ -0,0 +1,296 @@
+# Benchmark cases: the hot callbacks of the strategies at a given scale
+#
+# Every case takes a scale (the number of symbols or open trades) and returns the duration of every call it timed, in
+# seconds. A case runs its strategy file unmodified in the local engine on a SyntheticSource up to a known state, sets
+# up the scale (opens the trades, or widens the universe the way Initialize would), and then either times the callback
+# while the engine keeps calling it (CallTimer) or calls it directly with the same arguments the engine would
+# (timed_calls). The trades of the trade-book cases have their stop orders frozen while timed, so the book keeps the
+# size being measured.
+#
+# The dates are fixed: the runs start on Wednesday 2021-03-10 and the quarterly futures roll on Thursday 2021-03-11,
+# so the futures cases also time the rollover of every open trade.
+#
+# Example:
+#   durations = CASES[0].run(100)    # futures-contracts SymbolData.scan with 100 open trades
+
+import os
+import sys
+from collections import namedtuple
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import numpy as np
+
+from benchmarks.synthetic import SyntheticSource
+from local_engine import load_algorithm
+from local_engine.algorithm_imports import OrderDirection, Resolution, TradeBar
+from local_engine.engine import Engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+START = datetime(2021, 3, 10)
+END = datetime(2021, 3, 12)
+
+# Enough cash that every scale fits in the margin
+CASH = 1e9
+
+FUTURES = ['YM', 'ES', 'NQ', 'RTY']
+
+
+class CallTimer:
+    def __init__(self, owner, name):
+        # Replaces the method `name` of `owner` with this wrapper, which times every call
+        self.function = getattr(owner, name)
+        self.durations = []
+        setattr(owner, name, self)
+
+    def __call__(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            self.durations.append(perf_counter() - start)
+
+
+def timed_calls(function, calls):
+    # Duration of `function(*arguments)` for every tuple in `calls`
+    durations = []
+    for arguments in calls:
+        start = perf_counter()
+        function(*arguments)
+        durations.append(perf_counter() - start)
+    return durations
+
+
+def start_engine(strategy, source, until=None, cash=CASH):
+    # Engine that ran Initialize and, with `until`, every step up to that time
+    engine = Engine(load_algorithm(os.path.join(ROOT, strategy)), source, start=START, end=END, cash=cash, quiet=True)
+    if until is not None:
+        engine.begin().advance(until)
+    return engine
+
+
+def freeze_stops(engine):
+    # Stop and limit orders stay open however far the price moves
+    engine.fill_open_orders = lambda now: None
+
+
+def futures_tickers(count):
+    return (FUTURES + [f"F{i:03d}" for i in range(len(FUTURES), count)])[:count]
+
+
+def hourly_bars(engine, symbol, count):
+    # The last `count` hourly TradeBars of `symbol`, as the consolidators would hand them over
+    bars = engine.series(symbol, Resolution.Hour).last(count, engine.time)
+    return engine.bar_objects(TradeBar, symbol, bars, timedelta(hours=1))
+
+
+# region futures-contracts
+
+def futures_contracts_engine(scale):
+    # Wednesday 10:00 with `scale` open trades on YM, two thirds long and one third short, so the roll has a position
+    source = SyntheticSource(START, END, futures=['YM'], history_days=130)
+    engine = start_engine('futures-contracts.py', source, START.replace(hour=10))
+    algorithm = engine.algorithm
+    module = sys.modules[type(algorithm).__module__]
+    symbol_data = next(iter(algorithm.symbol_data_by_future.values()))
+    for i in range(scale):
+        direction = OrderDirection.Sell if i % 3 == 2 else OrderDirection.Buy
+        symbol_data.add_trade(module.Trade(algorithm, symbol_data.future, direction, symbol_data.trailing_stop_pct))
+    return engine, symbol_data
+
+
+def futures_contracts_scan(scale):
+    # Every minute through the roll on Thursday
+    engine, symbol_data = futures_contracts_engine(scale)
+    freeze_stops(engine)
+    timer = CallTimer(symbol_data, 'scan')
+    engine.advance(END)
+    return timer.durations
+
+
+def futures_contracts_consolidation_handler(scale):
+    engine, symbol_data = futures_contracts_engine(scale)
+    freeze_stops(engine)
+    bars = hourly_bars(engine, symbol_data.future.Symbol, 200)
+    return timed_calls(symbol_data.consolidation_handler, [(None, bar) for bar in bars])
+
+# endregion
+
+
+# region futures-mean-reversion
+
+def futures_mean_reversion_on_data(scale):
+    # The strategy with `scale` futures instead of its one, set up like Initialize does, then every minute through the
+    # roll on Thursday
+    source = SyntheticSource(START, END, futures=futures_tickers(scale), history_days=40)
+    engine = start_engine('futures-mean-reversion.py', source)
+    algorithm = engine.algorithm
+    module = sys.modules[type(algorithm).__module__]
+
+    # Drop the indicator bank Initialize registered, then mirror its loop over the tickers
+    engine.consolidators.clear()
+    engine.all_consolidators.clear()
+    tickers = futures_tickers(scale)
+    algorithm.indicator_bank = module.IndicatorBank(len(tickers), bb_period=24, bb_k=2, std_period=22,
+                                                    long_bb_threshold=algorithm.long_bb_threshold,
+                                                    short_bb_threshold=algorithm.short_bb_threshold)
+    algorithm.futures = []
+    algorithm.invested = np.zeros(len(tickers), dtype=bool)
+    algorithm.symbol_data_by_future = {}
+    for ticker in tickers:
+        future = algorithm.AddFuture(ticker, Resolution.Minute)
+        future.SetFilter(0, 180)
+        algorithm.futures.append(future)
+        algorithm.symbol_data_by_future[future] = module.SymbolData(
+            algorithm, future, algorithm.max_loss, algorithm.profit_target_multiple, algorithm.max_holding_time,
+            algorithm.stop_loss_std_multiple, algorithm.long_bb_threshold, algorithm.short_bb_threshold,
+            algorithm.indicator_bank)
+
+    engine.begin().advance(START.replace(hour=10))
+    timer = CallTimer(algorithm, 'OnData')
+    engine.advance(END)
+    return timer.durations
+
+# endregion
+
+
+# region options-LONG-put-call
+
+def options_engine(scale):
+    # Wednesday 10:00 with `scale` open trades on SPY, alternating between the ATM call and put of the week. Trades
+    # size their orders with CalculateOrderQuantity, which targets the weight of the whole position in the contract,
+    # so the k-th trade on a contract targets k slices of half the portfolio.
+    source = SyntheticSource(START, END, history_days=80)
+    engine = start_engine('options-LONG-put-call.py', source, START.replace(hour=10))
+    algorithm = engine.algorithm
+    module = sys.modules[type(algorithm).__module__]
+    symbol_data = next(symbol_data for security, symbol_data in algorithm.symbol_data_by_asset.items()
+                       if security.Symbol.Value == 'SPY')
+    for i in range(scale):
+        direction = OrderDirection.Buy if i % 2 == 0 else OrderDirection.Sell
+        symbol_data.add_trade(module.Trade(algorithm, symbol_data.security, direction, symbol_data.trailing_stop_pct,
+                                           0.5 * (i // 2 + 1) / scale))
+    return engine, symbol_data
+
+
+def options_scan(scale):
+    # Every minute until Thursday's close; the trades are closed on Friday
+    engine, symbol_data = options_engine(scale)
+    freeze_stops(engine)
+    timer = CallTimer(symbol_data, 'scan')
+    engine.advance(END)
+    return timer.durations
+
+
+def options_consolidation_handler(scale):
+    engine, symbol_data = options_engine(scale)
+    freeze_stops(engine)
+    bars = hourly_bars(engine, symbol_data.security.Symbol, 200)
+    return timed_calls(symbol_data.consolidation_handler, [(None, bar) for bar in bars])
+
+# endregion
+
+
+# region in-out-strategy
+
+def in_out_rebalance(scale, calls=200):
+    # The daily rebalance after the first one. Its universe is the 14 ETFs it names one by one (signals, pairs and
+    # holdings), so `scale` is always 14; the part of it that grows with the symbols is timed by in_out_close_store.
+    source = SyntheticSource(START, END, history_days=260)
+    engine = start_engine('in-out-strategy.py', source, START.replace(hour=12))
+    return timed_calls(engine.algorithm.rebalance_when_out_of_the_market, [()] * calls)
+
+
+def in_out_close_store(scale, days=100):
+    # A DailyCloseStore of the strategy's kind over `scale` stocks, seeded from a year of daily History: a day's bar is
+    # staged for every stock and the day's row appended, for `days` days after the seeded ones
+    source = SyntheticSource(START, END, history_days=260)
+    engine = start_engine('in-out-strategy.py', source, START.replace(hour=12))
+    algorithm = engine.algorithm
+    module = sys.modules[type(algorithm).__module__]
+    symbols = [algorithm.AddEquity(f"S{i:04d}", Resolution.Minute).Symbol for i in range(scale)]
+    store = module.DailyCloseStore(algorithm, symbols)
+
+    rng = np.random.default_rng(0)
+    calls = []
+    for day in range(days):
+        end = datetime.combine(store.last_date, datetime.min.time()) + timedelta(days=day + 1, hours=16)
+        closes = 100 + rng.normal(size=scale)
+        calls.append(([TradeBar(end - timedelta(hours=6, minutes=30), symbol, close, close, close, close, 0,
+                                timedelta(hours=6, minutes=30)) for symbol, close in zip(symbols, closes)],))
+
+    def add_day(bars):
+        for bar in bars:
+            store.stage_bar(bar)
+        store.update()
+
+    return timed_calls(add_day, calls)
+
+# endregion
+
+
+# region realized-skewness-prediction-equity-returns
+
+def skewness_rebalance(scale, calls=20):
+    # The weekly rebalance at Wednesday's close over a universe of `scale` stocks with a full week of 5-minute closes,
+    # repeated on the portfolio the first one built. The universe is selected on the first day instead of in January.
+    source = SyntheticSource(START, END, history_days=30, sparse_step=5, universe_size=scale)
+    engine = start_engine('realized-skewness-prediction-equity-returns.py', source)
+    algorithm = engine.algorithm
+    algorithm.selection_flag = True
+    algorithm.coarse_count = scale
+    engine.begin().advance(START.replace(hour=16))
+    data = engine.slice
+
+    def rebalance():
+        algorithm.days = 5
+        algorithm.OnData(data)
+
+    return timed_calls(rebalance, [()] * calls)
+
+# endregion
+
+
+# region vix-hedging-3xetf
+
+def vix_fill_ladder(scale, calls=100):
+    # OnData on a minute every rung of the ladder is empty, which is when the day's chain is searched and the calls
+    # bought: the rungs are emptied again before every call. The ladder has its 4 rungs and the chain the listing of
+    # one underlying (about 150 calls within the filter), so `scale` is always 1 ladder.
+    source = SyntheticSource(START, END, history_days=5)
+    engine = start_engine('vix-hedging-3xetf', source)
+    algorithm = engine.algorithm
+    algorithm.use_ladder = True
+    engine.option_subscriptions[0].SetFilter(-20, 20, 25, 30 * algorithm.ladder_months[-1] + 5)
+    engine.begin().advance(START.replace(hour=10))
+    data = engine.slice
+
+    def fill():
+        algorithm.ladder = {months: None for months in algorithm.ladder_months}
+        algorithm.rung_by_contract.clear()
+        algorithm.OnData(data)
+
+    return timed_calls(fill, [()] * calls)
+
+# endregion
+
+
+Case = namedtuple('Case', ['strategy', 'callback', 'unit', 'scales', 'run'])
+
+SCALES = (1, 10, 100, 1000)
+
+CASES = [
+    Case('futures-contracts', 'SymbolData.scan', 'open trades', SCALES, futures_contracts_scan),
+    Case('futures-contracts', 'SymbolData.consolidation_handler', 'open trades', SCALES,
+         futures_contracts_consolidation_handler),
+    Case('futures-mean-reversion', 'OnData', 'futures', SCALES, futures_mean_reversion_on_data),
+    Case('options-LONG-put-call', 'SymbolData.scan', 'open trades', SCALES, options_scan),
+    Case('options-LONG-put-call', 'SymbolData.consolidation_handler', 'open trades', SCALES,
+         options_consolidation_handler),
+    Case('in-out-strategy', 'rebalance_when_out_of_the_market', 'symbols', (14,), in_out_rebalance),
+    Case('in-out-strategy', 'DailyCloseStore (daily row)', 'symbols', SCALES, in_out_close_store),
+    Case('realized-skewness-prediction-equity-returns', 'OnData (weekly rebalance)', 'symbols', SCALES,
+         skewness_rebalance),
+    Case('vix-hedging-3xetf', 'OnData (ladder fill)', 'ladders', (1,), vix_fill_ladder)
+]
@@ -0,0 +1,173 @@
+# Runs the benchmark cases and compares them with a baseline
+#
+# Every case (see cases.py) is run in rounds at each of its scales, at least `rounds` times and for at least
+# `min_seconds`, with garbage collection paused, and the statistics of its call durations are written as JSON. Only the
+# fastest of the rounds' medians is compared: a mean follows the few calls that hit a GC pause, a page fault or another
+# process, and a single round's median of a ~100 us call moves by more than the tolerance between two runs on an idle
+# machine. Even the fastest median drifts with the speed of a shared machine, and scaling it by a timed calibration
+# workload only adds that workload's own noise, so the baseline measures the spread instead: --update-baseline runs the
+# whole suite `baseline_runs` times and keeps the fastest and the slowest best median of every case. A case regresses
+# when its best median exceeds the slowest one of the baseline by more than the tolerance and by more than the noise
+# floor; the run then exits with status 1, e.g. to fail CI. On a single shared vCPU the best medians of three baseline
+# runs differed by up to 1.9x and clean runs still came out up to 1.26x the slowest of them, hence the default
+# tolerance of 0.5. The baseline has to come from this runner on the machine
+# that runs the comparison.
+#
+# Example:
+#   python -m benchmarks.run                                   # every case, compared with benchmarks/baseline.json
+#   python -m benchmarks.run --cases futures --scales 1 10 --output results.json
+#   python -m benchmarks.run --rounds 10                       # steadier medians, on a busy machine
+#   python -m benchmarks.run --update-baseline                 # after a deliberate change in performance
+#   python -m benchmarks.run --update-baseline --baseline-runs 5   # a wider measured spread, on a noisy machine
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+
+from benchmarks.cases import CASES
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Statistics compared with the baseline
+COMPARED = ('best_median_us',)
+
+
+def statistics(durations):
+    microseconds = np.array(durations) * 1e6
+    return {
+        'calls': len(microseconds),
+        'min_us': float(microseconds.min()),
+        'median_us': float(np.median(microseconds)),
+        'p95_us': float(np.percentile(microseconds, 95)),
+        'mean_us': float(microseconds.mean()),
+        'max_us': float(microseconds.max())
+    }
+
+
+def run_case(case, scale, rounds, min_seconds):
+    # Statistics of the calls of every round together and the fastest median of a round
+    durations = []
+    medians = []
+    start = perf_counter()
+    while len(medians) < rounds or perf_counter() - start < min_seconds:
+        gc.collect()
+        gc.disable()
+        try:
+            round_durations = case.run(scale)
+        finally:
+            gc.enable()
+        durations.extend(round_durations)
+        medians.append(float(np.median(round_durations)) * 1e6)
+    return {'strategy': case.strategy, 'callback': case.callback, 'unit': case.unit, 'scale': scale,
+            'rounds': len(medians), 'best_median_us': min(medians),
+            **statistics(durations)}
+
+
+def key(result):
+    return result['strategy'], result['callback'], result['scale']
+
+
+def run_suite(cases, scales, rounds, min_seconds):
+    results = []
+    for case in cases:
+        for scale in case.scales:
+            if scales and scale not in scales:
+                continue
+            result = run_case(case, scale, rounds, min_seconds)
+            results.append(result)
+            print(f"{case.strategy} {case.callback} @ {scale} {case.unit}: {result['rounds']} rounds, {result['calls']} calls, "
+                  f"best median {result['best_median_us']:.1f} us, median {result['median_us']:.1f} us, "
+                  f"p95 {result['p95_us']:.1f} us, mean {result['mean_us']:.1f} us", flush=True)
+    return results
+
+
+def merge_runs(runs):
+    # The result of every case with the fastest of its compared statistics across the runs, plus the slowest one
+    # (`slowest_<statistic>`) as the spread the comparison allows for
+    merged = []
+    for results in zip(*runs):
+        merged_result = dict(min(results, key=lambda result: result[COMPARED[0]]))
+        merged_result['baseline_runs'] = len(results)
+        for statistic in COMPARED:
+            merged_result[statistic] = min(result[statistic] for result in results)
+            merged_result[f"slowest_{statistic}"] = max(result[statistic] for result in results)
+        merged.append(merged_result)
+    return merged
+
+
+def regressions(results, baseline, tolerance, floor):
+    # (result, statistic, slowest baseline value) of every statistic that regressed
+    baseline_results = {key(result): result for result in baseline['results']}
+    regressed = []
+    for result in results:
+        baseline_result = baseline_results.get(key(result))
+        if baseline_result is None:
+            continue
+        for statistic in COMPARED:
+            expected = baseline_result.get(f"slowest_{statistic}", baseline_result[statistic])
+            if result[statistic] > expected * (1 + tolerance) and result[statistic] - expected > floor:
+                regressed.append((result, statistic, expected))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the hot callbacks of the strategies on synthetic data")
+    parser.add_argument('--cases', nargs='*', default=None, help="Only the cases whose strategy or callback contains one of these")
+    parser.add_argument('--scales', nargs='*', type=int, default=None, help="Only these scales (default: every scale of a case)")
+    parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--rounds', type=int, default=5, help="Runs of every case and scale; the fastest median counts")
+    parser.add_argument('--min-seconds', type=float, default=5.0, help="More rounds until a case and scale ran this long")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Allowed slowdown as a fraction of the slowest baseline run")
+    parser.add_argument('--floor', type=float, default=5.0, help="Slowdowns of fewer microseconds are noise")
+    parser.add_argument('--update-baseline', action='store_true', help="Write the results to the baseline instead of comparing")
+    parser.add_argument('--baseline-runs', type=int, default=3, help="Runs of the whole suite that make up a new baseline")
+    args = parser.parse_args()
+
+    cases = [case for case in CASES
+             if not args.cases or any(pattern in f"{case.strategy} {case.callback}" for pattern in args.cases)]
+    if args.update_baseline:
+        runs = []
+        for run in range(args.baseline_runs):
+            print(f"Baseline run {run + 1} of {args.baseline_runs}", flush=True)
+            runs.append(run_suite(cases, args.scales, args.rounds, args.min_seconds))
+        results = merge_runs(runs)
+    else:
+        results = run_suite(cases, args.scales, args.rounds, args.min_seconds)
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}")
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressed = regressions(results, baseline, args.tolerance, args.floor)
+    for result, statistic, expected in regressed:
+        print(f"REGRESSION {result['strategy']} {result['callback']} @ {result['scale']}: {statistic} "
+              f"{result[statistic]:.1f} us, expected at most {max(expected * (1 + args.tolerance), expected + args.floor):.1f} us")
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
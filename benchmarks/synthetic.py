@@ -0,0 +1,218 @@
+# Deterministic synthetic market data for the benchmarks
+#
+# SyntheticSource is a bar source for the local engine (see local_engine/data.py) that generates the data of any ticker
+# on first use instead of reading it from disk:
+# - equities and indexes: a random walk of regular-session minute bars with bid/ask closes
+# - futures: the same, plus the contract the continuous future is mapped to. It rolls to the next quarterly contract
+#   eight days before the third Friday of Mar/Jun/Sep/Dec, and the price gaps at every roll like a raw (not back
+#   adjusted) continuous series does.
+# - option contracts (OSI tickers, e.g. SPY200117C00320000): Black-Scholes prices of the underlying's bars
+# - option chains with a realistic listing: Mon/Wed/Fri weeklies, monthlies and LEAPS, with strikes every 1, 5 and 10
+#   points further from the money, which is several thousand SPY contracts a day
+# - coarse/fine fundamentals for a universe of any size
+#
+# Every series is seeded from its ticker, so the same ticker always gets the same bars. Bars before `dense_start` are
+# `sparse_step` minutes apart: the warm-up history the strategies request at hourly, daily or 5-minute resolution
+# comes out the same while hundreds of symbols take a fraction of the memory.
+#
+# Example:
+#   source = SyntheticSource(datetime(2021, 1, 4), datetime(2021, 1, 8), futures=['YM'], history_days=40)
+#   engine = local_engine.run('futures-contracts.py', source, start=datetime(2021, 1, 4), quiet=True)
+
+import re
+import zlib
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+from local_engine.data import Bars
+from option_greeks import price
+
+OPTION_TICKER = re.compile(r'([A-Z]+)(\d{6})([CP])(\d{8})')
+
+QUARTERLY_MONTHS = {3: 'H', 6: 'M', 9: 'U', 12: 'Z'}
+
+# Starting prices of the tickers the strategies trade; other tickers get a seeded price between 20 and 500
+START_PRICES = {'SPY': 320.0, 'QQQ': 210.0, 'YM': 28000.0, 'ES': 3200.0, 'NQ': 9000.0, 'RTY': 1650.0,
+                'VIX': 20.0}
+
+MINUTE_VOLATILITY = 0.0006
+
+
+def seed(*parts):
+    return zlib.crc32('/'.join(map(str, parts)).encode())
+
+
+def business_days(start, end):
+    return [day.date() for day in pd.bdate_range(start, end)]
+
+
+def third_friday(year, month):
+    first = date(year, month, 1)
+    return first + timedelta(days=(4 - first.weekday()) % 7 + 14)
+
+
+def bar_times(days, dense_start, sparse_step):
+    # End times of the regular-session minute bars of `days` (9:31 to 16:00); before `dense_start` only every
+    # `sparse_step`-th minute, always including the close
+    minutes = np.arange(1, 391)
+    sparse_minutes = np.unique(np.r_[np.arange(sparse_step, 391, sparse_step), 390])
+    times = []
+    for day in days:
+        open_time = np.datetime64(datetime.combine(day, time(9, 30)), 'ns')
+        offsets = minutes if dense_start is None or day >= dense_start else sparse_minutes
+        times.append(open_time + offsets.astype('timedelta64[m]'))
+    return np.concatenate(times) if times else np.array([], dtype='datetime64[ns]')
+
+
+def random_walk(ticker, times, start_price, volatility):
+    # Minute OHLC bars of a geometric random walk; gaps between sparse bars get the volatility of their length
+    rng = np.random.default_rng(seed(ticker))
+    gaps = np.maximum(np.diff(times, prepend=times[:1]).astype('timedelta64[m]').astype(float), 1)
+    closes = start_price * np.exp(np.cumsum(rng.normal(0, volatility, len(times)) * np.sqrt(np.minimum(gaps, 390))))
+    opens = np.r_[start_price, closes[:-1]]
+    wicks = np.abs(rng.normal(0, volatility / 2, (2, len(times))))
+    return {
+        'open': opens,
+        'high': np.maximum(opens, closes) * (1 + wicks[0]),
+        'low': np.minimum(opens, closes) * (1 - wicks[1]),
+        'close': closes,
+        'volume': rng.integers(100, 10000, len(times)).astype(float)
+    }
+
+
+def with_quotes(columns, spread):
+    columns['bidclose'] = columns['close'] - spread / 2
+    columns['askclose'] = columns['close'] + spread / 2
+    return columns
+
+
+def start_price(ticker):
+    return START_PRICES.get(ticker, 20 + seed(ticker, 'price') % 480)
+
+
+def equity_bars(ticker, times):
+    columns = random_walk(ticker, times, start_price(ticker), MINUTE_VOLATILITY)
+    return Bars(times, with_quotes(columns, np.maximum(columns['close'] * 0.0002, 0.01)))
+
+
+def quarterly_contracts(ticker, days):
+    # Front quarterly contract on each of `days`, rolling eight days before its expiry
+    contracts = []
+    for day in days:
+        year, month = day.year, day.month
+        while True:
+            if month in QUARTERLY_MONTHS and day < third_friday(year, month) - timedelta(days=8):
+                break
+            month += 1
+            if month > 12:
+                year, month = year + 1, 1
+        contracts.append(f"{ticker} {QUARTERLY_MONTHS[month]}{year % 100:02d}")
+    return contracts
+
+
+def future_bars(ticker, times):
+    columns = random_walk(ticker, times, start_price(ticker), MINUTE_VOLATILITY)
+    days = (times - np.timedelta64(1, 'ns')).astype('datetime64[D]')
+    unique_days, day_rows = np.unique(days, return_inverse=True)
+    contracts = np.array(quarterly_contracts(ticker, [day.astype(object) for day in unique_days]), dtype=object)
+    mapped = contracts[day_rows]
+
+    # The next contract trades at a premium or discount; the gap carries over to every later bar
+    rolls = np.flatnonzero(mapped[1:] != mapped[:-1]) + 1
+    rng = np.random.default_rng(seed(ticker, 'rolls'))
+    scale = np.ones(len(times))
+    for roll in rolls:
+        scale[roll:] *= 1 + rng.normal(0, 0.003)
+    for field in ('open', 'high', 'low', 'close'):
+        columns[field] = columns[field] * scale
+    tick = 1.0 if ticker == 'YM' else 0.25
+    return Bars(times, with_quotes(columns, tick), mapped)
+
+
+def option_bars(ticker, underlying):
+    # Black-Scholes bars of an OSI contract from its underlying's bars, until the contract expires at 16:00
+    match = OPTION_TICKER.fullmatch(ticker)
+    expiry, right, strike = datetime.strptime(match[2], '%y%m%d'), match[3], int(match[4]) / 1000
+    expiry_time = np.datetime64(expiry + timedelta(hours=16), 'ns')
+    rows = underlying.time <= expiry_time
+    times = underlying.time[rows]
+    years = np.maximum((expiry_time - times) / np.timedelta64(365, 'D'), 1e-6)
+    closes = np.maximum(price(underlying['close'][rows], strike, years, 0.0, 0.0, 0.25, right == 'C'), 0.01)
+    spread = np.maximum(closes * 0.02, 0.01)
+    columns = {'open': closes, 'high': closes, 'low': closes, 'close': closes, 'volume': np.full(len(closes), 10.0)}
+    return Bars(times, with_quotes(columns, spread))
+
+
+def option_listing(day, underlying_price):
+    # Mon/Wed/Fri weeklies for 8 weeks, the third-Friday monthlies for a year and January LEAPS for two years
+    expiries = {day + timedelta(days=offset) for offset in range(1, 57) if (day + timedelta(days=offset)).weekday() in (0, 2, 4)}
+    for months in range(1, 13):
+        year, month = day.year + (day.month + months - 1) // 12, (day.month + months - 1) % 12 + 1
+        expiries.add(third_friday(year, month))
+    expiries.update(third_friday(day.year + years, 1) for years in (1, 2))
+    atm = round(underlying_price)
+    strikes = np.unique(np.r_[np.arange(atm - 0.1 * atm, atm + 0.1 * atm + 1, 1).round(),
+                              5 * np.arange((atm * 0.7) // 5, (atm * 1.3) // 5 + 1),
+                              10 * np.arange((atm * 0.5) // 10, (atm * 1.5) // 10 + 1)])
+    return sorted(expiries), strikes[strikes > 0]
+
+
+class SyntheticSource:
+    def __init__(self, start, end, futures=(), history_days=10, sparse_step=60, universe_size=0):
+        # Bars from `history_days` business days before `start` to `end`; the bars before `start` are sparse. Tickers
+        # in `futures` get a mapped contract. `universe_size` stocks (S0000, S0001, ...) are in the fundamentals.
+        self.days = business_days(pd.Timestamp(start) - pd.offsets.BDay(history_days), end)
+        self.dense_start = pd.Timestamp(start).date()
+        self.sparse_step = sparse_step
+        self.futures = set(futures)
+        self.universe = [f"S{i:04d}" for i in range(universe_size)]
+        self.times = bar_times(self.days, self.dense_start, sparse_step)
+        self.bars_by_ticker = {}
+
+    def series(self, ticker):
+        bars = self.bars_by_ticker.get(ticker)
+        if bars is None:
+            if OPTION_TICKER.fullmatch(ticker):
+                bars = option_bars(ticker, self.series(OPTION_TICKER.fullmatch(ticker)[1]))
+            elif ticker in self.futures:
+                bars = future_bars(ticker, self.times)
+            else:
+                bars = equity_bars(ticker, self.times)
+            self.bars_by_ticker[ticker] = bars
+        return bars
+
+    def bars(self, ticker, start=None, end=None):
+        bars = self.series(ticker)
+        return bars if start is None and end is None else bars.between(start, end)
+
+    def last(self, ticker, count, end=None):
+        return self.series(ticker).last(count, end)
+
+    def trading_days(self, ticker):
+        return list(self.days)
+
+    def option_chain(self, underlying, day):
+        if day not in self.days:
+            return None
+        bars = self.series(underlying).last(1, datetime.combine(day, time(9, 31)))
+        if not len(bars):
+            return None
+        expiries, strikes = option_listing(day, float(bars['close'][0]))
+        rows = [(pd.Timestamp(expiry), right, strike) for expiry in expiries for right in 'CP' for strike in strikes]
+        chain = pd.DataFrame(rows, columns=['expiry', 'right', 'strike'])
+        chain.insert(0, 'date', pd.Timestamp(day))
+        return chain
+
+    def fundamentals(self, day):
+        if not self.universe or day not in self.days:
+            return None
+        rng = np.random.default_rng(seed('fundamentals', day))
+        return pd.DataFrame({
+            'date': pd.Timestamp(day),
+            'symbol': self.universe,
+            'price': [start_price(ticker) for ticker in self.universe],
+            'dollar_volume': rng.lognormal(18, 1, len(self.universe)),
+            'market_cap': rng.lognormal(23, 1, len(self.universe))
+        })
@@ -1,49 +1,79 @@
 # region imports
 from AlgorithmImports import *
+import numpy as np
+from instrumentation import Instrumentation, instrumented
+from telemetry import Telemetry
 # endregion
 
 class SwimmingBlackTermite(QCAlgorithm):
 
+    # Order statuses after which a ticket receives no more order events
+    CLOSED_ORDER_STATUSES = (OrderStatus.Filled, OrderStatus.Canceled, OrderStatus.Invalid)
+
     def Initialize(self):
         self.SetStartDate(2020, 1, 1)
         #self.SetEndDate(2022, 12, 1)
         self.SetCash(100000)
 
+        # Opt-in timing of the callbacks (see instrumentation.py), with the parameter instrumentation=on
+        self.instrumentation = Instrumentation(self, enabled=self.GetParameter('instrumentation') == 'on')
+
+        # Log/Debug/Plot go through a buffered sink (see telemetry.py), which formats them off the algorithm thread in live mode
+        self.telemetry = Telemetry(self)
+
         bar_size = timedelta(minutes=60)
         trailing_stop_pct = 0.05
+        warm_up_lookback = 150 # Minute history used to warm up the consolidator (a bar count or a timedelta, e.g. timedelta(weeks=3))
 
         future = self.AddFuture(Futures.Indices.Dow30EMini, Resolution.Minute, 
                                 dataMappingMode=DataMappingMode.OpenInterest, 
                                 dataNormalizationMode=DataNormalizationMode.BackwardsRatio, 
                                 contractDepthOffset=0)
         future.SetFilter(0, 180)
+        self.owner_by_order_id = {}
         self.symbol_data_by_future = {}
-        self.symbol_data_by_future[future] = SymbolData(self, future, bar_size, trailing_stop_pct)
+        self.symbol_data_by_future[future] = SymbolData(self, future, bar_size, trailing_stop_pct, warm_up_lookback)
 
+    @instrumented
     def OnData(self, data: Slice):    
         for symbol_data in self.symbol_data_by_future.values():
-            ids_to_remove = []
-            for i, trade in enumerate(symbol_data.trade_collection):
-                trade.scan(data)
-                if trade.completed:
-                    ids_to_remove.append(i)
-
-            # Remove completed trades
-            for id_ in ids_to_remove[::-1]:
-                del symbol_data.trade_collection[id_]
+            symbol_data.scan(data)
         
+    @instrumented
     def OnOrderEvent(self, orderEvent: OrderEvent) -> None:
+        # Only stop loss tickets are registered; entry and rollover market orders have no owner
+        trade = self.owner_by_order_id.get(orderEvent.OrderId)
+        if trade is None:
+            return
+        if orderEvent.Status in self.CLOSED_ORDER_STATUSES:
+            del self.owner_by_order_id[orderEvent.OrderId]
+        self.route_order_event(trade, orderEvent)
+
+    def route_order_event(self, trade, orderEvent):
         future = self.Securities[orderEvent.Symbol.Canonical]
-        self.symbol_data_by_future[future].on_order_event(orderEvent)
+        self.symbol_data_by_future[future].on_order_event(trade, orderEvent)
+
+    def register_ticket(self, ticket, owner):
+        # Route the order events of `ticket` to `owner` until the order is closed. A ticket that is already closed (a
+        # stop that filled on submission) raised its events before it had an owner, so the owner gets the ticket itself,
+        # which carries the OrderId, Symbol and final Status of its last order event.
+        if ticket.Status in self.CLOSED_ORDER_STATUSES:
+            self.route_order_event(owner, ticket)
+        else:
+            self.owner_by_order_id[ticket.OrderId] = owner
     
     def OnEndOfDay(self, symbol):
         for symbol_data in self.symbol_data_by_future.values():
-            self.Plot("Open Trades", "Count", len(symbol_data.trade_collection))
+            self.telemetry.plot("Open Trades", "Count", len(symbol_data.trade_book))
+
+    def OnEndOfAlgorithm(self):
+        self.telemetry.close()
+        self.instrumentation.dump()
 
         
 
 class SymbolData:
-    def __init__(self, algorithm, future, bar_size, trailing_stop_pct):
+    def __init__(self, algorithm, future, bar_size, trailing_stop_pct, warm_up_lookback=150):
         self.algorithm = algorithm
         self.future = future
         self.trailing_stop_pct = trailing_stop_pct
@@ -63,21 +93,37 @@ class SymbolData:
         # Warm up RollingWindow objects
         self.is_warming_up = True
         daily_trade_bars = algorithm.History[TradeBar](future.Symbol, self.ema.WarmUpPeriod + self.trailing_ema.Size + 100, Resolution.Daily) # 100 extra days so EMA warms up consistently (see https://www.quantconnect.com/docs/v2/writing-algorithms/indicators/supported-indicators/exponential-moving-average#01-Introduction)
-        minute_trade_bars = algorithm.History[TradeBar](future.Symbol, 150, Resolution.Minute)
-        for daily_trade_bar in daily_trade_bars:
-            for minute_trade_bar in minute_trade_bars:
-                if daily_trade_bar.Time < minute_trade_bar.EndTime < daily_trade_bar.EndTime:
-                    self.consolidator.Update(minute_trade_bar)
-            self.ema.Update(daily_trade_bar.EndTime, daily_trade_bar.Close)
-        #  Iterate through the minute-bars again just in case some minute bars are from a day that's passed the last bar in `daily_trade_bars`
-        for minute_trade_bar in minute_trade_bars:
-            if daily_trade_bar.EndTime < minute_trade_bar.EndTime:
-                self.consolidator.Update(minute_trade_bar)
+        minute_trade_bars = algorithm.History[TradeBar](future.Symbol, warm_up_lookback, Resolution.Minute)
+        self.warm_up(daily_trade_bars, minute_trade_bars)
         self.is_warming_up = False
 
         # Define a collection to manage the independent trades
-        self.trade_collection = []
+        self.trade_book = TradeBook()
+        self.rollover_manager = RolloverManager(algorithm, future)
+
+    def warm_up(self, daily_trade_bars, minute_trade_bars):
+        # Merge the two time-ordered histories in a single pass. A minute bar is fed to the consolidator when it ends
+        # inside a daily bar (before that daily bar updates the EMA) or after the last daily bar. Minute bars that end
+        # between daily bars are skipped.
+        minute_trade_bars = iter(minute_trade_bars)
+        minute_trade_bar = next(minute_trade_bars, None)
+        last_daily_end_time = None
+        for daily_trade_bar in daily_trade_bars:
+            while minute_trade_bar is not None and minute_trade_bar.EndTime <= daily_trade_bar.Time:
+                minute_trade_bar = next(minute_trade_bars, None)
+            while minute_trade_bar is not None and minute_trade_bar.EndTime < daily_trade_bar.EndTime:
+                self.consolidator.Update(minute_trade_bar)
+                minute_trade_bar = next(minute_trade_bars, None)
+            self.ema.Update(daily_trade_bar.EndTime, daily_trade_bar.Close)
+            last_daily_end_time = daily_trade_bar.EndTime
+
+        # Feed the minute bars from a day that's passed the last bar in `daily_trade_bars`
+        while minute_trade_bar is not None:
+            if last_daily_end_time is None or last_daily_end_time < minute_trade_bar.EndTime:
+                self.consolidator.Update(minute_trade_bar)
+            minute_trade_bar = next(minute_trade_bars, None)
 
+    @instrumented
     def consolidation_handler(self, sender: object, consolidated_bar: TradeBar) -> None:
         # Update trialing history
         self.trailing_ema.Add(self.ema.Current.Value)
@@ -88,7 +134,8 @@ class SymbolData:
             return
         
         if self.algorithm.LiveMode:
-            self.algorithm.Log(f"Trailing EMAs: {list(self.trailing_ema)}; Trailing closes: {list(self.trailing_closes)}")
+            self.algorithm.telemetry.log('trailing windows', "Trailing EMAs: {}; Trailing closes: {}",
+                                         values=lambda: (list(self.trailing_ema), list(self.trailing_closes)))
 
         if not self.should_trade:
             return
@@ -98,23 +145,185 @@ class SymbolData:
             and self.trailing_closes[1] > self.trailing_ema[1] \
             and self.trailing_closes[0] > self.trailing_ema[0]:
             # Enter LONG position
-            self.trade_collection.append(Trade(self.algorithm, self.future, OrderDirection.Buy, self.trailing_stop_pct))
+            self.add_trade(Trade(self.algorithm, self.future, OrderDirection.Buy, self.trailing_stop_pct))
         
         # Check for SHORT entry condition (1 close above EMA and then 2 closes below EMA)
         elif self.trailing_closes[2] > self.trailing_ema[2] \
             and self.trailing_closes[1] < self.trailing_ema[1] \
             and self.trailing_closes[0] < self.trailing_ema[0]:
             # Enter SHORT position
-            self.trade_collection.append(Trade(self.algorithm, self.future, OrderDirection.Sell, self.trailing_stop_pct))
+            self.add_trade(Trade(self.algorithm, self.future, OrderDirection.Sell, self.trailing_stop_pct))
         
 
     @property
     def should_trade(self):
-        return len(self.trade_collection) < int(1 / self.trailing_stop_pct)
+        return len(self.trade_book) < int(1 / self.trailing_stop_pct)
 
-    def on_order_event(self, orderEvent: OrderEvent) -> None:
-        for trade in self.trade_collection:
-            trade.on_order_event(orderEvent)
+    def add_trade(self, trade):
+        if not trade.completed:
+            self.trade_book.add(trade)
+
+    def scan(self, data: Slice):
+        # Roll all the open trades together when the continuous contract is remapped
+        self.rollover_manager.scan(data, self.trade_book)
+
+        # Update the trailing stop losses
+        self.trade_book.update(data)
+
+    def on_order_event(self, trade, orderEvent: OrderEvent) -> None:
+        trade.on_order_event(orderEvent)
+        if trade.completed and trade.book_key is not None:
+            self.trade_book.remove(trade)
+
+
+class TradeBook:
+    def __init__(self):
+        # Open trades grouped by (contract, direction) so each quote updates a whole group at once
+        self.groups = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # Iterate over a snapshot so trades can be removed while iterating
+        for group in list(self.groups.values()):
+            yield from list(group.trades)
+
+    def groups_on(self, contract_symbol):
+        # The long and the short group of the trades on `contract_symbol`, whichever are open
+        return [group for (symbol, _), group in self.groups.items() if symbol == contract_symbol]
+
+    def high_water_mark(self, trade):
+        return self.groups[trade.book_key].high_water_marks[trade.book_slot]
+
+    def add(self, trade):
+        key = (trade.contract_symbol, trade.order_direction)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = TradeGroup(trade.contract_symbol, trade.order_direction)
+        group.add(trade)
+        trade.book_key = key
+        self.count += 1
+
+    def remove(self, trade):
+        group = self.groups[trade.book_key]
+        group.remove(trade)
+        if not group.trades:
+            del self.groups[trade.book_key]
+        trade.book_key = None
+        self.count -= 1
+
+    def update(self, data: Slice):
+        for group in self.groups.values():
+            if group.contract_symbol not in data.QuoteBars:
+                continue
+            quote_bar = data.QuoteBars[group.contract_symbol]
+            # Longs trail the bid, shorts trail the ask
+            if group.order_direction == OrderDirection.Buy:
+                group.update(quote_bar.Bid.Close)
+            else:
+                group.update(quote_bar.Ask.Close)
+
+
+class RolloverManager:
+    def __init__(self, algorithm, future):
+        self.algorithm = algorithm
+        self.future = future
+        self.rollover = None
+
+    def scan(self, data: Slice, trade_book):
+        # Catch rollover signals
+        if data.SymbolChangedEvents.Count > 0:
+            for symbol_changed_event in data.SymbolChangedEvents.Values:
+                # Decided from the trade groups on the old contract rather than the net position: offsetting long and
+                # short trades hold no net quantity, but their stops still have to move to the new contract
+                if symbol_changed_event.Symbol == self.future.Symbol and trade_book.groups_on(symbol_changed_event.OldSymbol):
+                    self.rollover = {'old_symbol' : symbol_changed_event.OldSymbol, 'new_symbol': symbol_changed_event.NewSymbol}
+                    self.algorithm.telemetry.debug('rollover', "{} - Contract rollover DETECTED {} => {}", self.algorithm.Time,
+                                                  symbol_changed_event.OldSymbol, symbol_changed_event.NewSymbol)
+
+        # Rollover contracts when their data is available in the Slice
+        if self.rollover is not None and self.rollover['old_symbol'] in data.Bars and self.rollover['new_symbol'] in data.Bars:
+            self.roll(data, trade_book, self.rollover['old_symbol'], self.rollover['new_symbol'])
+            self.algorithm.telemetry.debug('rollover', "{} - Contract rollover TRADED {} => {}", self.algorithm.Time,
+                                           self.rollover['old_symbol'], self.rollover['new_symbol'])
+            self.rollover = None
+
+    def roll(self, data: Slice, trade_book, old_symbol, new_symbol):
+        groups = trade_book.groups_on(old_symbol)
+        trades = [trade for group in groups for trade in group.trades]
+
+        # Cancel the stop losses of every group first so none of them can trigger while the position is moved
+        for trade in trades:
+            trade.stop_loss_ticket.Cancel()
+
+        # Net the trades of both groups into a single close/open pair, or no orders at all if they offset each other
+        quantity = sum(trade.quantity for trade in trades)
+        close_price = data.Bars[old_symbol].Close
+        open_price = data.Bars[new_symbol].Close
+        if quantity != 0:
+            close_price = self.algorithm.MarketOrder(old_symbol, -quantity).AverageFillPrice or close_price
+            open_price = self.algorithm.MarketOrder(new_symbol, quantity).AverageFillPrice or open_price
+
+        # Re-attach each group's stop losses on the new contract, with their high-water marks adjusted by the price ratio
+        # between the contracts
+        price_ratio = open_price / close_price
+        for trade in trades:
+            high_water_mark = trade_book.high_water_mark(trade) * price_ratio
+            trade_book.remove(trade)
+            trade.attach_stop_loss(new_symbol, high_water_mark)
+            if not trade.completed:
+                trade_book.add(trade)
+
+
+class TradeGroup:
+    def __init__(self, contract_symbol, order_direction, capacity=8):
+        self.contract_symbol = contract_symbol
+        self.order_direction = order_direction
+        self.trades = []
+        self.high_water_marks = np.empty(capacity)
+        self.stop_prices = np.empty(capacity)
+
+    def add(self, trade):
+        slot = len(self.trades)
+        if slot == len(self.high_water_marks):
+            self.high_water_marks = np.resize(self.high_water_marks, 2 * slot)
+            self.stop_prices = np.resize(self.stop_prices, 2 * slot)
+        self.trades.append(trade)
+        self.high_water_marks[slot] = trade.high_water_mark
+        self.stop_prices[slot] = trade.stop_price
+        trade.book_slot = slot
+
+    def remove(self, trade):
+        # Swap the last trade into the freed slot so removal is O(1)
+        slot = trade.book_slot
+        last_slot = len(self.trades) - 1
+        last_trade = self.trades.pop()
+        if slot != last_slot:
+            self.trades[slot] = last_trade
+            self.high_water_marks[slot] = self.high_water_marks[last_slot]
+            self.stop_prices[slot] = self.stop_prices[last_slot]
+            last_trade.book_slot = slot
+        trade.book_slot = None
+
+    def update(self, current_price):
+        high_water_marks = self.high_water_marks[:len(self.trades)]
+        if self.order_direction == OrderDirection.Buy:
+            moved = high_water_marks < current_price
+        else:
+            moved = high_water_marks > current_price
+        if not moved.any():
+            return
+        high_water_marks[moved] = current_price
+
+        # Every trade that moved now shares the same high-water mark, so they share the same stop price. Only the
+        # tickets whose rounded stop level actually changes are updated.
+        stop_price = self.trades[0].get_stop_loss_price(current_price)
+        stop_prices = self.stop_prices[:len(self.trades)]
+        for slot in np.flatnonzero(moved & (stop_prices != stop_price)):
+            stop_prices[slot] = stop_price
+            self.trades[slot].stop_loss_ticket.UpdateStopPrice(stop_price)
 
 
 class Trade:
@@ -125,14 +334,15 @@ class Trade:
         self.trailing_stop_pct = trailing_stop_pct
 
         self.completed = False
-        self.rollover = None
+        self.book_key = None # Set while the trade is in a TradeBook
 
         self.place_orders(future.Mapped, order_direction)
 
     def place_orders(self, contract_symbol, order_direction):
         self.contract_symbol = contract_symbol
         self.quantity = 0
-        self.high_water_mark = 0
+        self.high_water_mark = 0 # Once the trade is in a TradeBook, the book trails the high-water mark
+        self.stop_price = None
         self.stop_loss_ticket = None
 
         # Calculate order quantity -- 0, 1, or -1 contract
@@ -150,9 +360,17 @@ class Trade:
         self.high_water_mark = self.algorithm.MarketOrder(contract_symbol, self.quantity).AverageFillPrice
 
         # Submit stop loss order
-        self.stop_loss_ticket = self.algorithm.StopMarketOrder(contract_symbol, -self.quantity, self.get_stop_loss_price(order_direction)) 
+        self.attach_stop_loss(contract_symbol, self.high_water_mark)
+
+    def attach_stop_loss(self, contract_symbol, high_water_mark):
+        # Also used by the RolloverManager to move the stop loss onto the new contract after it rolled the position
+        self.contract_symbol = contract_symbol
+        self.high_water_mark = high_water_mark
+        self.stop_price = self.get_stop_loss_price(high_water_mark)
+        self.stop_loss_ticket = self.algorithm.StopMarketOrder(contract_symbol, -self.quantity, self.stop_price) 
+        self.algorithm.register_ticket(self.stop_loss_ticket, self)
 
-    def get_stop_loss_price(self, order_direction):
+    def get_stop_loss_price(self, high_water_mark):
         def round_price(price):
             # Round the stop loss price level so we don't get errors from not following the MinimumPriceVariation
             minimum_price_variation = self.future.SymbolProperties.MinimumPriceVariation
@@ -160,47 +378,12 @@ class Trade:
             return round(int(price / minimum_price_variation) * minimum_price_variation, precision)
         
         # Longs
-        if order_direction == OrderDirection.Buy:
-            return round_price(self.high_water_mark * (1 - self.trailing_stop_pct / self.future.SymbolProperties.ContractMultiplier))
+        if self.order_direction == OrderDirection.Buy:
+            return round_price(high_water_mark * (1 - self.trailing_stop_pct / self.future.SymbolProperties.ContractMultiplier))
         
         # Shorts
-        return round_price(self.high_water_mark * (1 + self.trailing_stop_pct / self.future.SymbolProperties.ContractMultiplier))
-
-
-    def scan(self, data: Slice):
-        # Catch rollover signals
-        for symbol_changed_event in  data.SymbolChangedEvents.Values:
-            if symbol_changed_event.Symbol == self.future.Symbol:
-                quantity = self.algorithm.Portfolio[symbol_changed_event.OldSymbol].Quantity
-                if quantity != 0:
-                    self.rollover = {'old_symbol' : symbol_changed_event.OldSymbol, 'new_symbol': symbol_changed_event.NewSymbol, 'quantity': quantity}
-                    self.algorithm.Debug(f"{self.algorithm.Time} - Contract rollover DETECTED {symbol_changed_event.OldSymbol} => {symbol_changed_event.NewSymbol}")
-        
-        # Rollover contracts when their data is available in the Slice
-        if self.rollover is not None and self.rollover['old_symbol'] in data.Bars and self.rollover['new_symbol'] in data.Bars:
-            # Close trade on current contract
-            self.algorithm.MarketOrder(self.contract_symbol, -self.quantity)
-            self.stop_loss_ticket.Cancel()
-
-            # Buy new contract and set stop loss order
-            self.place_orders(self.rollover['new_symbol'], self.order_direction)
-            self.algorithm.Debug(f"{self.algorithm.Time} - Contract rollover TRADED {self.rollover['old_symbol']} => {self.rollover['new_symbol']}")
-            self.rollover = None
+        return round_price(high_water_mark * (1 + self.trailing_stop_pct / self.future.SymbolProperties.ContractMultiplier))
 
-        # Update trailing stop loss
-        if self.contract_symbol in data.QuoteBars:
-            # Longs
-            if self.order_direction == OrderDirection.Buy: 
-                current_price = data.QuoteBars[self.contract_symbol].Bid.Close
-                if current_price > self.high_water_mark:
-                    self.high_water_mark = current_price
-                    self.stop_loss_ticket.UpdateStopPrice(self.get_stop_loss_price(self.order_direction))
-            # Shorts
-            elif self.order_direction == OrderDirection.Sell:
-                current_price = data.QuoteBars[self.contract_symbol].Ask.Close
-                if current_price < self.high_water_mark:
-                    self.high_water_mark = current_price
-                    self.stop_loss_ticket.UpdateStopPrice(self.get_stop_loss_price(self.order_direction))
 
     def on_order_event(self, orderEvent: OrderEvent) -> None:
         # When the stop loss is hit, mark the trade as completed
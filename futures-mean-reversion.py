@@ -13,14 +13,22 @@
 
 # region imports
 from AlgorithmImports import *
+import numpy as np
+from instrumentation import Instrumentation, instrumented
 # endregion
 
 class SwimmingBlackTermite(QCAlgorithm):
 
+    # Order statuses after which a ticket receives no more order events
+    CLOSED_ORDER_STATUSES = (OrderStatus.Filled, OrderStatus.Canceled, OrderStatus.Invalid)
+
     def Initialize(self):
         self.SetStartDate(2019, 1, 1)
         self.SetEndDate(2022, 12, 1)
         self.SetCash(100000)
+
+        # Opt-in timing of the callbacks (see instrumentation.py), with the parameter instrumentation=on
+        self.instrumentation = Instrumentation(self, enabled=self.GetParameter('instrumentation') == 'on')
         
         self.max_loss = 3000 # Per trade position (used to place the stop loss)
         self.stop_loss_std_multiple = 1 # std from current price
@@ -29,6 +37,7 @@ class SwimmingBlackTermite(QCAlgorithm):
         self.long_bb_threshold = 0.2
         self.short_bb_threshold = 0.8
 
+        self.owner_by_order_id = {}
         self.symbol_data_by_future = {}
         tickers = [
             #Futures.Indices.SP500EMini,
@@ -36,42 +45,96 @@ class SwimmingBlackTermite(QCAlgorithm):
             #Futures.Indices.NASDAQ100EMini,
             #Futures.Indices.Russell2000EMini
         ]
+        # BB(24, 2) on hourly bars and STD(22) on daily bars for every future, row i belongs to self.futures[i]
+        self.indicator_bank = IndicatorBank(len(tickers), bb_period=24, bb_k=2, std_period=22, 
+                                            long_bb_threshold=self.long_bb_threshold, short_bb_threshold=self.short_bb_threshold)
+        self.futures = []
+        # Futures with an open position, maintained from order events
+        self.invested = np.zeros(len(tickers), dtype=bool)
         for ticker in tickers:
             future = self.AddFuture(ticker, Resolution.Minute, 
                                     dataMappingMode=DataMappingMode.OpenInterest, 
                                     dataNormalizationMode=DataNormalizationMode.BackwardsRatio, 
                                     contractDepthOffset=0)
             future.SetFilter(0, 180)
+            self.futures.append(future)
             self.symbol_data_by_future[future] = SymbolData(self, future, self.max_loss, self.profit_target_multiple, 
                                                             self.max_holding_time, self.stop_loss_std_multiple, 
-                                                            self.long_bb_threshold, self.short_bb_threshold)
+                                                            self.long_bb_threshold, self.short_bb_threshold, 
+                                                            self.indicator_bank)
 
+    @instrumented
     def OnData(self, data: Slice):
-        # Get current positions
-        current_holds = [self.Securities[security_holding.Symbol.Canonical] for security_holding in self.Portfolio.Values if security_holding.Invested]
-
-        # Find new entries
-        z_score_by_symbol_data = {future: symbol_data.z_score for future, symbol_data in self.symbol_data_by_future.items() if symbol_data.allowed_entry}
-        new_longs = sorted([(future, z_score) for future, z_score in z_score_by_symbol_data.items() if z_score <= self.long_bb_threshold and future not in current_holds], key=lambda kvp: kvp[1], reverse=True)
-        new_shorts = sorted([(future, z_score) for future, z_score in z_score_by_symbol_data.items() if z_score >= self.short_bb_threshold and future not in current_holds], key=lambda kvp: kvp[1], reverse=False)        
-
-        # Enter new positions
-        for future, _ in new_longs + new_shorts:
-            symbol_data = self.symbol_data_by_future[future]
-            if self.Portfolio.MarginRemaining > symbol_data.required_buying_power:
-                symbol_data.trade()
-
-        for symbol_data in self.symbol_data_by_future.values():
-            symbol_data.scan(data)
+        # Update the indicators of every future in one step
+        self.indicator_bank.update(data)
+
+        # Find and enter new positions
+        self.enter_positions()
+
+        # Only futures with a position have stops, holding times or rollovers to manage
+        for row in np.flatnonzero(self.invested):
+            self.symbol_data_by_future[self.futures[row]].scan(data)
+
+    def enter_positions(self):
+        # Cheap gates first, so most minutes return before any z-score or sort work: the future must be flat, its STD
+        # must size at least one contract, its price must be beyond a BB threshold, its stop loss delay over, and the
+        # margin available.
+        candidates = ~self.invested & self.indicator_bank.entry_signals()
+        if not candidates.any():
+            return
+        rows = [row for row in np.flatnonzero(candidates) if self.symbol_data_by_future[self.futures[row]].allowed_entry]
+        if not rows:
+            return
+        required_buying_power = {row: self.symbol_data_by_future[self.futures[row]].required_buying_power for row in rows}
+        if self.Portfolio.MarginRemaining <= min(required_buying_power.values()):
+            return
 
+        # Longs by descending z-score, then shorts by ascending z-score. The z-scores are computed once and handed to
+        # the trades.
+        rows = np.array(rows)
+        z_scores = self.indicator_bank.z_score(rows)
+        longs = np.flatnonzero(z_scores <= self.long_bb_threshold)
+        shorts = np.flatnonzero(z_scores >= self.short_bb_threshold)
+        order = np.concatenate((longs[np.argsort(-z_scores[longs], kind='stable')],
+                                shorts[np.argsort(z_scores[shorts], kind='stable')]))
+
+        for i in order:
+            row = rows[i]
+            if self.Portfolio.MarginRemaining > required_buying_power[row]:
+                self.symbol_data_by_future[self.futures[row]].trade(z_scores[i])
+
+    @instrumented
     def OnOrderEvent(self, orderEvent: OrderEvent) -> None:
-        future = self.Securities[orderEvent.Symbol.Canonical]
-        self.symbol_data_by_future[future].on_order_event(orderEvent)
+        # Keep the invested flags current
+        if orderEvent.Status in (OrderStatus.Filled, OrderStatus.PartiallyFilled):
+            symbol_data = self.symbol_data_by_future[self.Securities[orderEvent.Symbol.Canonical]]
+            symbol_data.update_holdings(orderEvent.Symbol)
+            self.invested[symbol_data.row] = symbol_data.invested
+
+        # Only stop loss and profit target tickets are registered; entry and liquidation orders have no owner
+        symbol_data = self.owner_by_order_id.get(orderEvent.OrderId)
+        if symbol_data is None:
+            return
+        if orderEvent.Status in self.CLOSED_ORDER_STATUSES:
+            del self.owner_by_order_id[orderEvent.OrderId]
+        symbol_data.on_order_event(orderEvent)
+
+    def register_ticket(self, ticket, owner):
+        # Route the order events of `ticket` to `owner` until the order is closed. A ticket that is already closed (an
+        # exit order that filled on submission) raised its events before it had an owner, so the owner gets the ticket
+        # itself, which carries the OrderId, Symbol and final Status of its last order event.
+        if ticket.Status in self.CLOSED_ORDER_STATUSES:
+            owner.on_order_event(ticket)
+        else:
+            self.owner_by_order_id[ticket.OrderId] = owner
+
+    def OnEndOfAlgorithm(self):
+        self.instrumentation.dump()
 
         
 
 class SymbolData:
-    def __init__(self, algorithm, future, max_loss, profit_target_multiple, max_holding_time, stop_loss_std_multiple, long_bb_threshold, short_bb_threshold):
+    def __init__(self, algorithm, future, max_loss, profit_target_multiple, max_holding_time, stop_loss_std_multiple, long_bb_threshold, short_bb_threshold, indicator_bank):
         self.algorithm = algorithm
         self.future = future
         self.max_loss = max_loss
@@ -81,34 +144,26 @@ class SymbolData:
         self.long_bb_threshold = long_bb_threshold
         self.short_bb_threshold = short_bb_threshold
 
-        # Create indicators
-        algorithm.EnableAutomaticIndicatorWarmUp = True
-        self.bb = algorithm.BB(future.Symbol, 24, 2, resolution=Resolution.Hour)
-        self.std = algorithm.STD(future.Symbol, 22, Resolution.Daily)
-        self.price = algorithm.Identity(future.Symbol)
+        # Register with the shared indicator bank
+        self.indicator_bank = indicator_bank
+        self.row = indicator_bank.add(algorithm, future.Symbol, max_loss, stop_loss_std_multiple,
+                                      future.SymbolProperties.ContractMultiplier)
 
         self.profit_target_ticket = None
         self.stop_loss_ticket = None
 
         self.last_trade_entry_time = None
-        self.rollover = None
+        self.invested_contracts = set()
+        self.rollover_manager = RolloverManager(algorithm, future)
         self.stop_loss_hit_time = None
         self.stop_loss_hit_delay = timedelta(days=7)
 
     
-    def trade(self):
+    def trade(self, z_score):
         # Set stop loss n-std away (the max loss controls how many contracts we buy)
-        z_score = self.z_score 
-
-        def round_price(price):
-            # Round the tp/sl price level so we don't get errors from not following the MinimumPriceVariation
-            minimum_price_variation = self.future.SymbolProperties.MinimumPriceVariation
-            precision = len(str(minimum_price_variation).split('.')[1])
-            return round(int(price / minimum_price_variation) * minimum_price_variation, precision)
-
         pct_portfolio_available = self.algorithm.Portfolio.MarginRemaining / (self.algorithm.Portfolio.TotalMarginUsed + self.algorithm.Portfolio.MarginRemaining)
         if z_score <= self.long_bb_threshold:
-            quantity = int(self.max_loss / (self.stop_loss_std_multiple*self.std.Current.Value * self.future.SymbolProperties.ContractMultiplier))
+            quantity = self.max_quantity
             quantity = min(quantity, self.algorithm.CalculateOrderQuantity(self.future.Mapped, pct_portfolio_available))
             if quantity == 0:
                 return
@@ -116,18 +171,15 @@ class SymbolData:
             # Entry order
             entry_price = self.algorithm.MarketOrder(self.future.Mapped, quantity).AverageFillPrice
 
-            # Stop loss order
-            stop_loss_price_level = round_price(entry_price - self.stop_loss_std_multiple*self.std.Current.Value)
-            self.stop_loss_ticket = self.algorithm.StopMarketOrder(self.future.Mapped, -quantity, stop_loss_price_level) 
-
-            # Profit target order
-            profit_target_price_level = round_price(entry_price + self.stop_loss_std_multiple*self.std.Current.Value*self.profit_target_multiple)
-            self.profit_target_ticket = self.algorithm.LimitOrder(self.future.Mapped, -quantity, profit_target_price_level)
-
-            # Record entry time
+            # Record entry time before the exit orders, which reset it if one of them fills on submission
             self.last_trade_entry_time = self.algorithm.Time
+
+            # Stop loss and profit target orders
+            stop_loss_price_level = self.round_price(entry_price - self.stop_loss_std_multiple*self.std)
+            profit_target_price_level = self.round_price(entry_price + self.stop_loss_std_multiple*self.std*self.profit_target_multiple)
+            self.place_exit_orders(self.future.Mapped, quantity, stop_loss_price_level, profit_target_price_level)
         elif z_score >= self.short_bb_threshold:
-            quantity = -int(self.max_loss / (self.stop_loss_std_multiple*self.std.Current.Value * self.future.SymbolProperties.ContractMultiplier))
+            quantity = -self.max_quantity
             quantity = max(quantity, self.algorithm.CalculateOrderQuantity(self.future.Mapped, -pct_portfolio_available))
             if quantity == 0:
                 return
@@ -135,32 +187,64 @@ class SymbolData:
             # Entry order
             entry_price = self.algorithm.MarketOrder(self.future.Mapped, quantity).AverageFillPrice
 
-            # Stop loss order
-            stop_loss_price_level = round_price(entry_price + self.stop_loss_std_multiple*self.std.Current.Value)
-            self.stop_loss_ticket = self.algorithm.StopMarketOrder(self.future.Mapped, -quantity, stop_loss_price_level) 
-
-            # Profit target order
-            profit_target_price_level = round_price(entry_price - self.stop_loss_std_multiple*self.std.Current.Value*self.profit_target_multiple)
-            self.profit_target_ticket = self.algorithm.LimitOrder(self.future.Mapped, -quantity, profit_target_price_level)
-
-            # Record entry time
+            # Record entry time before the exit orders, which reset it if one of them fills on submission
             self.last_trade_entry_time = self.algorithm.Time
+
+            # Stop loss and profit target orders
+            stop_loss_price_level = self.round_price(entry_price + self.stop_loss_std_multiple*self.std)
+            profit_target_price_level = self.round_price(entry_price - self.stop_loss_std_multiple*self.std*self.profit_target_multiple)
+            self.place_exit_orders(self.future.Mapped, quantity, stop_loss_price_level, profit_target_price_level)
         elif self.profit_target_ticket is not None or self.stop_loss_ticket is not None:
             self.algorithm.Debug(f"{self.algorithm.Time} - Closing {self.future.Symbol} because not in the BB bounds")
             self.close()
 
+    def place_exit_orders(self, contract_symbol, quantity, stop_loss_price_level, profit_target_price_level):
+        # Register each ticket as soon as it is placed. A stop loss that fills on submission resets the trade, so no
+        # profit target is placed for it.
+        self.profit_target_ticket = None
+        self.stop_loss_ticket = self.algorithm.StopMarketOrder(contract_symbol, -quantity, stop_loss_price_level) 
+        self.algorithm.register_ticket(self.stop_loss_ticket, self)
+        if self.stop_loss_ticket is None:
+            return
+        self.profit_target_ticket = self.algorithm.LimitOrder(contract_symbol, -quantity, profit_target_price_level)
+        self.algorithm.register_ticket(self.profit_target_ticket, self)
+
+    def round_price(self, price):
+        # Round the tp/sl price level so we don't get errors from not following the MinimumPriceVariation
+        minimum_price_variation = self.future.SymbolProperties.MinimumPriceVariation
+        precision = len(str(minimum_price_variation).split('.')[1])
+        return round(int(price / minimum_price_variation) * minimum_price_variation, precision)
+
     @property
     def required_buying_power(self):
         margin_required_per_contract = self.algorithm.Securities[self.future.Mapped].BuyingPowerModel.InitialIntradayMarginRequirement
-        max_quantity = int(self.max_loss / (self.stop_loss_std_multiple * self.std.Current.Value * self.future.SymbolProperties.ContractMultiplier))
-        margin_required_for_max_quantity = max_quantity * margin_required_per_contract
+        margin_required_for_max_quantity = self.max_quantity * margin_required_per_contract
         return margin_required_for_max_quantity
 
+    @property
+    def std(self):
+        return self.indicator_bank.std[self.row]
+
+    @property
+    def max_quantity(self):
+        # Contracts the max loss buys with the stop n-std away, sized by the indicator bank whenever the STD updates
+        return int(self.indicator_bank.max_quantities[self.row])
+
     @property
     def z_score(self):
-        # Calculate BB factor scores
-        bb_width = (self.bb.UpperBand.Current.Value - self.bb.LowerBand.Current.Value)
-        return (self.price.Current.Value - self.bb.LowerBand.Current.Value) / bb_width
+        # BB factor score
+        return self.indicator_bank.z_score(self.row)
+
+    @property
+    def invested(self):
+        return bool(self.invested_contracts)
+
+    def update_holdings(self, contract_symbol):
+        # A rollover briefly holds two contracts, so track them individually
+        if self.algorithm.Portfolio[contract_symbol].Invested:
+            self.invested_contracts.add(contract_symbol)
+        else:
+            self.invested_contracts.discard(contract_symbol)
 
     @property
     def allowed_entry(self):
@@ -172,23 +256,8 @@ class SymbolData:
         return False
     
     def scan(self, data: Slice):
-        # Catch rollover signals
-        for symbol_changed_event in  data.SymbolChangedEvents.Values:
-            if symbol_changed_event.Symbol == self.future.Symbol:
-                quantity = self.algorithm.Portfolio[symbol_changed_event.OldSymbol].Quantity
-                if quantity != 0:
-                    self.rollover = {'old_symbol' : symbol_changed_event.OldSymbol, 'new_symbol': symbol_changed_event.NewSymbol, 'quantity': quantity}
-                    self.algorithm.Debug(f"{self.algorithm.Time} - Contract rollover DETECTED {symbol_changed_event.OldSymbol} => {symbol_changed_event.NewSymbol}")
-        
-        # Rollover contracts when their data is available in the Slice
-        if self.rollover is not None and self.rollover['old_symbol'] in data.Bars and self.rollover['new_symbol'] in data.Bars:
-            # Close current contract
-            self.close()
-
-            # Buy new contract and set tp/sl orders
-            self.trade()
-            self.algorithm.Debug(f"{self.algorithm.Time} - Contract rollover TRADED {self.rollover['old_symbol']} => {self.rollover['new_symbol']}")
-            self.rollover = None
+        # Move the position and its tp/sl orders when the continuous contract is remapped
+        self.rollover_manager.scan(data, self)
 
         # Only hold positions up to a max of n days
         if self.last_trade_entry_time is not None and data.Time > self.last_trade_entry_time + self.max_holding_time:
@@ -212,7 +281,8 @@ class SymbolData:
         if orderEvent.Status != OrderStatus.Filled:
             return
         if self.stop_loss_ticket is not None and orderEvent.OrderId == self.stop_loss_ticket.OrderId:
-            self.profit_target_ticket.Cancel("Stop loss hit")
+            if self.profit_target_ticket is not None:
+                self.profit_target_ticket.Cancel("Stop loss hit")
             self.stop_loss_hit_time = self.algorithm.Time
         elif self.profit_target_ticket is not None and orderEvent.OrderId == self.profit_target_ticket.OrderId:
             self.stop_loss_ticket.Cancel("Profit target hit")
@@ -224,3 +294,182 @@ class SymbolData:
         self.profit_target_ticket = None
         self.stop_loss_ticket = None
         self.last_trade_entry_time = None
+
+
+class IndicatorBank:
+    def __init__(self, size, bb_period, bb_k, std_period, long_bb_threshold, short_bb_threshold):
+        # One row per future. The consolidators only stage their closes; `update` then pushes every staged close into
+        # the rolling windows and recomputes the bands and standard deviations with array operations. Z-scores are only
+        # computed on demand; the per-minute entry check compares prices with the band levels that match the thresholds,
+        # and skips the futures whose STD sizes a trade to 0 contracts.
+        self.bb_k = bb_k
+        self.long_bb_threshold = long_bb_threshold
+        self.short_bb_threshold = short_bb_threshold
+        self.symbols = []
+
+        self.hourly_closes = np.full((size, bb_period), np.nan)
+        self.hourly_counts = np.zeros(size, dtype=int)
+        self.staged_hourly_closes = np.full(size, np.nan)
+        self.lower_bands = np.full(size, np.nan)
+        self.band_widths = np.full(size, np.nan)
+        self.long_entry_prices = np.full(size, np.nan)
+        self.short_entry_prices = np.full(size, np.nan)
+
+        self.daily_closes = np.full((size, std_period), np.nan)
+        self.daily_counts = np.zeros(size, dtype=int)
+        self.staged_daily_closes = np.full(size, np.nan)
+        self.std = np.full(size, np.nan)
+        # Set by the consolidators, so `update` only looks at the staged closes on the minutes that have any
+        self.staged = False
+
+        # Contracts a trade buys: int(max_loss / (stop_loss_std_multiple * std * contract_multiplier))
+        self.max_losses = np.zeros(size)
+        self.stop_loss_std_multiples = np.ones(size)
+        self.contract_multipliers = np.ones(size)
+        self.max_quantities = np.zeros(size)
+
+        self.prices = np.full(size, np.nan)
+
+    def add(self, algorithm, symbol, max_loss, stop_loss_std_multiple, contract_multiplier):
+        row = len(self.symbols)
+        self.symbols.append(symbol)
+        self.max_losses[row] = max_loss
+        self.stop_loss_std_multiples[row] = stop_loss_std_multiple
+        self.contract_multipliers[row] = contract_multiplier
+
+        @instrumented('IndicatorBank.on_hourly_bar')
+        def on_hourly_bar(sender, bar):
+            self.staged_hourly_closes[row] = bar.Close
+            self.staged = True
+
+        @instrumented('IndicatorBank.on_daily_bar')
+        def on_daily_bar(sender, bar):
+            self.staged_daily_closes[row] = bar.Close
+            self.staged = True
+
+        for resolution, handler in ((Resolution.Hour, on_hourly_bar), (Resolution.Daily, on_daily_bar)):
+            consolidator = algorithm.ResolveConsolidator(symbol, resolution)
+            consolidator.DataConsolidated += handler
+            algorithm.SubscriptionManager.AddConsolidator(symbol, consolidator)
+
+        # Warm up the windows from history
+        hourly_closes = [bar.Close for bar in algorithm.History[TradeBar](symbol, self.hourly_closes.shape[1], Resolution.Hour)]
+        daily_closes = [bar.Close for bar in algorithm.History[TradeBar](symbol, self.daily_closes.shape[1], Resolution.Daily)]
+        for close in hourly_closes:
+            self.push(self.hourly_closes, self.hourly_counts, [row], [close])
+        for close in daily_closes:
+            self.push(self.daily_closes, self.daily_counts, [row], [close])
+        self.update_bands([row])
+        self.update_std([row])
+        if hourly_closes:
+            self.prices[row] = hourly_closes[-1]
+        return row
+
+    @staticmethod
+    def push(windows, counts, rows, closes):
+        # Write each close into its row's ring buffer slot
+        windows[rows, counts[rows] % windows.shape[1]] = closes
+        counts[rows] += 1
+
+    def update_bands(self, rows):
+        rows = np.asarray(rows)
+        rows = rows[self.hourly_counts[rows] >= self.hourly_closes.shape[1]]
+        windows = self.hourly_closes[rows]
+        middle = windows.mean(axis=1)
+        deviation = windows.std(axis=1)
+        self.lower_bands[rows] = middle - self.bb_k * deviation
+        self.band_widths[rows] = 2 * self.bb_k * deviation
+
+        # Price levels where the z-score crosses the entry thresholds (a flat band has no defined z-score)
+        band_widths = np.where(deviation > 0, self.band_widths[rows], np.nan)
+        self.long_entry_prices[rows] = self.lower_bands[rows] + self.long_bb_threshold * band_widths
+        self.short_entry_prices[rows] = self.lower_bands[rows] + self.short_bb_threshold * band_widths
+
+    def update_std(self, rows):
+        rows = np.asarray(rows)
+        rows = rows[self.daily_counts[rows] >= self.daily_closes.shape[1]]
+        std = self.std[rows] = self.daily_closes[rows].std(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            max_quantities = np.trunc(self.max_losses[rows]
+                                      / (self.stop_loss_std_multiples[rows] * std * self.contract_multipliers[rows]))
+        self.max_quantities[rows] = np.where((std > 0) & np.isfinite(max_quantities), max_quantities, 0)
+
+    def update(self, data: Slice):
+        bars = data.Bars
+        for row, symbol in enumerate(self.symbols):
+            if symbol in bars:
+                self.prices[row] = bars[symbol].Close
+
+        # The consolidators only emit on the hour, so most minutes have nothing staged
+        if not self.staged:
+            return
+        self.staged = False
+
+        rows = np.flatnonzero(~np.isnan(self.staged_hourly_closes))
+        if rows.size:
+            self.push(self.hourly_closes, self.hourly_counts, rows, self.staged_hourly_closes[rows])
+            self.staged_hourly_closes[rows] = np.nan
+            self.update_bands(rows)
+
+        rows = np.flatnonzero(~np.isnan(self.staged_daily_closes))
+        if rows.size:
+            self.push(self.daily_closes, self.daily_counts, rows, self.staged_daily_closes[rows])
+            self.staged_daily_closes[rows] = np.nan
+            self.update_std(rows)
+
+    def entry_signals(self):
+        # Futures whose price is beyond a threshold and whose STD sizes a trade to at least one contract. NaN levels
+        # never qualify.
+        return (self.max_quantities > 0) & ((self.prices <= self.long_entry_prices) | (self.prices >= self.short_entry_prices))
+
+    def z_score(self, rows):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.band_widths[rows] > 0, (self.prices[rows] - self.lower_bands[rows]) / self.band_widths[rows], np.nan)
+
+
+class RolloverManager:
+    def __init__(self, algorithm, future):
+        self.algorithm = algorithm
+        self.future = future
+        self.rollover = None
+
+    def scan(self, data: Slice, symbol_data):
+        # Catch rollover signals
+        if data.SymbolChangedEvents.Count > 0:
+            for symbol_changed_event in data.SymbolChangedEvents.Values:
+                if symbol_changed_event.Symbol == self.future.Symbol:
+                    quantity = self.algorithm.Portfolio[symbol_changed_event.OldSymbol].Quantity
+                    if quantity != 0:
+                        self.rollover = {'old_symbol' : symbol_changed_event.OldSymbol, 'new_symbol': symbol_changed_event.NewSymbol, 'quantity': quantity}
+                        self.algorithm.Debug(f"{self.algorithm.Time} - Contract rollover DETECTED {symbol_changed_event.OldSymbol} => {symbol_changed_event.NewSymbol}")
+
+        # Rollover contracts when their data is available in the Slice
+        if self.rollover is not None and self.rollover['old_symbol'] in data.Bars and self.rollover['new_symbol'] in data.Bars:
+            self.roll(data, symbol_data, self.rollover['old_symbol'], self.rollover['new_symbol'])
+            self.algorithm.Debug(f"{self.algorithm.Time} - Contract rollover TRADED {self.rollover['old_symbol']} => {self.rollover['new_symbol']}")
+            self.rollover = None
+
+    def roll(self, data: Slice, symbol_data, old_symbol, new_symbol):
+        quantity = self.algorithm.Portfolio[old_symbol].Quantity
+        if quantity == 0:
+            return # The tp/sl was hit before the new contract had data
+        if symbol_data.stop_loss_ticket is None or symbol_data.profit_target_ticket is None:
+            symbol_data.close()
+            return
+
+        # Cancel the tp/sl orders first so neither can trigger while the position is moved
+        stop_loss_price_level = symbol_data.stop_loss_ticket.Get(OrderField.StopPrice)
+        profit_target_price_level = symbol_data.profit_target_ticket.Get(OrderField.LimitPrice)
+        symbol_data.stop_loss_ticket.Cancel("Contract rollover")
+        symbol_data.profit_target_ticket.Cancel("Contract rollover")
+
+        # Move the position with a single close/open pair
+        close_price = self.algorithm.MarketOrder(old_symbol, -quantity).AverageFillPrice or data.Bars[old_symbol].Close
+        open_price = self.algorithm.MarketOrder(new_symbol, quantity).AverageFillPrice or data.Bars[new_symbol].Close
+
+        # Re-attach the tp/sl orders on the new contract, adjusted by the price ratio between the contracts. The
+        # holding period keeps counting from the original entry.
+        price_ratio = open_price / close_price
+        symbol_data.place_exit_orders(new_symbol, quantity, 
+                                      symbol_data.round_price(stop_loss_price_level * price_ratio), 
+                                      symbol_data.round_price(profit_target_price_level * price_ratio))
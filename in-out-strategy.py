@@ -13,6 +13,10 @@ https://www.quantconnect.com/forum/discussion/9597/the-in-amp-out-strategy-conti
 import numpy as np
 import pandas as pd
 import scipy as sc
+from bisect import bisect_left, insort
+from collections import deque
+from portfolio_rebalancer import PortfolioRebalancer
+from instrumentation import Instrumentation, instrumented
 
 
 class InOut(QCAlgorithm):
@@ -21,6 +25,8 @@ class InOut(QCAlgorithm):
 
         self.SetStartDate(2008, 1, 1)  # Set Start Date
         self.SetCash(100000)  # Set Strategy Cash
+        # Opt-in timing of the callbacks (see instrumentation.py), with the parameter instrumentation=on
+        self.instrumentation = Instrumentation(self, enabled=self.GetParameter('instrumentation') == 'on')
         self.UniverseSettings.Resolution = Resolution.Daily
         res = Resolution.Minute
         
@@ -54,6 +60,19 @@ class InOut(QCAlgorithm):
 
         self.FORPAIRS = [self.GOLD, self.SLVA, self.UTIL, self.SHCU, self.RICU]
         self.SIGNALS = [self.PRDC, self.METL, self.NRES, self.DEBT, self.USDX]
+        self.pairlist = ['G_S', 'U_I', 'C_A']
+
+        # Rolling 1st percentile of every signal column (USDX reverse coded, then the pairs) over the returns window
+        store_symbols = self.SIGNALS + [self.MRKT] + self.FORPAIRS
+        self.signal_columns = [store_symbols.index(symbol) for symbol in self.SIGNALS]
+        self.pair_columns = [(store_symbols.index(a), store_symbols.index(b)) for a, b in 
+                             ((self.GOLD, self.SLVA), (self.UTIL, self.INDU), (self.SHCU, self.RICU))]
+        self.signal_signs = np.array([-1 if symbol == self.USDX else 1 for symbol in self.SIGNALS])
+        self.signal_percentiles = [RollingPercentile(252 - 65, 1) for _ in self.SIGNALS + self.pairlist]
+        self.latest_signal_returns = np.full(len(self.signal_percentiles), np.nan)
+
+        # Rolling store of daily closes: seeded with one History call, then appended to by daily consolidators
+        self.close_store = DailyCloseStore(self, store_symbols, lookback=252, on_returns=self.update_signal_percentiles)
 
         # Initialize variables
         ## 'In'/'out' indicator
@@ -63,6 +82,8 @@ class InOut(QCAlgorithm):
         self.outday = 0  # dcount when self.be_in=0
         ## Flexi wait days
         self.WDadjvar = self.INI_WAIT_DAYS
+        ## Sizes all of a rebalance's orders against one portfolio snapshot, sells first
+        self.rebalancer = PortfolioRebalancer(self)
 
 
         self.Schedule.On(
@@ -78,25 +99,20 @@ class InOut(QCAlgorithm):
             self.rebalance_when_in_the_market
         )
 
+    @instrumented
     def rebalance_when_out_of_the_market(self):
-        # Returns sample to detect extreme observations
-        hist = self.History(
-            self.SIGNALS + [self.MRKT] + self.FORPAIRS, 252, Resolution.Daily)['close'].unstack(level=0).dropna()
-        hist_shift = hist.apply(lambda x: (x.shift(65) + x.shift(64) + x.shift(63) + x.shift(62) + x.shift(
-            61) + x.shift(60) + x.shift(59) + x.shift(58) + x.shift(57) + x.shift(56) + x.shift(55)) / 11)
-
-        returns_sample = (hist / hist_shift - 1)
-        # Reverse code USDX: sort largest changes to bottom
-        returns_sample[self.USDX] = returns_sample[self.USDX] * (-1)
-        # For pairs, take returns differential, reverse coded
-        returns_sample['G_S'] = -(returns_sample[self.GOLD] - returns_sample[self.SLVA])
-        returns_sample['U_I'] = -(returns_sample[self.UTIL] - returns_sample[self.INDU])
-        returns_sample['C_A'] = -(returns_sample[self.SHCU] - returns_sample[self.RICU])    
-        self.pairlist = ['G_S', 'U_I', 'C_A']
+        # Returns sample to detect extreme observations (the rows of the 252-day window with a full 55-65 day lag)
+        self.close_store.update()
+        # Only the last two rows are needed for the wait days; the percentiles are updated as rows are appended
+        returns = self.close_store.returns[-2:]
+        if len(returns) < 2:
+            # Not enough history yet; missing rows are NaN like the leading rows of the History-based sample were
+            returns = np.vstack((np.full((2 - len(returns), returns.shape[1]), np.nan), returns))
+        returns_sample = pd.DataFrame(returns, columns=self.close_store.symbols)
 
         # Extreme observations; statist. significance = 1%
-        pctl_b = np.nanpercentile(returns_sample, 1, axis=0)
-        extreme_b = returns_sample.iloc[-1] < pctl_b
+        pctl_b = np.array([percentile.value for percentile in self.signal_percentiles])
+        extreme_b = pd.Series(self.latest_signal_returns < pctl_b, index=self.SIGNALS + self.pairlist)
 
         # Determine waitdays empirically via safe haven excess returns, 50% decay
         self.WDadjvar = int(
@@ -134,17 +150,34 @@ class InOut(QCAlgorithm):
             wt[self.IEF] = .5
             
         # Thomas's reducing unnecessary trades
-        for sec, weight in wt.items():
-            cond1 = (self.Portfolio[sec].Quantity > 0) and (weight == 0)
-            cond2 = (self.Portfolio[sec].Quantity == 0) and (weight > 0)
-            if cond1 or cond2:
-                self.SetHoldings(sec, weight)
+        self.rebalancer.rebalance(self.position_changes(wt))
 
         self.Plot("In Out", "in_market", int(self.be_in))
         self.Plot("In Out", "num_out_signals", extreme_b[self.SIGNALS + self.pairlist].sum())
         self.Plot("Wait Days", "waitdays", adjwaitdays)
 
 
+    def position_changes(self, wt):
+        # Only open or close positions; weights of open positions are left to drift
+        targets = {}
+        for sec, weight in wt.items():
+            cond1 = (self.Portfolio[sec].Quantity > 0) and (weight == 0)
+            cond2 = (self.Portfolio[sec].Quantity == 0) and (weight > 0)
+            if cond1 or cond2:
+                targets[sec] = weight
+        return targets
+
+    @instrumented
+    def update_signal_percentiles(self, returns):
+        # Reverse code USDX: sort largest changes to bottom
+        signal_returns = returns[self.signal_columns] * self.signal_signs
+        # For pairs, take returns differential, reverse coded
+        pair_returns = [-(returns[a] - returns[b]) for a, b in self.pair_columns]
+        self.latest_signal_returns = np.concatenate((signal_returns, pair_returns))
+        for percentile, value in zip(self.signal_percentiles, self.latest_signal_returns):
+            percentile.update(value)
+
+    @instrumented
     def rebalance_when_in_the_market(self):
         # Swap to 'in' assets if applicable
         wt = self.wt
@@ -159,8 +192,129 @@ class InOut(QCAlgorithm):
             wt[self.IEF] = 0
         
         # Thomas's reducing unnecessary trades
-        for sec, weight in wt.items():
-            cond1 = (self.Portfolio[sec].Quantity > 0) and (weight == 0)
-            cond2 = (self.Portfolio[sec].Quantity == 0) and (weight > 0)
-            if cond1 or cond2:
-                self.SetHoldings(sec, weight)
+        self.rebalancer.rebalance(self.position_changes(wt))
+
+    def OnEndOfAlgorithm(self):
+        self.instrumentation.dump()
+
+
+class DailyCloseStore:
+    def __init__(self, algorithm, symbols, lookback=252, lag_start=55, lag_end=65, on_returns=None):
+        # Keeps the last `lookback` daily closes of every symbol (only dates on which all symbols have a bar, like the
+        # dropna of the History frame), a cumulative sum of them for the lagged average over the closes
+        # `lag_start`..`lag_end` rows back, and the return of every row against that average. Rows are appended to
+        # preallocated buffers that are compacted once they fill up, so a new day costs O(symbols).
+        self.algorithm = algorithm
+        self.symbols = list(symbols)
+        self.lookback = lookback
+        self.lag_start = lag_start
+        self.lag_end = lag_end
+        # Called with every new row of returns
+        self.on_returns = on_returns
+
+        capacity = 2 * lookback
+        self.closes = np.full((capacity, len(self.symbols)), np.nan)
+        # cumulative[i] is the sum of closes[:i]
+        self.cumulative = np.zeros((capacity + 1, len(self.symbols)))
+        self.row_returns = np.full((capacity, len(self.symbols)), np.nan)
+        self.count = 0
+        self.last_date = None
+
+        # Daily bars from the minute data only stage their close; `update` appends a row once every symbol has one.
+        # Rows of both paths are dated by the trading day a bar covers (see `trading_date`), so the first consolidated
+        # day follows the last History day whichever end-time convention the daily bars use.
+        self.staged_bars = {}
+        for symbol in self.symbols:
+            algorithm.Consolidate(symbol, Resolution.Daily, self.stage_bar)
+
+        history = algorithm.History(self.symbols, lookback, Resolution.Daily)
+        if not history.empty:
+            closes = history['close'].unstack(level=0).reindex(columns=self.symbols).dropna()
+            for time, row in zip(closes.index, closes.values):
+                self.append(self.trading_date(time), row)
+
+    @property
+    def returns(self):
+        # Returns of the rows in the lookback window that have a full lag (the rows the History-based sample had
+        # non-NaN values for), oldest first
+        start = max(self.count - self.lookback, 0) + self.lag_end
+        return self.row_returns[min(start, self.count):self.count]
+
+    @staticmethod
+    def trading_date(end_time):
+        # The day a daily bar covers, from its end time: 16:00 that day or midnight after it
+        return (end_time - timedelta(microseconds=1)).date()
+
+    @instrumented
+    def stage_bar(self, bar):
+        self.staged_bars[bar.Symbol] = (self.trading_date(bar.EndTime), bar.Close)
+
+    def update(self):
+        # Append the latest staged date once all symbols have a bar for it. Dates a symbol has no bar for are skipped.
+        if len(self.staged_bars) < len(self.symbols):
+            return
+        dates = {date for date, _ in self.staged_bars.values()}
+        if len(dates) != 1:
+            return
+        date = dates.pop()
+        # A day the History already seeded (or one appended before) is not appended again
+        if self.last_date is not None and date <= self.last_date:
+            return
+        self.append(date, np.array([self.staged_bars[symbol][1] for symbol in self.symbols]))
+
+    def append(self, date, closes):
+        if self.count == len(self.closes):
+            self.compact()
+        i = self.count
+        self.closes[i] = closes
+        self.cumulative[i + 1] = self.cumulative[i] + closes
+        if i >= self.lag_end:
+            lagged_average = (self.cumulative[i - self.lag_start + 1] - self.cumulative[i - self.lag_end]) / (self.lag_end - self.lag_start + 1)
+            self.row_returns[i] = closes / lagged_average - 1
+            if self.on_returns is not None:
+                self.on_returns(self.row_returns[i])
+        self.count += 1
+        self.last_date = date
+
+    def compact(self):
+        # Move the last `lookback` rows to the front and rebase the cumulative sum on them
+        keep = slice(self.count - self.lookback, self.count)
+        self.closes[:self.lookback] = self.closes[keep]
+        self.row_returns[:self.lookback] = self.row_returns[keep]
+        self.closes[self.lookback:] = np.nan
+        self.row_returns[self.lookback:] = np.nan
+        self.cumulative[1:self.lookback + 1] = np.cumsum(self.closes[:self.lookback], axis=0)
+        self.count = self.lookback
+
+
+class RollingPercentile:
+    def __init__(self, size, percentile):
+        # Percentile of the last `size` values, with linear interpolation and NaNs ignored like np.nanpercentile. The
+        # values are kept in arrival order for eviction and in a sorted list for the order statistics; an update is a
+        # binary search plus a list insert and delete.
+        self.size = size
+        self.fraction = percentile / 100
+        self.window = deque()
+        self.sorted_values = []
+
+    @property
+    def value(self):
+        n = len(self.sorted_values)
+        if n == 0:
+            return np.nan
+        position = (n - 1) * self.fraction
+        lower = int(position)
+        upper = min(lower + 1, n - 1)
+        a, b = self.sorted_values[lower], self.sorted_values[upper]
+        t = position - lower
+        # Same interpolation numpy uses, so the result matches np.nanpercentile exactly
+        return a + (b - a) * t if t < 0.5 else b - (b - a) * (1 - t)
+
+    def update(self, value):
+        self.window.append(value)
+        if not np.isnan(value):
+            insort(self.sorted_values, value)
+        if len(self.window) > self.size:
+            evicted = self.window.popleft()
+            if not np.isnan(evicted):
+                del self.sorted_values[bisect_left(self.sorted_values, evicted)]
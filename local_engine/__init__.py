@@ -0,0 +1,55 @@
+# Local offline runtime for the strategies in this repository
+#
+# The strategies only import AlgorithmImports, which exists inside the hosted LEAN engine. This package supplies the
+# part of that API they use (algorithm_imports.py) and a fast event loop over locally stored minute bars (engine.py),
+# so every strategy file runs unmodified on a laptop with no network, e.g. for profiling or benchmarks in CI.
+#
+# Example (one CSV of minute bars per ticker in ~/bars, see data.py for the layout, or a bar store, see bar_store.py):
+#   python -m local_engine futures-mean-reversion.py --data ~/bars --start 2021-01-04 --end 2021-03-31
+# or from Python:
+#   engine = local_engine.run('in-out-strategy.py', '~/bars', start=datetime(2021, 1, 4), quiet=True)
+#   engine.statistics(), engine.charts, engine.orders
+
+import importlib.util
+import os
+import re
+import sys
+from importlib.machinery import SourceFileLoader
+
+from local_engine import algorithm_imports
+from local_engine.bar_store import BarStore, is_bar_store
+from local_engine.data import CsvBarSource
+from local_engine.engine import Engine
+
+
+def install():
+    # Make `from AlgorithmImports import *` resolve to the local namespace
+    sys.modules.setdefault('AlgorithmImports', algorithm_imports)
+
+
+def load_algorithm(path):
+    # The QCAlgorithm subclass defined in a strategy file. The files have hyphenated names (and vix-hedging-3xetf no
+    # extension), so they are loaded by path; their directory goes on sys.path for the shared helper modules.
+    install()
+    path = os.path.abspath(os.path.expanduser(path))
+    directory = os.path.dirname(path)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(path))[0])
+    loader = SourceFileLoader(name, path)
+    module = sys.modules[name] = importlib.util.module_from_spec(importlib.util.spec_from_loader(name, loader))
+    loader.exec_module(module)
+    for value in vars(module).values():
+        if isinstance(value, type) and issubclass(value, algorithm_imports.QCAlgorithm) and value.__module__ == name:
+            return value
+    raise ValueError(f"{path} doesn't define a QCAlgorithm")
+
+
+def run(algorithm, data, start=None, end=None, cash=None, interest_rate=0.0, quiet=False, parameters=None):
+    # `algorithm` is a strategy file or a QCAlgorithm subclass, `data` a directory of CSV bars, a bar store directory
+    # or a bar source, and `parameters` a dict of the values GetParameter returns. Returns the engine after the run.
+    if isinstance(algorithm, str):
+        algorithm = load_algorithm(algorithm)
+    if isinstance(data, str):
+        data = BarStore(data) if is_bar_store(data) else CsvBarSource(os.path.expanduser(data))
+    return Engine(algorithm, data, start, end, cash, interest_rate, quiet, parameters).run()
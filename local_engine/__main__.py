@@ -0,0 +1,37 @@
+import argparse
+import csv
+import json
+from datetime import datetime
+
+import local_engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a strategy file offline over locally stored minute bars")
+    parser.add_argument('algorithm', help="Strategy file, e.g. futures-mean-reversion.py")
+    parser.add_argument('--data', required=True, help="Directory of CSV bars (see local_engine/data.py) or a bar store (see local_engine/bar_store.py)")
+    parser.add_argument('--start', type=datetime.fromisoformat, default=None, help="Overrides SetStartDate")
+    parser.add_argument('--end', type=datetime.fromisoformat, default=None, help="Overrides SetEndDate")
+    parser.add_argument('--cash', type=float, default=None, help="Overrides SetCash")
+    parser.add_argument('--interest-rate', type=float, default=0.0)
+    parser.add_argument('--plots', default=None, help="Write the Plot values to this CSV")
+    parser.add_argument('--quiet', action='store_true', help="Don't print Debug/Log messages")
+    parser.add_argument('--parameter', action='append', default=[], metavar='NAME=VALUE',
+                        help="Value GetParameter returns for NAME, e.g. instrumentation=on; repeatable")
+    args = parser.parse_args()
+
+    parameters = dict(parameter.split('=', 1) for parameter in args.parameter)
+    engine = local_engine.run(args.algorithm, args.data, args.start, args.end, args.cash, args.interest_rate, args.quiet,
+                              parameters)
+    if args.plots:
+        with open(args.plots, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['chart', 'series', 'time', 'value'])
+            for chart, series_values in engine.charts.items():
+                for series, values in series_values.items():
+                    writer.writerows((chart, series, time, value) for time, value in values)
+    print(json.dumps(engine.statistics(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
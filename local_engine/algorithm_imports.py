@@ -0,0 +1,1541 @@
+# The AlgorithmImports namespace of the local engine
+#
+# Strategies do `from AlgorithmImports import *`; `local_engine.install()` registers this module under that name so the
+# strategy files run unmodified. Only the part of the LEAN API the strategies in this repository use is provided, with
+# LEAN's names and its semantics where they change results: indicator recursions, consolidated bar times, fill prices
+# and order event statuses. Everything that needs the event loop (orders, history, subscriptions, scheduling) is
+# forwarded to the engine the algorithm is attached to.
+
+import math
+from collections import deque
+from datetime import date, datetime, time, timedelta
+from enum import IntEnum
+
+import numpy as np
+import pandas as pd
+
+from local_engine.data import market_close, market_open
+
+__all__ = [
+    'date', 'datetime', 'time', 'timedelta', 'math', 'np', 'pd',
+    'Resolution', 'SecurityType', 'OrderStatus', 'OrderDirection', 'OrderType', 'OrderField', 'OptionRight',
+    'DataMappingMode', 'DataNormalizationMode', 'Market', 'Futures',
+    'SecurityIdentifier', 'Symbol', 'Bar', 'TradeBar', 'QuoteBar', 'IndicatorDataPoint', 'KeyValuePair',
+    'DataDictionary', 'TradeBars', 'QuoteBars', 'SymbolChangedEvent', 'SymbolChangedEvents', 'OptionChains', 'Slice',
+    'RollingWindow', 'TradeBarConsolidator', 'IdentityDataConsolidator', 'SubscriptionManager',
+    'IndicatorBase', 'ExponentialMovingAverage', 'SimpleMovingAverage', 'StandardDeviation', 'BollingerBands',
+    'LogReturn', 'IndicatorExtensions',
+    'CashAmount', 'OrderFee', 'OrderFeeParameters', 'FeeModel', 'ConstantFeeModel', 'Order', 'OrderEvent',
+    'OrderResponse', 'OrderTicket',
+    'SymbolProperties', 'BuyingPowerModel', 'FutureMarginModel', 'SecurityHolding', 'Security', 'Equity', 'Index',
+    'Future', 'Option', 'SecurityManager', 'SecurityPortfolioManager',
+    'OptionContract', 'OptionChain', 'OptionChainProvider',
+    'Universe', 'CoarseFundamental', 'FineFundamental', 'SecurityChanges', 'UniverseSettings',
+    'FuncSecuritySeeder', 'BrokerageModelSecurityInitializer', 'DefaultBrokerageModel',
+    'ConstantRiskFreeRateInterestRateModel', 'AlgorithmSettings',
+    'DateRules', 'TimeRules', 'ScheduleManager', 'QCAlgorithm'
+]
+
+
+class Resolution(IntEnum):
+    Tick = 0
+    Second = 1
+    Minute = 2
+    Hour = 3
+    Daily = 4
+
+
+RESOLUTION_PERIODS = {
+    Resolution.Second: timedelta(seconds=1),
+    Resolution.Minute: timedelta(minutes=1),
+    Resolution.Hour: timedelta(hours=1),
+    Resolution.Daily: timedelta(days=1)
+}
+
+
+class SecurityType(IntEnum):
+    Base = 0
+    Equity = 1
+    Option = 2
+    Commodity = 3
+    Forex = 4
+    Future = 5
+    Cfd = 6
+    Crypto = 7
+    FutureOption = 8
+    Index = 9
+    IndexOption = 10
+
+
+class OrderStatus(IntEnum):
+    New = 0
+    Submitted = 1
+    PartiallyFilled = 2
+    Filled = 3
+    Canceled = 5
+    Invalid = 7
+    CancelPending = 8
+    UpdateSubmitted = 9
+
+
+class OrderDirection(IntEnum):
+    Buy = 0
+    Sell = 1
+    Hold = 2
+
+
+class OrderType(IntEnum):
+    Market = 0
+    Limit = 1
+    StopMarket = 2
+    StopLimit = 3
+    MarketOnOpen = 4
+    MarketOnClose = 5
+    OptionExercise = 6
+
+
+class OrderField(IntEnum):
+    LimitPrice = 0
+    StopPrice = 1
+
+
+class OptionRight(IntEnum):
+    Call = 0
+    Put = 1
+
+
+class DataMappingMode(IntEnum):
+    LastTradingDay = 0
+    FirstDayMonth = 1
+    OpenInterest = 2
+    OpenInterestAnnual = 3
+
+
+class DataNormalizationMode(IntEnum):
+    Raw = 0
+    Adjusted = 1
+    SplitAdjusted = 2
+    TotalReturn = 3
+    ForwardPanamaCanal = 4
+    BackwardsPanamaCanal = 5
+    BackwardsRatio = 6
+    ScaledRaw = 7
+
+
+class Market:
+    USA = 'usa'
+    CME = 'cme'
+    CBOT = 'cbot'
+    CBOE = 'cboe'
+
+
+class Futures:
+    class Indices:
+        SP500EMini = 'ES'
+        Dow30EMini = 'YM'
+        NASDAQ100EMini = 'NQ'
+        Russell2000EMini = 'RTY'
+        VIX = 'VX'
+
+
+# (contract multiplier, minimum price variation, initial intraday margin) of the futures the strategies trade
+FUTURES_PROPERTIES = {
+    'ES': (50, 0.25, 12650),
+    'YM': (5, 1, 9350),
+    'NQ': (20, 0.25, 17600),
+    'RTY': (50, 0.1, 6600),
+    'VX': (1000, 0.05, 16500)
+}
+
+
+# region Symbols and data
+
+class SecurityIdentifier:
+    def __init__(self, date=None, option_right=None, strike_price=None):
+        self.Date = date
+        self.OptionRight = option_right
+        self.StrikePrice = strike_price
+
+
+class Symbol:
+    def __init__(self, value, security_type, underlying=None, canonical=None, expiry=None, right=None, strike=None):
+        # Symbols are equal when their type and value are; they also equal (and hash like) their value string, so
+        # ticker strings index the same dictionaries
+        self.Value = value
+        self.SecurityType = security_type
+        self.Underlying = underlying
+        self.HasUnderlying = underlying is not None
+        self.Canonical = self if canonical is None else canonical
+        self.ID = SecurityIdentifier(expiry, right, strike)
+        self.key = (int(security_type), value)
+
+    @property
+    def IsCanonical(self):
+        return self.Canonical is self
+
+    def __eq__(self, other):
+        if isinstance(other, Symbol):
+            return self.key == other.key
+        if isinstance(other, str):
+            return self.Value == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.Value)
+
+    def __lt__(self, other):
+        # Symbols are ordered like LEAN orders them (by their identifier), so pandas can sort indexes of them
+        return self.key < (other.key if isinstance(other, Symbol) else (self.key[0], other))
+
+    def __str__(self):
+        return self.Value
+
+    def __repr__(self):
+        return self.Value
+
+    @staticmethod
+    def Create(ticker, security_type, market=None):
+        return Symbol(ticker, security_type)
+
+    @staticmethod
+    def CreateOption(underlying, market, style, right, strike, expiry):
+        security_type = SecurityType.IndexOption if underlying.SecurityType == SecurityType.Index else SecurityType.Option
+        value = f"{underlying.Value:<6}{expiry:%y%m%d}{'C' if right == OptionRight.Call else 'P'}{int(round(strike * 1000)):08d}"
+        return Symbol(value, security_type, underlying=underlying, expiry=expiry, right=right, strike=strike)
+
+
+class Bar:
+    __slots__ = ('Open', 'High', 'Low', 'Close')
+
+    def __init__(self, open, high, low, close):
+        self.Open = open
+        self.High = high
+        self.Low = low
+        self.Close = close
+
+
+class TradeBar:
+    __slots__ = ('Symbol', 'Time', 'EndTime', 'Period', 'Open', 'High', 'Low', 'Close', 'Volume')
+
+    def __init__(self, time=None, symbol=None, open=0.0, high=0.0, low=0.0, close=0.0, volume=0.0, period=timedelta(minutes=1)):
+        self.Symbol = symbol
+        self.Time = time
+        self.Period = period
+        self.EndTime = None if time is None else time + period
+        self.Open = open
+        self.High = high
+        self.Low = low
+        self.Close = close
+        self.Volume = volume
+
+    @property
+    def Value(self):
+        return self.Close
+
+    @property
+    def Price(self):
+        return self.Close
+
+    def __repr__(self):
+        return f"{self.Symbol}: O: {self.Open} H: {self.High} L: {self.Low} C: {self.Close} V: {self.Volume}"
+
+
+class QuoteBar:
+    __slots__ = ('Symbol', 'Time', 'EndTime', 'Period', 'Bid', 'Ask')
+
+    def __init__(self, time=None, symbol=None, bid=None, ask=None, period=timedelta(minutes=1)):
+        self.Symbol = symbol
+        self.Time = time
+        self.Period = period
+        self.EndTime = None if time is None else time + period
+        self.Bid = bid
+        self.Ask = ask
+
+    @property
+    def Close(self):
+        if self.Bid is not None and self.Ask is not None:
+            return (self.Bid.Close + self.Ask.Close) / 2
+        return (self.Bid or self.Ask).Close
+
+    @property
+    def Value(self):
+        return self.Close
+
+    @property
+    def Price(self):
+        return self.Close
+
+
+class IndicatorDataPoint:
+    __slots__ = ('Time', 'EndTime', 'Value')
+
+    def __init__(self, time=None, value=0.0):
+        self.Time = time
+        self.EndTime = time
+        self.Value = value
+
+    def __float__(self):
+        return float(self.Value)
+
+    def __repr__(self):
+        return f"{self.Time}: {self.Value}"
+
+
+class KeyValuePair:
+    __slots__ = ('Key', 'Value')
+
+    def __init__(self, key, value):
+        self.Key = key
+        self.Value = value
+
+
+class DataDictionary(dict):
+    @property
+    def Count(self):
+        return len(self)
+
+    @property
+    def Keys(self):
+        return list(self.keys())
+
+    @property
+    def Values(self):
+        return list(self.values())
+
+    def ContainsKey(self, key):
+        return key in self
+
+
+class TradeBars(DataDictionary):
+    pass
+
+
+class QuoteBars(DataDictionary):
+    pass
+
+
+class SymbolChangedEvent:
+    def __init__(self, symbol, old_symbol, new_symbol):
+        self.Symbol = symbol
+        self.OldSymbol = old_symbol
+        self.NewSymbol = new_symbol
+
+
+class SymbolChangedEvents(DataDictionary):
+    pass
+
+
+class OptionChains(DataDictionary):
+    def __iter__(self):
+        # Like the C# dictionary, iterating yields key/value pairs
+        return (KeyValuePair(key, value) for key, value in self.items())
+
+
+class Slice:
+    def __init__(self, time):
+        self.Time = time
+        self.Bars = TradeBars()
+        self.QuoteBars = QuoteBars()
+        self.SymbolChangedEvents = SymbolChangedEvents()
+        self.OptionChains = OptionChains()
+
+    @property
+    def HasData(self):
+        return bool(self.Bars or self.QuoteBars)
+
+    @property
+    def Keys(self):
+        return list(self.Bars.keys() | self.QuoteBars.keys())
+
+    def __contains__(self, symbol):
+        return symbol in self.Bars or symbol in self.QuoteBars
+
+    def ContainsKey(self, symbol):
+        return symbol in self
+
+    def __getitem__(self, symbol):
+        bar = self.Bars.get(symbol)
+        if bar is None:
+            bar = self.QuoteBars[symbol]
+        return bar
+
+    def get(self, symbol, default=None):
+        return self[symbol] if symbol in self else default
+
+# endregion
+
+
+# region Windows, consolidators and indicators
+
+class _Event:
+    # A C# event: handlers are attached with += and called in order
+    def __init__(self):
+        self.handlers = []
+
+    def __iadd__(self, handler):
+        self.handlers.append(handler)
+        return self
+
+    def __isub__(self, handler):
+        self.handlers.remove(handler)
+        return self
+
+    def __call__(self, *args):
+        for handler in self.handlers:
+            handler(*args)
+
+
+class RollingWindow:
+    def __class_getitem__(cls, item):
+        # RollingWindow[float](3)
+        return cls
+
+    def __init__(self, size):
+        # Index 0 is the most recent item
+        self.Size = size
+        self.items = deque(maxlen=size)
+        self.Samples = 0
+
+    def Add(self, item):
+        self.items.appendleft(item)
+        self.Samples += 1
+
+    @property
+    def Count(self):
+        return len(self.items)
+
+    @property
+    def IsReady(self):
+        return len(self.items) == self.Size
+
+    def Reset(self):
+        self.items.clear()
+        self.Samples = 0
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def round_down(value, period):
+    # Floor of a datetime to a multiple of `period` counted from midnight
+    midnight = datetime.combine(value.date(), time())
+    return value - (value - midnight) % period
+
+
+class TradeBarConsolidator:
+    def __init__(self, period):
+        # `period` is a timedelta (bars aligned to multiples of it from midnight), a Resolution or a bar count
+        if isinstance(period, Resolution):
+            period = RESOLUTION_PERIODS[period]
+        self.period = period if isinstance(period, timedelta) else None
+        self.max_count = None if isinstance(period, timedelta) else int(period)
+        self.count = 0
+        self.WorkingBar = None
+        self.Consolidated = None
+        self.DataConsolidated = _Event()
+
+    def Update(self, bar):
+        working = self.WorkingBar
+        if self.period is not None and working is not None and bar.Time >= working.EndTime:
+            self.emit()
+            working = None
+        if working is None:
+            start = bar.Time if self.period is None else round_down(bar.Time, self.period)
+            working = self.WorkingBar = TradeBar(start, bar.Symbol, bar.Open, bar.High, bar.Low, bar.Close, bar.Volume,
+                                                 self.period or bar.Period)
+        else:
+            working.High = max(working.High, bar.High)
+            working.Low = min(working.Low, bar.Low)
+            working.Close = bar.Close
+            working.Volume += bar.Volume
+            if self.period is None:
+                working.EndTime = bar.EndTime
+                working.Period = working.EndTime - working.Time
+        if self.max_count is not None:
+            self.count += 1
+            if self.count == self.max_count:
+                self.emit()
+
+    def Scan(self, current_time):
+        # Emit the working bar once its period is over, even if no later bar has arrived
+        if self.period is not None and self.WorkingBar is not None and self.WorkingBar.EndTime <= current_time:
+            self.emit()
+
+    def emit(self):
+        bar, self.WorkingBar = self.WorkingBar, None
+        self.count = 0
+        self.Consolidated = bar
+        self.DataConsolidated(self, bar)
+
+
+class IdentityDataConsolidator:
+    # Passes every bar through; the consolidator of a subscription's own resolution
+    def __init__(self):
+        self.Consolidated = None
+        self.DataConsolidated = _Event()
+
+    def Update(self, bar):
+        self.Consolidated = bar
+        self.DataConsolidated(self, bar)
+
+    def Scan(self, current_time):
+        pass
+
+
+class SubscriptionManager:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def AddConsolidator(self, symbol, consolidator):
+        self.engine.add_consolidator(symbol, consolidator)
+
+    def RemoveConsolidator(self, symbol, consolidator):
+        self.engine.remove_consolidator(symbol, consolidator)
+
+
+class IndicatorBase:
+    def __init__(self, name, warm_up_period):
+        self.Name = name
+        self.WarmUpPeriod = warm_up_period
+        self.Samples = 0
+        self.Current = IndicatorDataPoint(None, 0.0)
+        self.Updated = _Event()
+
+    @property
+    def IsReady(self):
+        return self.Samples >= self.WarmUpPeriod
+
+    def Update(self, *args):
+        # Update(time, value), Update(IndicatorDataPoint) or Update(bar)
+        if len(args) == 2:
+            time, value = args
+        else:
+            time, value = args[0].EndTime, args[0].Value
+        self.Samples += 1
+        self.Current = IndicatorDataPoint(time, float(self.compute(float(value))))
+        self.Updated(self, self.Current)
+        return self.IsReady
+
+    def compute(self, value):
+        raise NotImplementedError
+
+    def Reset(self):
+        self.Samples = 0
+        self.Current = IndicatorDataPoint(None, 0.0)
+
+    def __float__(self):
+        return float(self.Current.Value)
+
+
+def _name_and_period(args, default_name):
+    # Indicators take (period, ...) or (name, period, ...)
+    if isinstance(args[0], str):
+        return args[0], args[1:]
+    return f"{default_name}({args[0]})", args
+
+
+class _Window:
+    # The last `size` values of the moving average and standard deviation indicators
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+
+    def add(self, value):
+        self.values.append(value)
+
+    def mean(self):
+        return sum(self.values) / len(self.values)
+
+    def std(self):
+        # Population standard deviation, like LEAN's StandardDeviation
+        mean = self.mean()
+        return math.sqrt(sum((value - mean) ** 2 for value in self.values) / len(self.values))
+
+
+class ExponentialMovingAverage(IndicatorBase):
+    def __init__(self, *args):
+        name, (period, *_) = _name_and_period(args, 'EMA')
+        super().__init__(name, period)
+        self.k = 2 / (period + 1)
+
+    def compute(self, value):
+        # The first sample seeds the average
+        if self.Samples == 1:
+            return value
+        return value * self.k + self.Current.Value * (1 - self.k)
+
+
+class SimpleMovingAverage(IndicatorBase):
+    def __init__(self, *args):
+        name, (period, *_) = _name_and_period(args, 'SMA')
+        super().__init__(name, period)
+        self.window = _Window(period)
+
+    def compute(self, value):
+        self.window.add(value)
+        return self.window.mean()
+
+
+class StandardDeviation(IndicatorBase):
+    def __init__(self, *args):
+        name, (period, *_) = _name_and_period(args, 'STD')
+        super().__init__(name, period)
+        self.window = _Window(period)
+
+    def compute(self, value):
+        self.window.add(value)
+        return self.window.std()
+
+
+class _Band(IndicatorBase):
+    # One output of a composite indicator, set by its owner
+    def set(self, time, value):
+        self.Samples += 1
+        self.Current = IndicatorDataPoint(time, value)
+
+
+class BollingerBands(IndicatorBase):
+    def __init__(self, *args):
+        name, (period, k, *_) = _name_and_period(args, 'BB')
+        super().__init__(name, period)
+        self.k = k
+        self.window = _Window(period)
+        self.MiddleBand = _Band(f"{name}_MiddleBand", period)
+        self.UpperBand = _Band(f"{name}_UpperBand", period)
+        self.LowerBand = _Band(f"{name}_LowerBand", period)
+        self.StandardDeviation = _Band(f"{name}_StandardDeviation", period)
+
+    def Update(self, *args):
+        time = args[0] if len(args) == 2 else args[0].EndTime
+        self.pending_time = time
+        return super().Update(*args)
+
+    def compute(self, value):
+        self.window.add(value)
+        middle = self.window.mean()
+        std = self.window.std()
+        time = self.pending_time
+        self.StandardDeviation.set(time, std)
+        self.MiddleBand.set(time, middle)
+        self.UpperBand.set(time, middle + self.k * std)
+        self.LowerBand.set(time, middle - self.k * std)
+        return middle
+
+
+class LogReturn(IndicatorBase):
+    def __init__(self, *args):
+        name, (period, *_) = _name_and_period(args, 'LOGR')
+        super().__init__(name, period + 1)
+        self.window = deque(maxlen=period + 1)
+
+    def compute(self, value):
+        self.window.append(value)
+        return math.log(value / self.window[0]) if self.window[0] > 0 else 0.0
+
+
+class IndicatorExtensions:
+    @staticmethod
+    def Of(second, first, waitForFirstToReady=True):
+        # `second` is updated with every output of `first`
+        def update(sender, point):
+            if first.IsReady or not waitForFirstToReady:
+                second.Update(point.EndTime, point.Value)
+
+        first.Updated += update
+        return second
+
+# endregion
+
+
+# region Orders
+
+class CashAmount:
+    def __init__(self, amount, currency='USD'):
+        self.Amount = amount
+        self.Currency = currency
+
+
+class OrderFee:
+    def __init__(self, value):
+        self.Value = value
+
+    Zero = None
+
+
+OrderFee.Zero = OrderFee(CashAmount(0.0))
+
+
+class OrderFeeParameters:
+    def __init__(self, security, order):
+        self.Security = security
+        self.Order = order
+
+
+class FeeModel:
+    def GetOrderFee(self, parameters):
+        return OrderFee.Zero
+
+
+class ConstantFeeModel(FeeModel):
+    def __init__(self, fee, currency='USD'):
+        self.fee = fee
+        self.currency = currency
+
+    def GetOrderFee(self, parameters):
+        return OrderFee(CashAmount(self.fee, self.currency))
+
+
+class Order:
+    def __init__(self, id, symbol, quantity, type, time, tag='', stop_price=None, limit_price=None):
+        self.Id = id
+        self.Symbol = symbol
+        self.Quantity = quantity
+        self.Type = type
+        self.Time = time
+        self.Tag = tag
+        self.StopPrice = stop_price
+        self.LimitPrice = limit_price
+        self.Status = OrderStatus.New
+        self.Price = 0.0
+        self.QuantityFilled = 0
+
+    @property
+    def AbsoluteQuantity(self):
+        return abs(self.Quantity)
+
+    @property
+    def Direction(self):
+        return OrderDirection.Buy if self.Quantity > 0 else OrderDirection.Sell
+
+
+class OrderEvent:
+    def __init__(self, order, time, status, fill_price=0.0, fill_quantity=0, fee=None, message=''):
+        self.OrderId = order.Id
+        self.Symbol = order.Symbol
+        self.Status = status
+        self.Direction = order.Direction
+        self.Quantity = order.Quantity
+        self.FillPrice = fill_price
+        self.FillQuantity = fill_quantity
+        self.OrderFee = OrderFee.Zero if fee is None else fee
+        self.UtcTime = time
+        self.Message = message
+        self.IsAssignment = False
+
+    @property
+    def AbsoluteFillQuantity(self):
+        return abs(self.FillQuantity)
+
+    def __repr__(self):
+        return f"{self.UtcTime} OrderID: {self.OrderId} {self.Symbol} Status: {self.Status.name} Quantity: {self.FillQuantity} FillPrice: {self.FillPrice}"
+
+
+class OrderResponse:
+    def __init__(self, order_id, is_success, message=''):
+        self.OrderId = order_id
+        self.IsSuccess = is_success
+        self.IsError = not is_success
+        self.ErrorMessage = message
+
+
+class OrderTicket:
+    def __init__(self, engine, order):
+        self.engine = engine
+        self.order = order
+
+    @property
+    def OrderId(self):
+        return self.order.Id
+
+    @property
+    def Symbol(self):
+        return self.order.Symbol
+
+    @property
+    def Quantity(self):
+        return self.order.Quantity
+
+    @property
+    def OrderType(self):
+        return self.order.Type
+
+    @property
+    def Status(self):
+        return self.order.Status
+
+    @property
+    def Tag(self):
+        return self.order.Tag
+
+    @property
+    def Time(self):
+        return self.order.Time
+
+    @property
+    def QuantityFilled(self):
+        return self.order.QuantityFilled
+
+    @property
+    def AverageFillPrice(self):
+        return self.order.Price
+
+    def Get(self, field):
+        return self.order.StopPrice if field == OrderField.StopPrice else self.order.LimitPrice
+
+    def UpdateStopPrice(self, stop_price, tag=None):
+        return self.engine.update_order(self.order, stop_price=stop_price, tag=tag)
+
+    def UpdateLimitPrice(self, limit_price, tag=None):
+        return self.engine.update_order(self.order, limit_price=limit_price, tag=tag)
+
+    def Cancel(self, tag=None):
+        return self.engine.cancel_order(self.order, tag)
+
+# endregion
+
+
+# region Securities and portfolio
+
+class SymbolProperties:
+    def __init__(self, description='', quote_currency='USD', contract_multiplier=1, minimum_price_variation=0.01, lot_size=1):
+        # LEAN's decimals reach Python as floats, so a whole tick size still prints as "1.0"
+        self.Description = description
+        self.QuoteCurrency = quote_currency
+        self.ContractMultiplier = contract_multiplier
+        self.MinimumPriceVariation = float(minimum_price_variation)
+        self.LotSize = lot_size
+
+
+class BuyingPowerModel:
+    def __init__(self, leverage=1):
+        self.leverage = leverage
+
+    def GetLeverage(self, security=None):
+        return self.leverage
+
+    def SetLeverage(self, security, leverage):
+        self.leverage = leverage
+
+    def unit_margin(self, security):
+        # Initial margin of one unit of `security`
+        return security.Price * security.SymbolProperties.ContractMultiplier / self.leverage
+
+
+class FutureMarginModel(BuyingPowerModel):
+    def __init__(self, initial_margin):
+        super().__init__(1)
+        self.InitialIntradayMarginRequirement = initial_margin
+        self.InitialOvernightMarginRequirement = initial_margin
+
+    def unit_margin(self, security):
+        return self.InitialIntradayMarginRequirement
+
+
+class SecurityHolding:
+    def __init__(self, security):
+        self.security = security
+        self.Quantity = 0
+        self.AveragePrice = 0.0
+        self.TotalFees = 0.0
+
+    @property
+    def Symbol(self):
+        return self.security.Symbol
+
+    @property
+    def Invested(self):
+        return self.Quantity != 0
+
+    @property
+    def AbsoluteQuantity(self):
+        return abs(self.Quantity)
+
+    @property
+    def IsLong(self):
+        return self.Quantity > 0
+
+    @property
+    def IsShort(self):
+        return self.Quantity < 0
+
+    @property
+    def HoldingsValue(self):
+        return self.Quantity * self.security.Price * self.security.SymbolProperties.ContractMultiplier
+
+    @property
+    def AbsoluteHoldingsValue(self):
+        return abs(self.HoldingsValue)
+
+    @property
+    def HoldingsCost(self):
+        return self.Quantity * self.AveragePrice * self.security.SymbolProperties.ContractMultiplier
+
+    @property
+    def UnrealizedProfit(self):
+        return self.HoldingsValue - self.HoldingsCost
+
+    def fill(self, quantity, price):
+        # Average price of the position after a fill; it resets when the position closes or flips
+        new_quantity = self.Quantity + quantity
+        if new_quantity == 0:
+            self.AveragePrice = 0.0
+        elif self.Quantity == 0 or (self.Quantity > 0) != (new_quantity > 0):
+            self.AveragePrice = price
+        elif abs(new_quantity) > abs(self.Quantity):
+            self.AveragePrice = (self.AveragePrice * self.Quantity + price * quantity) / new_quantity
+        self.Quantity = new_quantity
+
+
+class Security:
+    def __init__(self, symbol, symbol_properties, resolution, buying_power_model):
+        self.Symbol = symbol
+        self.Type = symbol.SecurityType
+        self.Resolution = resolution
+        self.SymbolProperties = symbol_properties
+        self.BuyingPowerModel = buying_power_model
+        self.FeeModel = FeeModel()
+        self.Holdings = SecurityHolding(self)
+        self.DataNormalizationMode = DataNormalizationMode.Adjusted
+        self.Open = self.High = self.Low = self.Close = self.Price = 0.0
+        self.Volume = 0.0
+        self.BidPrice = self.AskPrice = 0.0
+        self.HasData = False
+        self.IsTradable = True
+        self.LocalTime = None
+        self.last_bar = None
+        # The engine's feed of a security whose prices are only brought up to date when they're read
+        self.lazy_feed = None
+
+    @property
+    def MarginModel(self):
+        return self.BuyingPowerModel
+
+    @MarginModel.setter
+    def MarginModel(self, model):
+        self.BuyingPowerModel = model
+
+    @property
+    def Leverage(self):
+        return self.BuyingPowerModel.GetLeverage(self)
+
+    @property
+    def Invested(self):
+        return self.Holdings.Invested
+
+    def SetLeverage(self, leverage):
+        self.BuyingPowerModel.SetLeverage(self, leverage)
+
+    def SetFeeModel(self, fee_model):
+        self.FeeModel = fee_model
+
+    def SetBuyingPowerModel(self, model):
+        self.BuyingPowerModel = model
+
+    def SetMarginModel(self, model):
+        self.BuyingPowerModel = model
+
+    def SetDataNormalizationMode(self, mode):
+        self.DataNormalizationMode = mode
+
+    def SetMarketPrice(self, bar):
+        if isinstance(bar, QuoteBar):
+            self.update_prices(None, bar)
+        else:
+            self.update_prices(bar, None)
+
+    def refresh(self):
+        if self.lazy_feed is not None:
+            self.lazy_feed.catch_up()
+
+    def update_prices(self, trade_bar, quote_bar):
+        if trade_bar is not None:
+            self.Open, self.High, self.Low = trade_bar.Open, trade_bar.High, trade_bar.Low
+            self.Close = self.Price = trade_bar.Close
+            self.Volume = trade_bar.Volume
+            self.last_bar = trade_bar
+        if quote_bar is not None:
+            self.BidPrice = quote_bar.Bid.Close
+            self.AskPrice = quote_bar.Ask.Close
+            if trade_bar is None:
+                self.Close = self.Price = quote_bar.Close
+        self.HasData = True
+
+    def __repr__(self):
+        return str(self.Symbol)
+
+
+class Equity(Security):
+    pass
+
+
+class Index(Security):
+    pass
+
+
+class Future(Security):
+    def __init__(self, symbol, symbol_properties, resolution, buying_power_model):
+        super().__init__(symbol, symbol_properties, resolution, buying_power_model)
+        self.Mapped = None
+        self.filter = None
+
+    def SetFilter(self, *args):
+        # Contract selection is not simulated; the mapped contract comes from the data
+        self.filter = args
+
+
+class Option(Security):
+    def __init__(self, symbol, symbol_properties, resolution, buying_power_model):
+        super().__init__(symbol, symbol_properties, resolution, buying_power_model)
+        self.filter = (-10, 10, timedelta(0), timedelta(35))
+
+    def SetFilter(self, min_strike=-10, max_strike=10, min_expiry=0, max_expiry=35):
+        # Strike ranks around the ATM strike, and days (or timedeltas) to expiry
+        as_timedelta = lambda value: value if isinstance(value, timedelta) else timedelta(days=value)
+        self.filter = (min_strike, max_strike, as_timedelta(min_expiry), as_timedelta(max_expiry))
+
+    @property
+    def Underlying(self):
+        return self.Symbol.Underlying
+
+    @property
+    def Expiry(self):
+        return self.Symbol.ID.Date
+
+    @property
+    def StrikePrice(self):
+        return self.Symbol.ID.StrikePrice
+
+    @property
+    def Right(self):
+        return self.Symbol.ID.OptionRight
+
+
+class SecurityManager(DataDictionary):
+    # Securities by symbol; ticker strings find the security of the symbol with that value. A security that's fed
+    # lazily (an option chain contract) is brought up to date when it's looked up.
+    def __getitem__(self, symbol):
+        security = dict.__getitem__(self, symbol)
+        if security.lazy_feed is not None:
+            security.lazy_feed.catch_up()
+        return security
+
+
+class SecurityPortfolioManager:
+    def __init__(self, securities):
+        self.securities = securities
+        self.Cash = 0.0
+        self.TotalFeesPaid = 0.0
+        # Securities with a position, so the totals don't walk the whole universe
+        self.held = {}
+
+    def __getitem__(self, symbol):
+        return self.securities[symbol].Holdings
+
+    def __contains__(self, symbol):
+        return symbol in self.securities
+
+    def __iter__(self):
+        return (KeyValuePair(symbol, security.Holdings) for symbol, security in self.securities.items())
+
+    def __len__(self):
+        return len(self.securities)
+
+    @property
+    def Keys(self):
+        return list(self.securities.keys())
+
+    @property
+    def Values(self):
+        return [security.Holdings for security in self.securities.values()]
+
+    @property
+    def Invested(self):
+        return bool(self.held)
+
+    @property
+    def TotalHoldingsValue(self):
+        return sum(security.Holdings.HoldingsValue for security in self.held.values())
+
+    @property
+    def TotalAbsoluteHoldingsCost(self):
+        return sum(abs(security.Holdings.HoldingsCost) for security in self.held.values())
+
+    @property
+    def TotalUnrealizedProfit(self):
+        return sum(security.Holdings.UnrealizedProfit for security in self.held.values())
+
+    @property
+    def TotalPortfolioValue(self):
+        return self.Cash + self.TotalHoldingsValue
+
+    @property
+    def TotalMarginUsed(self):
+        return sum(abs(security.Holdings.Quantity) * security.BuyingPowerModel.unit_margin(security)
+                   for security in self.held.values())
+
+    @property
+    def MarginRemaining(self):
+        return self.TotalPortfolioValue - self.TotalMarginUsed
+
+    def SetCash(self, cash):
+        self.Cash = float(cash)
+
+    def update_held(self, security):
+        if security.Holdings.Quantity:
+            self.held[security.Symbol] = security
+        else:
+            self.held.pop(security.Symbol, None)
+
+# endregion
+
+
+# region Options, universes and models
+
+class OptionContract:
+    def __init__(self, symbol, security, underlying_security):
+        self.Symbol = symbol
+        self.UnderlyingSymbol = symbol.Underlying
+        self.Expiry = symbol.ID.Date
+        self.Strike = symbol.ID.StrikePrice
+        self.Right = symbol.ID.OptionRight
+        self.security = security
+        self.underlying_security = underlying_security
+
+    @property
+    def BidPrice(self):
+        self.security.refresh()
+        return self.security.BidPrice
+
+    @property
+    def AskPrice(self):
+        self.security.refresh()
+        return self.security.AskPrice
+
+    @property
+    def LastPrice(self):
+        self.security.refresh()
+        return self.security.Price
+
+    @property
+    def UnderlyingLastPrice(self):
+        return self.underlying_security.Price
+
+    def __repr__(self):
+        return str(self.Symbol)
+
+
+class OptionChain:
+    def __init__(self, symbol, underlying, contracts):
+        self.Symbol = symbol
+        self.Underlying = underlying
+        self.Contracts = DataDictionary((contract.Symbol, contract) for contract in contracts)
+
+    def __iter__(self):
+        return iter(self.Contracts.values())
+
+    def __len__(self):
+        return len(self.Contracts)
+
+
+class OptionChainProvider:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def GetOptionContractList(self, symbol, date):
+        return self.engine.option_contract_list(symbol, date)
+
+
+class _UnchangedUniverse:
+    def __repr__(self):
+        return 'Universe.Unchanged'
+
+
+class Universe:
+    Unchanged = _UnchangedUniverse()
+
+
+class CoarseFundamental:
+    def __init__(self, symbol, price, dollar_volume, has_fundamental_data=True, market=Market.USA):
+        self.Symbol = symbol
+        self.Price = price
+        self.Value = price
+        self.DollarVolume = dollar_volume
+        self.Volume = dollar_volume / price if price else 0
+        self.HasFundamentalData = has_fundamental_data
+        self.Market = market
+
+
+class FineFundamental:
+    def __init__(self, symbol, price, market_cap):
+        self.Symbol = symbol
+        self.Price = price
+        self.MarketCap = market_cap
+
+
+class SecurityChanges:
+    def __init__(self, added, removed):
+        self.AddedSecurities = added
+        self.RemovedSecurities = removed
+
+    def __repr__(self):
+        return f"Added: {self.AddedSecurities} Removed: {self.RemovedSecurities}"
+
+
+class UniverseSettings:
+    def __init__(self):
+        self.Resolution = Resolution.Minute
+        self.Leverage = None
+        self.FillForward = True
+        self.ExtendedMarketHours = False
+        self.DataNormalizationMode = DataNormalizationMode.Adjusted
+        self.MinimumTimeInUniverse = timedelta(days=1)
+
+
+class FuncSecuritySeeder:
+    def __init__(self, get_last_known_prices):
+        self.get_last_known_prices = get_last_known_prices
+
+    def SeedSecurity(self, security):
+        for bar in self.get_last_known_prices(security):
+            security.SetMarketPrice(bar)
+        return True
+
+
+class BrokerageModelSecurityInitializer:
+    def __init__(self, brokerage_model, security_seeder=None):
+        self.brokerage_model = brokerage_model
+        self.security_seeder = security_seeder
+
+    def Initialize(self, security):
+        if self.security_seeder is not None:
+            self.security_seeder.SeedSecurity(security)
+
+
+class DefaultBrokerageModel:
+    pass
+
+
+class ConstantRiskFreeRateInterestRateModel:
+    def __init__(self, rate=0.0):
+        self.rate = rate
+
+    def GetInterestRate(self, date):
+        return self.rate
+
+
+class AlgorithmSettings:
+    def __init__(self):
+        # The free portfolio value is set from the percentage when the run starts, like LEAN does
+        self.FreePortfolioValuePercentage = 0.0025
+        self.FreePortfolioValue = 0.0
+        self.MinimumOrderMarginPortfolioPercentage = 0.0
+
+# endregion
+
+
+# region Scheduling
+
+class _DateRule:
+    def __init__(self, name, symbol, selects):
+        # `selects(day, days, i)` is called for trading days only, with `days` the sorted trading days and `i` the
+        # index of `day` in them
+        self.Name = name
+        self.symbol = symbol
+        self.selects = selects
+
+
+class DateRules:
+    def EveryDay(self, symbol=None):
+        return _DateRule('EveryDay', symbol, lambda day, days, i: True)
+
+    def WeekStart(self, symbol=None):
+        return _DateRule('WeekStart', symbol, lambda day, days, i: i == 0 or _week(days[i - 1]) != _week(day))
+
+    def WeekEnd(self, symbol=None):
+        return _DateRule('WeekEnd', symbol, lambda day, days, i: day.weekday() == 4 if i == len(days) - 1 else _week(days[i + 1]) != _week(day))
+
+    def MonthStart(self, symbol=None):
+        return _DateRule('MonthStart', symbol, lambda day, days, i: i == 0 or days[i - 1].month != day.month)
+
+    def MonthEnd(self, symbol=None):
+        return _DateRule('MonthEnd', symbol, lambda day, days, i: i < len(days) - 1 and days[i + 1].month != day.month)
+
+    def On(self, *dates):
+        dates = {value.date() if isinstance(value, datetime) else value for value in dates}
+        return _DateRule('On', None, lambda day, days, i: day in dates)
+
+
+def _week(day):
+    return day.isocalendar()[:2]
+
+
+class _TimeRule:
+    def __init__(self, name, symbol, times):
+        # `times(day)` gives the event times of a trading day
+        self.Name = name
+        self.symbol = symbol
+        self.times = times
+
+
+class TimeRules:
+    def AfterMarketOpen(self, symbol, minutesAfterOpen=0, extendedMarketOpen=False):
+        return _TimeRule('AfterMarketOpen', symbol, lambda day: [market_open(day) + timedelta(minutes=minutesAfterOpen)])
+
+    def BeforeMarketClose(self, symbol, minutesBeforeClose=0, extendedMarketClose=False):
+        return _TimeRule('BeforeMarketClose', symbol, lambda day: [market_close(day) - timedelta(minutes=minutesBeforeClose)])
+
+    def At(self, hour, minute=0, second=0):
+        return _TimeRule('At', None, lambda day: [datetime.combine(day, time(hour, minute, second))])
+
+    def Every(self, interval):
+        steps = int(timedelta(days=1) / interval)
+        return _TimeRule('Every', None, lambda day: [datetime.combine(day, time()) + i * interval for i in range(steps)])
+
+    @property
+    def Midnight(self):
+        return self.At(0)
+
+    @property
+    def Noon(self):
+        return self.At(12)
+
+
+class ScheduleManager:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def On(self, date_rule, time_rule, callback):
+        self.engine.schedule(date_rule, time_rule, callback)
+
+# endregion
+
+
+class _History:
+    # algorithm.History(...) returns a DataFrame; algorithm.History[TradeBar](...) a list of bars
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __call__(self, symbols, periods, resolution=None):
+        return self.engine.history_frame(symbols, periods, resolution)
+
+    def __getitem__(self, bar_type):
+        return lambda symbols, periods, resolution=None: self.engine.history_bars(bar_type, symbols, periods, resolution)
+
+
+class QCAlgorithm:
+    def __init__(self):
+        self.Time = datetime(1998, 1, 1)
+        self.StartDate = None
+        self.EndDate = None
+        self.LiveMode = False
+        self.IsWarmingUp = False
+        self.Settings = AlgorithmSettings()
+        self.UniverseSettings = UniverseSettings()
+        self.DateRules = DateRules()
+        self.TimeRules = TimeRules()
+        self.BrokerageModel = DefaultBrokerageModel()
+        self.RiskFreeInterestRateModel = ConstantRiskFreeRateInterestRateModel()
+        self.Securities = SecurityManager()
+        self.Portfolio = SecurityPortfolioManager(self.Securities)
+        self.engine = None
+
+    def attach(self, engine):
+        self.engine = engine
+        self.History = _History(engine)
+        self.Schedule = ScheduleManager(engine)
+        self.SubscriptionManager = SubscriptionManager(engine)
+        self.OptionChainProvider = OptionChainProvider(engine)
+
+    # Event handlers
+
+    def Initialize(self):
+        pass
+
+    def OnData(self, data):
+        pass
+
+    def OnOrderEvent(self, orderEvent):
+        pass
+
+    def OnSecuritiesChanged(self, changes):
+        pass
+
+    def OnEndOfDay(self, symbol=None):
+        pass
+
+    def OnWarmupFinished(self):
+        pass
+
+    def OnEndOfAlgorithm(self):
+        pass
+
+    # Setup
+
+    def SetStartDate(self, *args):
+        self.engine.set_start(_to_datetime(*args))
+
+    def SetEndDate(self, *args):
+        self.engine.set_end(_to_datetime(*args))
+
+    def SetCash(self, cash):
+        self.engine.set_cash(cash)
+
+    def SetWarmUp(self, period, resolution=None):
+        if not isinstance(period, timedelta):
+            period = period * RESOLUTION_PERIODS[resolution or Resolution.Minute]
+        self.engine.warm_up = period
+
+    def SetSecurityInitializer(self, initializer):
+        self.engine.security_initializer = initializer
+
+    def GetParameter(self, name, default_value=None):
+        return self.engine.parameters.get(name, default_value)
+
+    def SetBrokerageModel(self, *args):
+        pass
+
+    def SetBenchmark(self, benchmark):
+        pass
+
+    def SetRiskFreeInterestRateModel(self, model):
+        self.RiskFreeInterestRateModel = model
+
+    # Subscriptions
+
+    def AddEquity(self, ticker, resolution=Resolution.Minute, market=Market.USA, fillForward=True, leverage=None,
+                  extendedMarketHours=False, dataNormalizationMode=None):
+        return self.engine.add_equity(ticker, resolution, leverage, dataNormalizationMode)
+
+    def AddIndex(self, ticker, resolution=Resolution.Minute, market=Market.USA, fillForward=True):
+        return self.engine.add_index(ticker, resolution)
+
+    def AddFuture(self, ticker, resolution=Resolution.Minute, market=None, fillForward=True, leverage=None,
+                  extendedMarketHours=False, dataMappingMode=None, dataNormalizationMode=None, contractDepthOffset=0):
+        return self.engine.add_future(ticker, resolution)
+
+    def AddOption(self, underlying, resolution=Resolution.Minute, market=Market.USA, fillForward=True, leverage=None):
+        return self.engine.add_option(underlying, resolution, SecurityType.Equity)
+
+    def AddIndexOption(self, underlying, resolution=Resolution.Minute, market=Market.USA, fillForward=True):
+        return self.engine.add_option(underlying, resolution, SecurityType.Index)
+
+    def AddOptionContract(self, symbol, resolution=Resolution.Minute, fillForward=True, leverage=None):
+        return self.engine.add_option_contract(symbol, resolution)
+
+    def AddUniverse(self, coarse, fine=None):
+        self.engine.add_universe(coarse, fine)
+
+    def RemoveSecurity(self, symbol):
+        return self.engine.remove_security(symbol)
+
+    # Orders
+
+    def MarketOrder(self, symbol, quantity, asynchronous=False, tag=''):
+        return self.engine.submit_order(symbol, quantity, OrderType.Market, tag)
+
+    def Buy(self, symbol, quantity):
+        return self.MarketOrder(symbol, abs(quantity))
+
+    def Sell(self, symbol, quantity):
+        return self.MarketOrder(symbol, -abs(quantity))
+
+    def LimitOrder(self, symbol, quantity, limitPrice, tag=''):
+        return self.engine.submit_order(symbol, quantity, OrderType.Limit, tag, limit_price=limitPrice)
+
+    def StopMarketOrder(self, symbol, quantity, stopPrice, tag=''):
+        return self.engine.submit_order(symbol, quantity, OrderType.StopMarket, tag, stop_price=stopPrice)
+
+    def Liquidate(self, symbol=None, tag='Liquidated'):
+        return self.engine.liquidate(symbol, tag)
+
+    def SetHoldings(self, symbol, percentage, liquidateExistingHoldings=False, tag=''):
+        if liquidateExistingHoldings:
+            for holding in list(self.Portfolio.held):
+                if holding != symbol:
+                    self.Liquidate(holding)
+        quantity = self.CalculateOrderQuantity(symbol, percentage)
+        if quantity:
+            self.MarketOrder(symbol, quantity, tag=tag)
+
+    def CalculateOrderQuantity(self, symbol, target):
+        return self.engine.order_quantity(symbol, target)
+
+    # Indicators and consolidators
+
+    def RegisterIndicator(self, symbol, indicator, resolution=None):
+        if isinstance(resolution, (TradeBarConsolidator, IdentityDataConsolidator)):
+            consolidator = resolution
+        else:
+            consolidator = self.ResolveConsolidator(symbol, resolution)
+        consolidator.DataConsolidated += lambda sender, bar: indicator.Update(bar.EndTime, bar.Close)
+        self.SubscriptionManager.AddConsolidator(symbol, consolidator)
+
+    def ResolveConsolidator(self, symbol, resolution=None):
+        # Bars of the subscription's own resolution pass straight through
+        if resolution is None or resolution == self.Securities[symbol].Resolution:
+            return IdentityDataConsolidator()
+        return TradeBarConsolidator(RESOLUTION_PERIODS[resolution])
+
+    def Consolidate(self, symbol, period, handler):
+        consolidator = TradeBarConsolidator(period)
+        consolidator.DataConsolidated += lambda sender, bar: handler(bar)
+        self.SubscriptionManager.AddConsolidator(symbol, consolidator)
+        return consolidator
+
+    def EMA(self, symbol, period, resolution=None):
+        return self._registered(symbol, ExponentialMovingAverage(f"EMA({symbol},{period})", period), resolution)
+
+    def SMA(self, symbol, period, resolution=None):
+        return self._registered(symbol, SimpleMovingAverage(f"SMA({symbol},{period})", period), resolution)
+
+    def STD(self, symbol, period, resolution=None):
+        return self._registered(symbol, StandardDeviation(f"STD({symbol},{period})", period), resolution)
+
+    def BB(self, symbol, period, k, movingAverageType=None, resolution=None):
+        if isinstance(movingAverageType, Resolution):
+            resolution = movingAverageType
+        return self._registered(symbol, BollingerBands(f"BB({symbol},{period},{k})", period, k), resolution)
+
+    def LOGR(self, symbol, period, resolution=None):
+        return self._registered(symbol, LogReturn(f"LOGR({symbol},{period})", period), resolution)
+
+    def _registered(self, symbol, indicator, resolution):
+        self.RegisterIndicator(symbol, indicator, resolution)
+        return indicator
+
+    # Data
+
+    def GetLastKnownPrices(self, security):
+        symbol = security.Symbol if isinstance(security, Security) else security
+        return self.engine.last_known_prices(symbol)
+
+    # Logging and charting
+
+    def Debug(self, message):
+        self.engine.log('DEBUG', message)
+
+    def Log(self, message):
+        self.engine.log('LOG', message)
+
+    def Error(self, message):
+        self.engine.log('ERROR', message)
+
+    def Plot(self, chart, series, value=None):
+        if value is None:
+            chart, series, value = chart, chart, series
+        self.engine.plot(chart, series, value)
+
+    def Record(self, series, value):
+        self.Plot('Custom', series, value)
+
+
+def _to_datetime(*args):
+    if len(args) == 1:
+        value = args[0]
+        return value if isinstance(value, datetime) else datetime.combine(value, time())
+    return datetime(*args)
@@ -0,0 +1,210 @@
+# Memory-mapped minute-bar store
+#
+# CSV files have to be parsed on every run, which takes seconds per symbol-year. BarStore keeps the minute bars in
+# binary files instead, laid out like this:
+#   bar_store.json          format version
+#   <TICKER>/<YYYY-MM>.npy  the bars of one month as one columnar float64 array of shape (8, bars): the end times (the
+#                           int64 nanoseconds of datetime64[ns], stored as raw bits) followed by the FIELDS columns
+#   <TICKER>/index.npy      the date index: month and row range in that month's file of every trading day
+#   <TICKER>/mapped.csv     time and contract of every roll of a continuous future, if the bars had a mapping
+#   option_chains/, fundamentals.csv  as for CsvBarSource
+#
+# Month files are opened with np.load(mmap_mode='r'), so opening one only reads its header and the OS pages in just
+# the rows a query touches. A query within one month returns views of the mapped file, without parsing or copying;
+# a query over several months concatenates the slices it covers. BarStore is a bar source for the engine (see
+# data.py), so the warm-up and History calls of a run read only the months they need.
+#
+# Example (converts a CsvBarSource directory once, then runs from the store):
+#   python -m local_engine.convert ~/bars ~/bar_store
+#   python -m local_engine in-out-strategy.py --data ~/bar_store
+# or from Python:
+#   store = BarStore('~/bar_store')
+#   store.frame('SPY', datetime(2021, 3, 1), datetime(2021, 3, 2))  # DataFrame sharing the mapped file's memory
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from local_engine.data import FIELDS, Bars, CsvBarSource
+
+VERSION = 1
+
+INDEX_DTYPE = np.dtype([('day', 'datetime64[D]'), ('month', 'datetime64[M]'), ('start', 'i8'), ('stop', 'i8')])
+
+
+def is_bar_store(directory):
+    return os.path.exists(os.path.join(os.path.expanduser(directory), 'bar_store.json'))
+
+
+def periods_of(time, unit):
+    # Day or month of every bar; like in trading_days, a bar ending at midnight belongs to the period before
+    return (time - np.timedelta64(1, 'ns')).astype(f'datetime64[{unit}]')
+
+
+class BarStore(CsvBarSource):
+    def __init__(self, directory):
+        # Option chains and fundamentals are read from the same CSV files as in CsvBarSource
+        super().__init__(os.path.expanduser(directory))
+        self.month_arrays = {}
+        self.indexes = {}
+        self.rolls = {}
+
+    # region Reading
+
+    def index(self, ticker):
+        # Date index of `ticker` sorted by day; empty if the ticker isn't stored
+        index = self.indexes.get(ticker)
+        if index is None:
+            path = self.path(ticker, 'index.npy')
+            index = self.indexes[ticker] = np.load(path) if os.path.exists(path) else np.empty(0, INDEX_DTYPE)
+        return index
+
+    def months(self, ticker):
+        return np.unique(self.index(ticker)['month'])
+
+    def month_array(self, ticker, month):
+        # The memory-mapped (8, bars) array of one month
+        key = (ticker, month)
+        array = self.month_arrays.get(key)
+        if array is None:
+            array = self.month_arrays[key] = np.load(self.path(ticker, f"{month}.npy"), mmap_mode='r')
+        return array
+
+    def pieces(self, ticker, start=None, end=None, count=None):
+        # Column slices (views of the month arrays, oldest first) of the bars that end after `start` and no later than
+        # `end`, or of the last `count` bars that end no later than `end`
+        months = self.months(ticker)
+        if start is not None:
+            months = months[months >= np.datetime64(start, 'M')]
+        if end is not None:
+            months = months[months <= periods_of(np.datetime64(end, 'ns'), 'M')]
+        pieces = []
+        for month in months if count is None else months[::-1]:
+            array = self.month_array(ticker, month)
+            time = array[0].view('datetime64[ns]')
+            i = 0 if start is None else np.searchsorted(time, np.datetime64(start, 'ns'), 'right')
+            j = len(time) if end is None else np.searchsorted(time, np.datetime64(end, 'ns'), 'right')
+            if count is not None:
+                i = max(j - count, 0)
+                count -= j - i
+            if i < j:
+                pieces.append(array[:, i:j])
+            if count is not None and count <= 0:
+                break
+        return pieces if count is None else pieces[::-1]
+
+    def bars(self, ticker, start=None, end=None):
+        # Bars that end after `start` and no later than `end`
+        return self.join(ticker, self.pieces(ticker, start, end))
+
+    def last(self, ticker, count, end=None):
+        # The last `count` bars that end no later than `end`, walking back from the month of `end`
+        return self.join(ticker, self.pieces(ticker, end=end, count=count))
+
+    def join(self, ticker, pieces):
+        if not pieces:
+            return Bars.empty()
+        array = pieces[0] if len(pieces) == 1 else np.concatenate(pieces, axis=1)
+        time = array[0].view('datetime64[ns]')
+        return Bars(time, {field: array[k + 1] for k, field in enumerate(FIELDS)}, self.mapped(ticker, time))
+
+    def frame(self, ticker, start=None, end=None):
+        # DataFrame of the bars between `start` and `end` indexed by end time. The FIELDS are consecutive rows of a month
+        # array, so within one month the frame's single block is a view of the mapped file.
+        pieces = self.pieces(ticker, start, end)
+        if not pieces:
+            return pd.DataFrame(columns=list(FIELDS), index=pd.DatetimeIndex([], name='time'), dtype=float)
+        array = pieces[0] if len(pieces) == 1 else np.concatenate(pieces, axis=1)
+        return pd.DataFrame(array[1:].T, index=pd.DatetimeIndex(array[0].view('datetime64[ns]'), name='time'),
+                            columns=list(FIELDS), copy=False)
+
+    def mapped(self, ticker, time):
+        # Mapped contract of every bar in `time`, from the roll table; None for tickers without one
+        rolls = self.rolls.get(ticker)
+        if rolls is None:
+            path = self.path(ticker, 'mapped.csv')
+            rolls = ()
+            if os.path.exists(path):
+                frame = pd.read_csv(path, parse_dates=['time'])
+                rolls = (frame['time'].values.astype('datetime64[ns]'), frame['mapped'].values.astype(object))
+            self.rolls[ticker] = rolls
+        if not rolls:
+            return None
+        roll_times, contracts = rolls
+        return contracts[np.maximum(np.searchsorted(roll_times, time, 'right') - 1, 0)]
+
+    def trading_days(self, ticker):
+        return [day.astype(object) for day in self.index(ticker)['day']]
+
+    # endregion
+
+    # region Writing
+
+    def write(self, ticker, bars):
+        # Replaces the stored bars of `ticker` with `bars` (a Bars object)
+        directory = self.path(ticker)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        self.indexes.pop(ticker, None)
+        self.rolls.pop(ticker, None)
+        for key in [key for key in self.month_arrays if key[0] == ticker]:
+            del self.month_arrays[key]
+        if not len(bars):
+            np.save(self.path(ticker, 'index.npy'), np.empty(0, INDEX_DTYPE))
+            return
+
+        times = bars.time.astype('datetime64[ns]')
+        months = periods_of(times, 'M')
+        days = periods_of(times, 'D')
+        month_starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        month_stops = np.r_[month_starts[1:], len(times)]
+        for start, stop in zip(month_starts, month_stops):
+            array = np.empty((len(FIELDS) + 1, stop - start))
+            array[0].view('int64')[:] = times[start:stop].view('int64')
+            for k, field in enumerate(FIELDS):
+                array[k + 1] = bars[field][start:stop]
+            np.save(self.path(ticker, f"{months[start]}.npy"), array)
+
+        day_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        day_stops = np.r_[day_starts[1:], len(times)]
+        index = np.empty(len(day_starts), INDEX_DTYPE)
+        index['day'] = days[day_starts]
+        index['month'] = months[day_starts]
+        # Row ranges are relative to the start of each day's month file
+        month_offsets = month_starts[np.searchsorted(month_starts, day_starts, 'right') - 1]
+        index['start'] = day_starts - month_offsets
+        index['stop'] = day_stops - month_offsets
+        np.save(self.path(ticker, 'index.npy'), index)
+
+        if bars.mapped is not None:
+            rolls = np.flatnonzero(np.r_[True, bars.mapped[1:] != bars.mapped[:-1]])
+            pd.DataFrame({'time': times[rolls], 'mapped': bars.mapped[rolls]}).to_csv(self.path(ticker, 'mapped.csv'), index=False)
+
+    @classmethod
+    def create(cls, directory):
+        directory = os.path.expanduser(directory)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'bar_store.json'), 'w') as file:
+            json.dump({'version': VERSION}, file)
+        return cls(directory)
+
+    # endregion
+
+
+def convert(csv_directory, store_directory):
+    # Stores every <TICKER>.csv of a CsvBarSource directory and copies its option chains and fundamentals
+    source = CsvBarSource(os.path.expanduser(csv_directory))
+    store = BarStore.create(store_directory)
+    tickers = sorted(name[:-4] for name in os.listdir(source.directory) if name.endswith('.csv') and name != 'fundamentals.csv')
+    for ticker in tickers:
+        store.write(ticker, source.bars(ticker))
+    if os.path.isdir(source.path('option_chains')):
+        shutil.copytree(source.path('option_chains'), store.path('option_chains'), dirs_exist_ok=True)
+    if os.path.exists(source.path('fundamentals.csv')):
+        shutil.copy(source.path('fundamentals.csv'), store.path('fundamentals.csv'))
+    return tickers
+
@@ -0,0 +1,15 @@
+# Converts a directory of CSV minute bars (see data.py) into a memory-mapped bar store (see bar_store.py)
+#
+# Example:
+#   python -m local_engine.convert ~/bars ~/bar_store
+
+import argparse
+
+from local_engine.bar_store import convert
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a directory of CSV minute bars into a memory-mapped bar store")
+    parser.add_argument('csv_directory')
+    parser.add_argument('store_directory')
+    args = parser.parse_args()
+    print(f"Stored {len(convert(args.csv_directory, args.store_directory))} tickers in {args.store_directory}")
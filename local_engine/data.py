@@ -0,0 +1,165 @@
+# Bar sources of the local engine
+#
+# A bar source hands the engine the minute bars of one ticker as NumPy columns. CsvBarSource reads a directory laid out
+# like this:
+#   <TICKER>.csv                     time (bar end time, exchange time zone), open, high, low, close, volume, and
+#                                    optionally bidclose and askclose (the quotes at the bar end) and mapped (the
+#                                    contract a continuous future is mapped to, e.g. "YM H20")
+#   <OSI ticker without spaces>.csv  bars of one option contract, e.g. SPY200117C00320000.csv
+#   option_chains/<UNDERLYING>.csv   date, expiry, right (C or P) and strike of every listed contract
+#   fundamentals.csv                 date, symbol, price, dollar_volume, market_cap and optionally
+#                                    has_fundamental_data, for coarse/fine universe selection
+#
+# Any object with the same `bars`, `last`, `trading_days`, `option_chain` and `fundamentals` methods can stand in for
+# CsvBarSource, e.g. the memory-mapped BarStore in bar_store.py.
+
+import os
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Float columns of every Bars object; quotes a file doesn't have are NaN
+FIELDS = ('open', 'high', 'low', 'close', 'volume', 'bidclose', 'askclose')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class Bars:
+    def __init__(self, time, columns, mapped=None):
+        # `time` is a sorted datetime64[ns] array of bar end times, `columns` maps every name in FIELDS to a float array
+        # of the same length and `mapped` is an optional object array of contract tickers
+        self.time = time
+        self.columns = columns
+        self.mapped = mapped
+
+    @classmethod
+    def empty(cls):
+        return cls(np.array([], dtype='datetime64[ns]'), {field: np.array([]) for field in FIELDS})
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    @property
+    def quoted(self):
+        return bool(len(self.time)) and not np.isnan(self.columns['askclose']).all()
+
+    def slice(self, start, stop):
+        # Rows start..stop as views of these columns
+        mapped = None if self.mapped is None else self.mapped[start:stop]
+        return Bars(self.time[start:stop], {field: column[start:stop] for field, column in self.columns.items()}, mapped)
+
+    def between(self, start=None, end=None):
+        # Bars that end after `start` and no later than `end`
+        i = 0 if start is None else np.searchsorted(self.time, np.datetime64(start, 'ns'), 'right')
+        j = len(self.time) if end is None else np.searchsorted(self.time, np.datetime64(end, 'ns'), 'right')
+        return self.slice(i, j)
+
+    def last(self, count, end=None):
+        # The last `count` bars that end no later than `end`
+        j = len(self.time) if end is None else np.searchsorted(self.time, np.datetime64(end, 'ns'), 'right')
+        return self.slice(max(j - count, 0), j)
+
+
+def resample(bars, period):
+    # Consolidates bars into bars of `period` (a timedelta), aligned to midnight like TradeBarConsolidator. A bar belongs
+    # to the period its last nanosecond falls into; every consolidated bar is stamped with the end of its period.
+    if not len(bars):
+        return Bars.empty()
+    step = np.timedelta64(period).astype('timedelta64[ns]').astype('int64')
+    ends = bars.time.astype('int64')
+    buckets = (ends - 1) // step
+    first = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    last = np.r_[first[1:], len(ends)] - 1
+    columns = bars.columns
+    consolidated = {
+        'open': columns['open'][first],
+        'high': np.fmax.reduceat(columns['high'], first),
+        'low': np.fmin.reduceat(columns['low'], first),
+        'close': columns['close'][last],
+        'volume': np.add.reduceat(np.nan_to_num(columns['volume']), first),
+        'bidclose': columns['bidclose'][last],
+        'askclose': columns['askclose'][last]
+    }
+    time = ((buckets[first] + 1) * step).astype('datetime64[ns]')
+    return Bars(time, consolidated, None if bars.mapped is None else bars.mapped[last])
+
+
+def trading_days(bars):
+    # Dates with at least one bar; a bar ending at midnight belongs to the previous day
+    if not len(bars):
+        return []
+    days = np.unique((bars.time - np.timedelta64(1, 'ns')).astype('datetime64[D]'))
+    return [day.astype(object) for day in days]
+
+
+def to_datetime(nanoseconds):
+    return EPOCH + timedelta(microseconds=int(nanoseconds) // 1000)
+
+
+class CsvBarSource:
+    def __init__(self, directory):
+        self.directory = directory
+        self.bars_by_ticker = {}
+        self.chains = {}
+        self.fundamentals_by_date = None
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def bars(self, ticker, start=None, end=None):
+        # Minute bars of `ticker` that end after `start` and no later than `end`, parsed once; empty if there is no file
+        bars = self.bars_by_ticker.get(ticker)
+        if bars is None:
+            path = self.path(f"{ticker}.csv")
+            bars = self.bars_by_ticker[ticker] = read_bars(path) if os.path.exists(path) else Bars.empty()
+        return bars if start is None and end is None else bars.between(start, end)
+
+    def last(self, ticker, count, end=None):
+        # The last `count` minute bars of `ticker` that end no later than `end`
+        return self.bars(ticker).last(count, end)
+
+    def trading_days(self, ticker):
+        return trading_days(self.bars(ticker))
+
+    def option_chain(self, underlying, date):
+        # DataFrame of the expiry, right and strike of the contracts listed on `date`
+        chain = self.chains.get(underlying)
+        if chain is None:
+            path = self.path('option_chains', f"{underlying}.csv")
+            if os.path.exists(path):
+                frame = pd.read_csv(path, parse_dates=['date', 'expiry'])
+                chain = {day.date(): rows for day, rows in frame.groupby('date')}
+            else:
+                chain = {}
+            self.chains[underlying] = chain
+        return chain.get(date)
+
+    def fundamentals(self, date):
+        # DataFrame of the coarse/fine fields of every stock on `date`, or None
+        if self.fundamentals_by_date is None:
+            path = self.path('fundamentals.csv')
+            self.fundamentals_by_date = {}
+            if os.path.exists(path):
+                frame = pd.read_csv(path, parse_dates=['date'])
+                self.fundamentals_by_date = {day.date(): rows for day, rows in frame.groupby('date')}
+        return self.fundamentals_by_date.get(date)
+
+
+def read_bars(path):
+    frame = pd.read_csv(path, parse_dates=['time']).sort_values('time', kind='stable')
+    columns = {field: frame[field].values.astype(float) if field in frame else np.full(len(frame), np.nan)
+               for field in FIELDS}
+    mapped = frame['mapped'].values.astype(object) if 'mapped' in frame else None
+    return Bars(frame['time'].values.astype('datetime64[ns]'), columns, mapped)
+
+
+def market_open(day):
+    return datetime.combine(day, time(9, 30))
+
+
+def market_close(day):
+    return datetime.combine(day, time(16, 0))
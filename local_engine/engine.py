@@ -0,0 +1,949 @@
+# Event loop of the local engine
+#
+# Engine replays locally stored bars through a QCAlgorithm the way LEAN's backtesting engine does, closely enough to
+# profile the strategies and compare their decisions offline:
+# - every subscription is a feed of NumPy columns and the feeds are merged by bar end time with a heap, so a step only
+#   touches the feeds that have a bar at that time
+# - the contracts an option chain selects are fed lazily: they're not stepped, and their prices are brought up to date
+#   only when the chain, Securities[...] or an order reads them. A contract is stepped like any other security once
+#   it has an order or a consolidator.
+# - a step updates the security prices, fills the open stop and limit orders the new bars trade through, fires the
+#   scheduled events that are due, updates the consolidators (and the indicators registered on them) and then calls
+#   OnData with the Slice; daily bars are consolidated at midnight
+# - market orders fill immediately at the ask (buys) or bid (sells) of the last quote, or at the last close without
+#   quotes. Sell stops fill at min(stop, close) once the low trades through the stop and sell limits at max(low, limit)
+#   once the high does; buy orders mirror this. Order events are dispatched in order, after the handler that caused
+#   them returns.
+#
+# Simplifications: a continuous future's mapped contract trades at the continuous prices, and the contracts it was
+# mapped to before keep those prices while they have a position or open orders. Options only have data when the
+# source has it; held contracts are cash settled at their intrinsic value the day after expiry. Lazily fed chain
+# contracts have no bars in the Slice and no OnEndOfDay call. Universe selection
+# runs daily at midnight from the source's fundamentals. Fees are zero unless a security has a fee model.
+
+import heapq
+import inspect
+import itertools
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+from local_engine.algorithm_imports import (
+    FUTURES_PROPERTIES, RESOLUTION_PERIODS, Bar, BuyingPowerModel, ConstantRiskFreeRateInterestRateModel,
+    CoarseFundamental, Equity, FineFundamental, Future, FutureMarginModel, Index, Market, Option, OptionChain,
+    OptionContract, OptionRight, Order, OrderEvent, OrderFeeParameters, OrderResponse, OrderStatus, OrderTicket,
+    OrderType, QuoteBar, Resolution, SecurityChanges, SecurityType, Slice, Symbol, SymbolChangedEvent,
+    SymbolProperties, TradeBar, Universe
+)
+from local_engine.data import resample, to_datetime
+
+CLOSED_ORDER_STATUSES = (OrderStatus.Filled, OrderStatus.Canceled, OrderStatus.Invalid)
+OPTION_TYPES = (SecurityType.Option, SecurityType.IndexOption)
+
+
+class Feed:
+    def __init__(self, security, bars, period):
+        # Columns as lists, so reading a bar doesn't box NumPy scalars
+        self.security = security
+        self.symbol = security.Symbol
+        self.period = period
+        self.times = bars.time.astype('int64').tolist()
+        columns = bars.columns
+        self.open = columns['open'].tolist()
+        self.high = columns['high'].tolist()
+        self.low = columns['low'].tolist()
+        self.close = columns['close'].tolist()
+        self.volume = columns['volume'].tolist()
+        self.quoted = bars.quoted
+        self.bid = columns['bidclose'].tolist()
+        self.ask = columns['askclose'].tolist()
+        self.mapped = None if bars.mapped is None else bars.mapped.tolist()
+        self.index = 0
+        self.active = True
+
+    def read(self, end_time):
+        # The trade bar, quote bar and mapped contract at the cursor, then advance it
+        i = self.index
+        self.index += 1
+        return self.bar(i, end_time)
+
+    def bar(self, i, end_time):
+        # The trade bar, quote bar and mapped contract of row `i`. NaN closes or quotes give None.
+        start = end_time - self.period
+        trade_bar = quote_bar = None
+        close = self.close[i]
+        if close == close:
+            trade_bar = TradeBar(start, self.symbol, self.open[i], self.high[i], self.low[i], close, self.volume[i], self.period)
+        if self.quoted:
+            bid, ask = self.bid[i], self.ask[i]
+            if bid == bid and ask == ask:
+                quote_bar = QuoteBar(start, self.symbol, Bar(bid, bid, bid, bid), Bar(ask, ask, ask, ask), self.period)
+        return trade_bar, quote_bar, None if self.mapped is None else self.mapped[i]
+
+    @property
+    def done(self):
+        return self.index == len(self.times)
+
+
+class LazyFeed(Feed):
+    def __init__(self, engine, security, bars, period):
+        # A feed the event loop doesn't step. The security's prices are brought up to date with the bars that ended by
+        # the current step when they're read, so the minutes nobody looks at a contract cost nothing.
+        super().__init__(security, bars, period)
+        self.engine = engine
+        security.lazy_feed = self
+
+    def catch_up(self):
+        end = bisect_right(self.times, self.engine.clock, self.index)
+        if end == self.index:
+            return
+        # Only the last bar with a close and the last one with quotes are applied (in order), which leaves the
+        # prices where stepping through every bar would
+        trade_index = quote_index = None
+        for i in range(end - 1, self.index - 1, -1):
+            if trade_index is None and self.close[i] == self.close[i]:
+                trade_index = i
+            if quote_index is None and self.quoted and self.bid[i] == self.bid[i] and self.ask[i] == self.ask[i]:
+                quote_index = i
+            if trade_index is not None and (quote_index is not None or not self.quoted):
+                break
+        self.index = end
+        self.security.HasData = True
+        for i in sorted({i for i in (trade_index, quote_index) if i is not None}):
+            trade_bar, quote_bar, _ = self.bar(i, to_datetime(self.times[i]))
+            self.security.update_prices(trade_bar, quote_bar)
+
+
+class UniverseSubscription:
+    def __init__(self, coarse, fine):
+        self.coarse = coarse
+        self.fine = fine
+        self.members = set()
+
+
+class Engine:
+    def __init__(self, algorithm_class, source, start=None, end=None, cash=None, interest_rate=0.0, quiet=False,
+                 parameters=None):
+        # `start`, `end` and `cash` override the values the algorithm sets in Initialize; `parameters` are the values
+        # GetParameter returns
+        self.source = source
+        self.parameters = dict(parameters or {})
+        self.start_override = start
+        self.end_override = end
+        self.cash_override = cash
+        self.start = start
+        self.end = end
+        self.quiet = quiet
+        self.warm_up = None
+        self.security_initializer = None
+        self.running = False
+
+        self.symbols = {}
+        self.series_cache = {}
+        self.calendars = {}
+        self.feeds = {}
+        self.heap = []
+        self.feed_sequence = itertools.count()
+        self.pending_securities = []
+        self.consolidators = {}
+        self.all_consolidators = []
+        self.contracts = {}
+        self.option_subscriptions = []
+        self.chains = {}
+        self.universes = []
+        self.added = []
+        self.removed = []
+
+        self.order_ids = itertools.count(1)
+        self.orders = {}
+        self.open_orders = {}
+        self.order_events = deque()
+        self.dispatching = False
+
+        self.schedules = []
+        self.scheduled_events = []
+        self.event_sequence = itertools.count()
+
+        self.time = None
+        # End time of the current step in nanoseconds, which lazily fed securities are brought up to date to
+        self.clock = 0
+        self.slice = None
+        self.day = None
+        self.symbols_with_data = set()
+        self.logs = []
+        self.charts = {}
+        self.equity = []
+
+        self.algorithm = algorithm_class()
+        self.algorithm.attach(self)
+        self.algorithm.RiskFreeInterestRateModel = ConstantRiskFreeRateInterestRateModel(interest_rate)
+        self.algorithm.Portfolio.SetCash(100000 if cash is None else cash)
+        if start is not None:
+            self.set_start(start)
+        self.algorithm.Initialize()
+        end_of_day_parameters = inspect.signature(self.algorithm.OnEndOfDay).parameters
+        self.end_of_day_takes_symbol = len(end_of_day_parameters) > 0
+
+    # region Setup
+
+    def set_start(self, start):
+        self.start = self.start_override or start
+        self.algorithm.StartDate = self.start
+        self.algorithm.Time = self.start
+
+    def set_end(self, end):
+        self.end = self.end_override or end
+        self.algorithm.EndDate = self.end
+
+    def set_cash(self, cash):
+        self.algorithm.Portfolio.SetCash(self.cash_override if self.cash_override is not None else cash)
+
+    def symbol(self, value, security_type, **kwargs):
+        # One Symbol object per security, so identity checks (Canonical is self) hold
+        key = (int(security_type), value)
+        symbol = self.symbols.get(key)
+        if symbol is None:
+            symbol = self.symbols[key] = Symbol(value, security_type, **kwargs)
+        return symbol
+
+    def resolve(self, symbol):
+        # The Symbol of a subscribed security, or an equity Symbol for an unknown ticker
+        security = self.algorithm.Securities.get(symbol)
+        if security is not None:
+            return security.Symbol
+        return symbol if isinstance(symbol, Symbol) else self.symbol(symbol, SecurityType.Equity)
+
+    def data_key(self, symbol):
+        # Future contracts trade at the prices of their continuous future
+        if symbol.SecurityType == SecurityType.Future:
+            return symbol.Canonical.Value.lstrip('/')
+        return symbol.Value.replace(' ', '')
+
+    def series(self, symbol, resolution):
+        # Every bar of `symbol` at an hourly or daily `resolution`, consolidated from the minute bars once
+        key = (self.data_key(symbol), resolution)
+        bars = self.series_cache.get(key)
+        if bars is None:
+            bars = self.series_cache[key] = resample(self.source.bars(key[0]), RESOLUTION_PERIODS[resolution])
+        return bars
+
+    def bars_between(self, symbol, resolution, start, end):
+        # Bars that end after `start` and no later than `end`. Minute bars are read from the source for just that
+        # range, so a memory-mapped source only touches the months it covers.
+        if resolution in (Resolution.Hour, Resolution.Daily):
+            return self.series(symbol, resolution).between(start, end)
+        return self.source.bars(self.data_key(symbol), start, end)
+
+    def bars_before(self, symbol, resolution, count, end):
+        # The last `count` bars that end no later than `end`
+        if resolution in (Resolution.Hour, Resolution.Daily):
+            return self.series(symbol, resolution).last(count, end)
+        return self.source.last(self.data_key(symbol), count, end)
+
+    # endregion
+
+    # region Subscriptions
+
+    def add_security(self, security_class, symbol, resolution, symbol_properties, buying_power_model, lazy=False):
+        securities = self.algorithm.Securities
+        security = securities.get(symbol)
+        if security is None:
+            security = securities[symbol] = security_class(symbol, symbol_properties, resolution, buying_power_model)
+            if self.security_initializer is not None:
+                self.security_initializer.Initialize(security)
+        elif symbol in self.feeds:
+            if not lazy:
+                self.promote(security)
+            return security
+        self.subscribe(security, lazy)
+        self.added.append(security)
+        return security
+
+    def add_equity(self, ticker, resolution, leverage=None, normalization_mode=None):
+        symbol = self.symbol(ticker, SecurityType.Equity)
+        security = self.add_security(Equity, symbol, resolution, SymbolProperties(ticker), BuyingPowerModel(leverage or 2))
+        if normalization_mode is not None:
+            security.SetDataNormalizationMode(normalization_mode)
+        return security
+
+    def add_index(self, ticker, resolution):
+        return self.add_security(Index, self.symbol(ticker, SecurityType.Index), resolution, SymbolProperties(ticker), BuyingPowerModel(1))
+
+    def add_future(self, ticker, resolution):
+        multiplier, minimum_price_variation, margin = FUTURES_PROPERTIES.get(ticker, (1, 0.01, 0))
+        symbol_properties = SymbolProperties(ticker, 'USD', multiplier, minimum_price_variation, 1)
+        future = self.add_security(Future, self.symbol('/' + ticker, SecurityType.Future), resolution, symbol_properties,
+                                   FutureMarginModel(margin))
+        self.contracts.setdefault(future.Symbol, [])
+        if future.Mapped is None:
+            future.Mapped = self.contract(future, self.mapped_contract(future, self.algorithm.Time))
+        return future
+
+    def contract(self, future, value):
+        # The Symbol of a contract of `future`, added as a security the first time it's mapped
+        symbol = self.symbol(value, SecurityType.Future, canonical=future.Symbol)
+        if symbol not in self.algorithm.Securities:
+            properties = future.SymbolProperties
+            self.add_security(Future, symbol, future.Resolution, properties,
+                              FutureMarginModel(future.BuyingPowerModel.InitialIntradayMarginRequirement))
+            self.contracts[future.Symbol].append(symbol)
+        return symbol
+
+    def mapped_contract(self, future, at):
+        # Contract the continuous future is mapped to at `at` (or at its first bar within a month after `at`); the
+        # ticker itself if the data doesn't say
+        bars = self.bars_before(future.Symbol, Resolution.Minute, 1, at)
+        if not len(bars):
+            bars = self.bars_between(future.Symbol, Resolution.Minute, at, at + timedelta(days=31)).slice(0, 1)
+        if bars.mapped is None or not len(bars):
+            return future.Symbol.Value.lstrip('/')
+        return bars.mapped[0]
+
+    def add_option(self, underlying, resolution, underlying_type):
+        if underlying_type == SecurityType.Index:
+            underlying_security = self.add_index(underlying, resolution)
+            security_type = SecurityType.IndexOption
+        else:
+            underlying_security = self.add_equity(underlying, resolution)
+            security_type = SecurityType.Option
+        symbol = self.symbol('?' + underlying, security_type, underlying=underlying_security.Symbol)
+        option = self.add_security(Option, symbol, resolution, SymbolProperties(underlying, 'USD', 100), BuyingPowerModel(1))
+        self.option_subscriptions.append(option)
+        return option
+
+    def add_option_contract(self, symbol, resolution, lazy=False):
+        return self.add_security(Option, symbol, resolution, SymbolProperties(symbol.Underlying.Value, 'USD', 100),
+                                 BuyingPowerModel(1), lazy)
+
+    def option_symbol(self, underlying, expiry, right, strike):
+        right = OptionRight.Call if str(right).upper().startswith('C') else OptionRight.Put
+        symbol = Symbol.CreateOption(underlying, Market.USA, None, right, float(strike), expiry)
+        return self.symbols.setdefault(symbol.key, symbol)
+
+    def option_contract_list(self, underlying, at):
+        underlying = self.resolve(underlying)
+        day = at.date() if isinstance(at, datetime) else at
+        rows = self.source.option_chain(self.data_key(underlying), day)
+        if rows is None:
+            return []
+        return [self.option_symbol(underlying, expiry.to_pydatetime(), right, strike)
+                for expiry, right, strike in zip(rows['expiry'], rows['right'], rows['strike'])]
+
+    def option_chain(self, option):
+        # The chain of a canonical option in this step's slice. Its contracts are selected once a day, as soon as the
+        # underlying has a price; like in LEAN, only the contracts that have data are in the chain. The chain is only
+        # rebuilt when the first bar of another contract has come in.
+        day = self.time.date()
+        cached = self.chains.get(option.Symbol)
+        if cached is None or cached['day'] != day:
+            underlying = self.algorithm.Securities[option.Symbol.Underlying]
+            if not underlying.HasData:
+                return None
+            contracts = self.select_contracts(option, underlying, day)
+            data_starts = [self.data_start(contract.security) for contract in contracts]
+            cached = self.chains[option.Symbol] = {'day': day, 'underlying': underlying, 'contracts': contracts,
+                                                   'data_starts': data_starts, 'sorted_starts': sorted(data_starts),
+                                                   'count': 0, 'chain': None}
+        count = bisect_right(cached['sorted_starts'], self.clock)
+        if count != cached['count']:
+            contracts = [contract for contract, data_start in zip(cached['contracts'], cached['data_starts'])
+                         if data_start <= self.clock]
+            cached['count'] = count
+            cached['chain'] = OptionChain(option.Symbol, cached['underlying'], contracts)
+        return cached['chain']
+
+    def data_start(self, security):
+        # Time from which `security` has data: now if it has some, else the end of its next bar (never without one)
+        if security.HasData:
+            return 0
+        feed = self.feeds.get(security.Symbol)
+        return feed.times[feed.index] if feed is not None and not feed.done else float('inf')
+
+    def select_contracts(self, option, underlying, day):
+        # Contracts listed on `day` within the expiry range and strike ranks around the money of the option's filter
+        rows = self.source.option_chain(self.data_key(underlying.Symbol), day)
+        if rows is None:
+            return []
+        min_strike, max_strike, min_expiry, max_expiry = option.filter
+        days_to_expiry = (rows['expiry'] - pd.Timestamp(day)).dt.days
+        rows = rows[(days_to_expiry >= min_expiry.days) & (days_to_expiry <= max_expiry.days)]
+        strikes = np.unique(rows['strike'].values)
+        if len(strikes):
+            atm = int(np.abs(strikes - underlying.Price).argmin())
+            rows = rows[rows['strike'].isin(strikes[max(atm + min_strike, 0):atm + max_strike + 1])]
+        contracts = []
+        for expiry, right, strike in zip(rows['expiry'], rows['right'], rows['strike']):
+            symbol = self.option_symbol(underlying.Symbol, expiry.to_pydatetime(), right, strike)
+            contracts.append(OptionContract(symbol, self.add_option_contract(symbol, option.Resolution, lazy=True), underlying))
+        return contracts
+
+    def add_universe(self, coarse, fine):
+        self.universes.append(UniverseSubscription(coarse, fine))
+
+    def select_universes(self, day):
+        rows = self.source.fundamentals(day)
+        if rows is None or not self.universes:
+            return
+        symbols = [self.symbol(ticker, SecurityType.Equity) for ticker in rows['symbol']]
+        has_fundamental_data = rows['has_fundamental_data'] if 'has_fundamental_data' in rows else [True] * len(rows)
+        coarse = [CoarseFundamental(symbol, price, dollar_volume, bool(has_data)) for symbol, price, dollar_volume, has_data
+                  in zip(symbols, rows['price'], rows['dollar_volume'], has_fundamental_data)]
+        fundamentals = dict(zip(symbols, zip(rows['price'], rows['market_cap'])))
+        settings = self.algorithm.UniverseSettings
+        for universe in self.universes:
+            selected = universe.coarse(coarse)
+            if selected is Universe.Unchanged:
+                continue
+            if universe.fine is not None:
+                selected = universe.fine([FineFundamental(symbol, *fundamentals[symbol]) for symbol in selected if symbol in fundamentals])
+                if selected is Universe.Unchanged:
+                    continue
+            members = set(selected)
+            for symbol in members - universe.members:
+                self.add_equity(symbol.Value, settings.Resolution, settings.Leverage)
+            for symbol in universe.members - members:
+                # Like LEAN, a security with a position keeps its data until it's liquidated
+                security = self.algorithm.Securities[symbol]
+                if not security.Invested:
+                    self.unsubscribe(symbol)
+                self.removed.append(security)
+            universe.members = members
+
+    def remove_security(self, symbol):
+        security = self.algorithm.Securities[symbol]
+        self.liquidate(security.Symbol, 'Removed from universe')
+        self.unsubscribe(security.Symbol)
+        self.removed.append(security)
+        return True
+
+    def subscribe(self, security, lazy=False):
+        # Future contracts and canonical options have no data of their own
+        symbol = security.Symbol
+        if (symbol.SecurityType == SecurityType.Future and not symbol.IsCanonical) or symbol.Value.startswith('?'):
+            return
+        if self.running:
+            self.create_feed(security, self.time, lazy)
+        else:
+            self.pending_securities.append(security)
+
+    def create_feed(self, security, start, lazy=False):
+        period = RESOLUTION_PERIODS.get(security.Resolution, RESOLUTION_PERIODS[Resolution.Minute])
+        end = None if self.end is None else datetime.combine(self.end.date(), time()) + timedelta(days=1)
+        bars = self.bars_between(security.Symbol, security.Resolution, start, end)
+        if not len(bars):
+            return
+        if lazy:
+            self.feeds[security.Symbol] = LazyFeed(self, security, bars, period)
+            return
+        feed = self.feeds[security.Symbol] = Feed(security, bars, period)
+        heapq.heappush(self.heap, (feed.times[0], next(self.feed_sequence), feed))
+
+    def promote(self, security):
+        # Step a lazily fed security from now on, e.g. once it has orders that fill on its bars
+        feed = security.lazy_feed
+        if feed is None:
+            return
+        feed.catch_up()
+        security.lazy_feed = None
+        if feed.active and not feed.done:
+            heapq.heappush(self.heap, (feed.times[feed.index], next(self.feed_sequence), feed))
+
+    def unsubscribe(self, symbol):
+        feed = self.feeds.pop(symbol, None)
+        if feed is not None:
+            feed.active = False
+            if feed.security.lazy_feed is feed:
+                feed.catch_up()
+                feed.security.lazy_feed = None
+
+    def add_consolidator(self, symbol, consolidator):
+        symbol = self.resolve(symbol)
+        security = self.algorithm.Securities.get(symbol)
+        if security is not None:
+            self.promote(security)
+        self.consolidators.setdefault(symbol, []).append(consolidator)
+        self.all_consolidators.append(consolidator)
+
+    def remove_consolidator(self, symbol, consolidator):
+        self.consolidators[self.resolve(symbol)].remove(consolidator)
+        self.all_consolidators.remove(consolidator)
+
+    # endregion
+
+    # region History
+
+    def history_window(self, symbol, periods, resolution):
+        if resolution is None:
+            security = self.algorithm.Securities.get(symbol)
+            resolution = Resolution.Minute if security is None else security.Resolution
+        now = self.algorithm.Time
+        if isinstance(periods, timedelta):
+            return self.bars_between(symbol, resolution, now - periods, now), resolution
+        return self.bars_before(symbol, resolution, int(periods), now), resolution
+
+    def history_frame(self, symbols, periods, resolution=None):
+        # DataFrame indexed by (symbol, time) with LEAN's lower-case column names
+        symbols = [symbols] if isinstance(symbols, (Symbol, str)) else list(symbols)
+        windows = [(symbol, self.history_window(symbol, periods, resolution)[0])
+                   for symbol in (self.resolve(symbol) for symbol in symbols)]
+        windows = [(symbol, bars) for symbol, bars in windows if len(bars)]
+        if not windows:
+            return pd.DataFrame()
+        fields = ['open', 'high', 'low', 'close', 'volume']
+        if any(bars.quoted for _, bars in windows):
+            fields += ['askclose', 'bidclose']
+        symbol_column = np.empty(sum(len(bars) for _, bars in windows), dtype=object)
+        position = 0
+        for symbol, bars in windows:
+            symbol_column[position:position + len(bars)] = [symbol] * len(bars)
+            position += len(bars)
+        index = pd.MultiIndex.from_arrays([symbol_column, np.concatenate([bars.time for _, bars in windows])],
+                                          names=['symbol', 'time'])
+        return pd.DataFrame({field: np.concatenate([bars[field] for _, bars in windows]) for field in fields}, index=index)
+
+    def history_bars(self, bar_type, symbols, periods, resolution=None):
+        # List of TradeBar (or QuoteBar) objects, oldest first
+        symbols = [symbols] if isinstance(symbols, (Symbol, str)) else list(symbols)
+        history = []
+        for symbol in (self.resolve(symbol) for symbol in symbols):
+            bars, bar_resolution = self.history_window(symbol, periods, resolution)
+            history.extend(self.bar_objects(bar_type, symbol, bars, RESOLUTION_PERIODS[bar_resolution]))
+        if len(symbols) > 1:
+            history.sort(key=lambda bar: bar.EndTime)
+        return history
+
+    def bar_objects(self, bar_type, symbol, bars, period):
+        end_times = pd.DatetimeIndex(bars.time).to_pydatetime()
+        if bar_type is QuoteBar:
+            return [QuoteBar(end - period, symbol, Bar(bid, bid, bid, bid), Bar(ask, ask, ask, ask), period)
+                    for end, bid, ask in zip(end_times, bars['bidclose'].tolist(), bars['askclose'].tolist())
+                    if bid == bid and ask == ask]
+        return [TradeBar(end - period, symbol, open, high, low, close, volume, period)
+                for end, open, high, low, close, volume in zip(end_times, bars['open'].tolist(), bars['high'].tolist(),
+                                                                bars['low'].tolist(), bars['close'].tolist(),
+                                                                bars['volume'].tolist())
+                if close == close]
+
+    def last_known_prices(self, symbol):
+        symbol = self.resolve(symbol)
+        bars, resolution = self.history_window(symbol, 1, Resolution.Minute)
+        if not len(bars):
+            return []
+        period = RESOLUTION_PERIODS[resolution]
+        return self.bar_objects(TradeBar, symbol, bars, period) + self.bar_objects(QuoteBar, symbol, bars, period)
+
+    # endregion
+
+    # region Orders
+
+    def submit_order(self, symbol, quantity, order_type, tag='', stop_price=None, limit_price=None):
+        algorithm = self.algorithm
+        security = algorithm.Securities[symbol]
+        self.promote(security)
+        order = Order(next(self.order_ids), security.Symbol, quantity, order_type, algorithm.Time, tag, stop_price, limit_price)
+        self.orders[order.Id] = order
+        ticket = OrderTicket(self, order)
+
+        # Orders failing the pre-order checks never reach the brokerage, so they get no order events
+        error = None
+        if algorithm.IsWarmingUp:
+            error = "This order was not sent because the algorithm is warming up"
+        elif quantity == 0:
+            error = f"Unable to submit order with zero quantity: {security.Symbol}"
+        elif not security.HasData or not security.Price:
+            error = f"Order Error: no price data for {security.Symbol}"
+        if error is not None:
+            order.Status = OrderStatus.Invalid
+            self.log('ERROR', error)
+            return ticket
+
+        order.Status = OrderStatus.Submitted
+        self.emit(order, OrderStatus.Submitted)
+        if order_type == OrderType.Market:
+            self.fill(order, self.market_fill_price(security, quantity))
+        else:
+            self.open_orders[order.Id] = order
+        return ticket
+
+    def market_fill_price(self, security, quantity):
+        price = security.AskPrice if quantity > 0 else security.BidPrice
+        if not price or price != price:
+            price = security.Price
+        return price
+
+    def fill(self, order, price):
+        algorithm = self.algorithm
+        portfolio = algorithm.Portfolio
+        security = algorithm.Securities[order.Symbol]
+        holdings = security.Holdings
+        quantity = order.Quantity
+
+        # Orders that add exposure need the margin for it
+        new_quantity = holdings.Quantity + quantity
+        if abs(new_quantity) > abs(holdings.Quantity):
+            margin = portfolio.TotalMarginUsed + (abs(new_quantity) - abs(holdings.Quantity)) * security.BuyingPowerModel.unit_margin(security)
+            if margin > portfolio.TotalPortfolioValue:
+                order.Status = OrderStatus.Invalid
+                self.open_orders.pop(order.Id, None)
+                self.emit(order, OrderStatus.Invalid, message=f"Insufficient buying power to complete order (Value:{abs(quantity) * price}), Order Id: {order.Id}")
+                return False
+
+        fee = security.FeeModel.GetOrderFee(OrderFeeParameters(security, order))
+        holdings.fill(quantity, price)
+        holdings.TotalFees += fee.Value.Amount
+        portfolio.Cash -= quantity * price * security.SymbolProperties.ContractMultiplier + fee.Value.Amount
+        portfolio.TotalFeesPaid += fee.Value.Amount
+        portfolio.update_held(security)
+
+        order.Status = OrderStatus.Filled
+        order.Price = price
+        order.QuantityFilled = quantity
+        self.open_orders.pop(order.Id, None)
+        self.emit(order, OrderStatus.Filled, price, quantity, fee)
+        return True
+
+    def fill_open_orders(self, now):
+        # Stop and limit orders are checked against the bars of this step, from the bar after the one they were placed on
+        for order in list(self.open_orders.values()):
+            if order.Status in CLOSED_ORDER_STATUSES:
+                continue
+            bar = self.algorithm.Securities[order.Symbol].last_bar
+            if bar is None or bar.EndTime != now or bar.EndTime <= order.Time:
+                continue
+            price = self.trigger_price(order, bar)
+            if price is not None:
+                self.fill(order, price)
+
+    def trigger_price(self, order, bar):
+        if order.Type == OrderType.StopMarket:
+            if order.Quantity < 0 and bar.Low < order.StopPrice:
+                return min(order.StopPrice, bar.Close)
+            if order.Quantity > 0 and bar.High > order.StopPrice:
+                return max(order.StopPrice, bar.Close)
+        elif order.Type == OrderType.Limit:
+            if order.Quantity > 0 and bar.Low < order.LimitPrice:
+                return min(bar.High, order.LimitPrice)
+            if order.Quantity < 0 and bar.High > order.LimitPrice:
+                return max(bar.Low, order.LimitPrice)
+        return None
+
+    def update_order(self, order, stop_price=None, limit_price=None, tag=None):
+        if order.Status in CLOSED_ORDER_STATUSES:
+            return OrderResponse(order.Id, False, f"Unable to update order with id {order.Id}: order is closed")
+        if stop_price is not None:
+            order.StopPrice = stop_price
+        if limit_price is not None:
+            order.LimitPrice = limit_price
+        if tag is not None:
+            order.Tag = tag
+        order.Status = OrderStatus.UpdateSubmitted
+        self.emit(order, OrderStatus.UpdateSubmitted)
+        return OrderResponse(order.Id, True)
+
+    def cancel_order(self, order, tag=None):
+        if order.Status in CLOSED_ORDER_STATUSES:
+            return OrderResponse(order.Id, False, f"Unable to cancel order with id {order.Id}: order is closed")
+        if tag is not None:
+            order.Tag = tag
+        order.Status = OrderStatus.Canceled
+        self.open_orders.pop(order.Id, None)
+        self.emit(order, OrderStatus.Canceled)
+        return OrderResponse(order.Id, True)
+
+    def has_open_orders(self, symbol):
+        return any(order.Symbol == symbol for order in self.open_orders.values())
+
+    def liquidate(self, symbol=None, tag='Liquidated'):
+        portfolio = self.algorithm.Portfolio
+        if symbol is None:
+            symbols = set(portfolio.held) | {order.Symbol for order in self.open_orders.values()}
+        else:
+            symbols = [self.resolve(symbol)]
+        order_ids = []
+        for symbol in symbols:
+            for order in [order for order in self.open_orders.values() if order.Symbol == symbol]:
+                self.cancel_order(order)
+            quantity = portfolio[symbol].Quantity
+            if quantity:
+                order_ids.append(self.submit_order(symbol, -quantity, OrderType.Market, tag).OrderId)
+        return order_ids
+
+    def order_quantity(self, symbol, target):
+        # Quantity that moves the holdings to `target`: a share of the portfolio value, less the free portfolio value.
+        # For futures the share is of the margin, like LEAN sizes them; for everything else it's of the notional.
+        algorithm = self.algorithm
+        security = algorithm.Securities[symbol]
+        if not security.Price:
+            return 0
+        portfolio_value = algorithm.Portfolio.TotalPortfolioValue - algorithm.Settings.FreePortfolioValue
+        if isinstance(security.BuyingPowerModel, FutureMarginModel):
+            unit_value = security.BuyingPowerModel.unit_margin(security)
+        else:
+            unit_value = security.Price * security.SymbolProperties.ContractMultiplier
+        if unit_value <= 0:
+            return 0
+        lot_size = security.SymbolProperties.LotSize
+        target_quantity = int(target * portfolio_value / unit_value / lot_size) * lot_size
+        return target_quantity - security.Holdings.Quantity
+
+    def emit(self, order, status, fill_price=0.0, fill_quantity=0, fee=None, message=''):
+        # Events raised while OnOrderEvent runs are queued and dispatched after it returns
+        self.order_events.append(OrderEvent(order, self.algorithm.Time, status, fill_price, fill_quantity, fee, message))
+        if self.dispatching:
+            return
+        self.dispatching = True
+        try:
+            while self.order_events:
+                self.algorithm.OnOrderEvent(self.order_events.popleft())
+        finally:
+            self.dispatching = False
+
+    def expire_options(self, day):
+        # Held contracts that expired are cash settled at their intrinsic value, then every expired contract's data ends
+        securities = self.algorithm.Securities
+        for symbol, security in list(self.algorithm.Portfolio.held.items()):
+            expiry = symbol.ID.Date
+            if symbol.SecurityType not in OPTION_TYPES or expiry is None or expiry.date() >= day:
+                continue
+            for order in [order for order in self.open_orders.values() if order.Symbol == symbol]:
+                self.cancel_order(order)
+            underlying_price = securities[symbol.Underlying].Price
+            strike = symbol.ID.StrikePrice
+            intrinsic = max(underlying_price - strike, 0) if symbol.ID.OptionRight == OptionRight.Call else max(strike - underlying_price, 0)
+            order = Order(next(self.order_ids), symbol, -security.Holdings.Quantity, OrderType.OptionExercise,
+                          self.algorithm.Time, 'Automatic Exercise' if intrinsic else 'Option Expired')
+            self.orders[order.Id] = order
+            self.fill(order, intrinsic)
+        for symbol in [symbol for symbol in self.feeds if symbol.SecurityType in OPTION_TYPES]:
+            if symbol.ID.Date is not None and symbol.ID.Date.date() < day:
+                self.unsubscribe(symbol)
+
+    # endregion
+
+    # region Scheduling
+
+    def schedule(self, date_rule, time_rule, callback):
+        self.schedules.append((date_rule, time_rule, callback))
+        if self.day is not None:
+            self.schedule_day(self.day, [(date_rule, time_rule, callback)], after=self.algorithm.Time)
+
+    def calendar(self, symbol):
+        # Sorted trading days of `symbol` (the days its data has bars on); weekdays when there's no symbol or data
+        if symbol is not None:
+            key = self.data_key(self.resolve(symbol))
+            days = self.calendars.get(key)
+            if days is None:
+                days = self.calendars[key] = self.source.trading_days(key)
+            if days:
+                return days
+        return None
+
+    def is_trading_day(self, symbol, day):
+        days = self.calendar(symbol)
+        if days is None:
+            return day.weekday() < 5
+        i = bisect_left(days, day)
+        return i < len(days) and days[i] == day
+
+    def schedule_day(self, day, schedules=None, after=None):
+        for date_rule, time_rule, callback in self.schedules if schedules is None else schedules:
+            days = self.calendar(date_rule.symbol)
+            if days is None:
+                days = [day + timedelta(days=offset) for offset in range(-7, 8) if (day + timedelta(days=offset)).weekday() < 5]
+            i = bisect_left(days, day)
+            if i == len(days) or days[i] != day or not date_rule.selects(day, days, i):
+                continue
+            if time_rule.symbol is not None and not self.is_trading_day(time_rule.symbol, day):
+                continue
+            for event_time in time_rule.times(day):
+                if after is None or event_time > after:
+                    heapq.heappush(self.scheduled_events, (event_time, next(self.event_sequence), callback))
+
+    def fire_events(self, until, inclusive=True):
+        # Each event runs with the algorithm time set to its scheduled time
+        events = self.scheduled_events
+        while events and (events[0][0] <= until if inclusive else events[0][0] < until):
+            event_time, _, callback = heapq.heappop(events)
+            self.algorithm.Time = event_time
+            callback()
+        self.algorithm.Time = until
+
+    # endregion
+
+    # region Event loop
+
+    def run(self):
+        self.begin()
+        self.advance()
+        return self.finish()
+
+    def begin(self):
+        # Subscribes the securities added in Initialize, from the start of the warm-up
+        algorithm = self.algorithm
+        if self.start is None:
+            raise ValueError("No start date: call SetStartDate in Initialize or pass a start date")
+        warm_up_start = self.start - self.warm_up if self.warm_up else self.start
+        algorithm.IsWarmingUp = warm_up_start < self.start
+        algorithm.Settings.FreePortfolioValue = algorithm.Portfolio.TotalPortfolioValue * algorithm.Settings.FreePortfolioValuePercentage
+        self.running = True
+        for security in self.pending_securities:
+            self.create_feed(security, warm_up_start)
+        self.pending_securities = []
+        return self
+
+    def advance(self, until=None):
+        # Steps through the bars that end no later than `until` (all of them by default), so a run can be stopped and
+        # inspected, e.g. to benchmark callbacks from a known state
+        heap = self.heap
+        until = None if until is None else int(np.datetime64(until, 'ns').astype('int64'))
+        while heap and (until is None or heap[0][0] <= until):
+            now = heap[0][0]
+            feeds = []
+            while heap and heap[0][0] == now:
+                feed = heapq.heappop(heap)[2]
+                if feed.active:
+                    feeds.append(feed)
+            if not feeds:
+                continue
+            self.step(now, feeds)
+            for feed in feeds:
+                if feed.active and not feed.done:
+                    heapq.heappush(heap, (feed.times[feed.index], next(self.feed_sequence), feed))
+                elif feed.done:
+                    self.feeds.pop(feed.symbol, None)
+        return self
+
+    def finish(self):
+        if self.day is not None:
+            self.fire_events(datetime.combine(self.day, time()) + timedelta(days=1), inclusive=False)
+            self.end_of_day()
+        self.algorithm.OnEndOfAlgorithm()
+        self.running = False
+        return self
+
+    def step(self, now, feeds):
+        self.clock = now
+        now = to_datetime(now)
+        if now.date() != self.day:
+            self.new_day(now.date())
+        algorithm = self.algorithm
+        self.time = algorithm.Time = now
+        if algorithm.IsWarmingUp and now >= self.start:
+            algorithm.IsWarmingUp = False
+            algorithm.OnWarmupFinished()
+
+        data = Slice(now)
+        for feed in feeds:
+            trade_bar, quote_bar, mapped = feed.read(now)
+            security = feed.security
+            security.update_prices(trade_bar, quote_bar)
+            self.symbols_with_data.add(feed.symbol)
+            if trade_bar is not None:
+                data.Bars[feed.symbol] = trade_bar
+            if quote_bar is not None:
+                data.QuoteBars[feed.symbol] = quote_bar
+            if feed.symbol.SecurityType == SecurityType.Future:
+                self.update_contracts(security, mapped, trade_bar, quote_bar, data)
+
+        self.fill_open_orders(now)
+        self.fire_events(now)
+
+        for symbol, bar in data.Bars.items():
+            for consolidator in self.consolidators.get(symbol, ()):
+                consolidator.Update(bar)
+        for consolidator in self.all_consolidators:
+            consolidator.Scan(now)
+
+        for option in self.option_subscriptions:
+            chain = self.option_chain(option)
+            if chain is not None:
+                data.OptionChains[option.Symbol] = chain
+
+        self.flush_security_changes()
+        self.slice = data
+        algorithm.OnData(data)
+
+    def update_contracts(self, future, mapped, trade_bar, quote_bar, data):
+        # Remap the continuous future, and price its mapped contract and the contracts still in use with its bars
+        if mapped is not None and mapped != future.Mapped.Value:
+            old_symbol = future.Mapped
+            future.Mapped = self.contract(future, mapped)
+            data.SymbolChangedEvents[future.Symbol] = SymbolChangedEvent(future.Symbol, old_symbol, future.Mapped)
+        securities = self.algorithm.Securities
+        for symbol in self.contracts[future.Symbol]:
+            security = securities[symbol]
+            if symbol != future.Mapped and not security.Invested and not self.has_open_orders(symbol):
+                continue
+            contract_trade_bar = contract_quote_bar = None
+            if trade_bar is not None:
+                contract_trade_bar = data.Bars[symbol] = TradeBar(trade_bar.Time, symbol, trade_bar.Open, trade_bar.High,
+                                                                  trade_bar.Low, trade_bar.Close, trade_bar.Volume,
+                                                                  trade_bar.Period)
+            if quote_bar is not None:
+                contract_quote_bar = data.QuoteBars[symbol] = QuoteBar(quote_bar.Time, symbol, quote_bar.Bid, quote_bar.Ask, quote_bar.Period)
+            security.update_prices(contract_trade_bar, contract_quote_bar)
+
+    def new_day(self, day):
+        # Close the previous day (its remaining events, the daily consolidators and OnEndOfDay), then set up this one
+        midnight = datetime.combine(day, time())
+        if self.day is not None:
+            self.fire_events(midnight, inclusive=False)
+            for consolidator in self.all_consolidators:
+                consolidator.Scan(midnight)
+            self.end_of_day()
+        self.day = day
+        self.time = self.algorithm.Time = midnight
+        self.expire_options(day)
+        self.select_universes(day)
+        self.schedule_day(day)
+
+    def end_of_day(self):
+        algorithm = self.algorithm
+        if algorithm.IsWarmingUp:
+            self.symbols_with_data.clear()
+            return
+        if self.end_of_day_takes_symbol:
+            for symbol in list(self.symbols_with_data):
+                algorithm.OnEndOfDay(symbol)
+        else:
+            algorithm.OnEndOfDay()
+        self.symbols_with_data.clear()
+        self.equity.append((self.day, algorithm.Portfolio.TotalPortfolioValue))
+
+    def flush_security_changes(self):
+        if self.added or self.removed:
+            changes = SecurityChanges(self.added, self.removed)
+            self.added, self.removed = [], []
+            self.algorithm.OnSecuritiesChanged(changes)
+
+    # endregion
+
+    # region Output
+
+    def log(self, level, message):
+        self.logs.append((self.algorithm.Time, level, message))
+        if not self.quiet:
+            print(f"{self.algorithm.Time} {level} {message}")
+
+    def plot(self, chart, series, value):
+        self.charts.setdefault(chart, {}).setdefault(series, []).append((self.algorithm.Time, value))
+
+    def statistics(self):
+        equity = pd.Series([value for _, value in self.equity], index=[day for day, _ in self.equity], dtype=float)
+        returns = equity.pct_change().dropna()
+        filled = [order for order in self.orders.values() if order.Status == OrderStatus.Filled]
+        return {
+            'start': str(self.start),
+            'end': str(equity.index[-1]) if len(equity) else None,
+            'final_portfolio_value': float(self.algorithm.Portfolio.TotalPortfolioValue),
+            'total_return': float(equity.iloc[-1] / equity.iloc[0] - 1) if len(equity) else 0.0,
+            'sharpe': float(np.sqrt(252) * returns.mean() / returns.std()) if len(returns) > 1 and returns.std() > 0 else None,
+            'max_drawdown': float((1 - equity / equity.cummax()).max()) if len(equity) else 0.0,
+            'orders_filled': len(filled),
+            'fees': float(self.algorithm.Portfolio.TotalFeesPaid)
+        }
+
+    # endregion
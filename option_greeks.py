@@ -0,0 +1,122 @@
+# Black-Scholes-Merton prices, greeks and implied volatilities for whole option chains at once
+#
+# Every function takes NumPy arrays (or scalars that broadcast against them), so a chain of strikes is priced with a
+# handful of array operations instead of a Python loop over contracts. `is_call` is a boolean array (or scalar).
+# Options on futures use the Black-76 model, which is the same formulas with the futures price as `spot` and
+# `dividend_yield` equal to `rate`; `black76_*` are shorthands for that.
+#
+# Example:
+#   strikes = np.array([float(c.Strike) for c in calls])
+#   mids = np.array([(float(c.BidPrice) + float(c.AskPrice)) / 2 for c in calls])
+#   sigma = implied_volatility(mids, underlying_price, strikes, time_to_expiry, rate, dividend_yield, True)
+#   deltas = delta(underlying_price, strikes, time_to_expiry, rate, dividend_yield, sigma, True)
+#   contract = calls[nearest(deltas, 0.25)]
+
+import numpy as np
+from scipy.special import ndtr
+
+# 1 / sqrt(2 * pi)
+INV_SQRT_2PI = 0.3989422804014327
+
+
+def norm_pdf(x):
+    return INV_SQRT_2PI * np.exp(-0.5 * x * x)
+
+
+def d1_d2(spot, strike, time_to_expiry, rate, dividend_yield, sigma):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_sqrt_t = sigma * np.sqrt(time_to_expiry)
+        d1 = (np.log(spot / strike) + (rate - dividend_yield + 0.5 * sigma * sigma) * time_to_expiry) / sigma_sqrt_t
+    return d1, d1 - sigma_sqrt_t
+
+
+def price(spot, strike, time_to_expiry, rate, dividend_yield, sigma, is_call):
+    d1, d2 = d1_d2(spot, strike, time_to_expiry, rate, dividend_yield, sigma)
+    discounted_spot = spot * np.exp(-dividend_yield * time_to_expiry)
+    discounted_strike = strike * np.exp(-rate * time_to_expiry)
+    call = discounted_spot * ndtr(d1) - discounted_strike * ndtr(d2)
+    put = discounted_strike * ndtr(-d2) - discounted_spot * ndtr(-d1)
+    return np.where(is_call, call, put)
+
+
+def delta(spot, strike, time_to_expiry, rate, dividend_yield, sigma, is_call):
+    d1, _ = d1_d2(spot, strike, time_to_expiry, rate, dividend_yield, sigma)
+    carry = np.exp(-dividend_yield * time_to_expiry)
+    return np.where(is_call, carry * ndtr(d1), carry * (ndtr(d1) - 1))
+
+
+def gamma(spot, strike, time_to_expiry, rate, dividend_yield, sigma):
+    d1, _ = d1_d2(spot, strike, time_to_expiry, rate, dividend_yield, sigma)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.exp(-dividend_yield * time_to_expiry) * norm_pdf(d1) / (spot * sigma * np.sqrt(time_to_expiry))
+
+
+def vega(spot, strike, time_to_expiry, rate, dividend_yield, sigma):
+    # Per 1.00 change in volatility
+    d1, _ = d1_d2(spot, strike, time_to_expiry, rate, dividend_yield, sigma)
+    return spot * np.exp(-dividend_yield * time_to_expiry) * norm_pdf(d1) * np.sqrt(time_to_expiry)
+
+
+def greeks(spot, strike, time_to_expiry, rate, dividend_yield, sigma, is_call):
+    # Delta, gamma and vega from one d1 computation
+    d1, _ = d1_d2(spot, strike, time_to_expiry, rate, dividend_yield, sigma)
+    carry = np.exp(-dividend_yield * time_to_expiry)
+    density = norm_pdf(d1)
+    sqrt_t = np.sqrt(time_to_expiry)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'delta': np.where(is_call, carry * ndtr(d1), carry * (ndtr(d1) - 1)),
+            'gamma': carry * density / (spot * sigma * sqrt_t),
+            'vega': spot * carry * density * sqrt_t
+        }
+
+
+def implied_volatility(option_price, spot, strike, time_to_expiry, rate, dividend_yield, is_call,
+                       lower=1e-4, upper=5.0, tolerance=1e-8, max_iterations=50):
+    # Newton steps safeguarded by a bisection bracket, run on the whole chain at once. Prices outside the no-arbitrage
+    # bounds (or with no time left) have no implied volatility and give NaN.
+    option_price, spot, strike, time_to_expiry, rate, dividend_yield, is_call = np.broadcast_arrays(
+        *(np.asarray(value, dtype=float) for value in (option_price, spot, strike, time_to_expiry, rate, dividend_yield)),
+        np.asarray(is_call, dtype=bool))
+    low = np.full(option_price.shape, lower)
+    high = np.full(option_price.shape, upper)
+    low_price = price(spot, strike, time_to_expiry, rate, dividend_yield, low, is_call)
+    high_price = price(spot, strike, time_to_expiry, rate, dividend_yield, high, is_call)
+    valid = (time_to_expiry > 0) & (option_price >= low_price) & (option_price <= high_price)
+
+    sigma = np.where(valid, 0.5 * (low + high), np.nan)
+    active = valid.copy()
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        error = price(spot, strike, time_to_expiry, rate, dividend_yield, sigma, is_call) - option_price
+        active &= np.abs(error) > tolerance
+
+        # Shrink the bracket, then take the Newton step if it stays inside it and bisect otherwise
+        high = np.where(active & (error > 0), sigma, high)
+        low = np.where(active & (error < 0), sigma, low)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            newton = sigma - error / vega(spot, strike, time_to_expiry, rate, dividend_yield, sigma)
+        step = np.where((newton > low) & (newton < high), newton, 0.5 * (low + high))
+        sigma = np.where(active, step, sigma)
+    return sigma
+
+
+def black76_price(futures_price, strike, time_to_expiry, rate, sigma, is_call):
+    return price(futures_price, strike, time_to_expiry, rate, rate, sigma, is_call)
+
+
+def black76_delta(futures_price, strike, time_to_expiry, rate, sigma, is_call):
+    return delta(futures_price, strike, time_to_expiry, rate, rate, sigma, is_call)
+
+
+def black76_implied_volatility(option_price, futures_price, strike, time_to_expiry, rate, is_call, **kwargs):
+    return implied_volatility(option_price, futures_price, strike, time_to_expiry, rate, rate, is_call, **kwargs)
+
+
+def nearest(values, target):
+    # Index of the value closest to `target`, ignoring NaNs; None if every value is NaN
+    distance = np.abs(np.asarray(values, dtype=float) - target)
+    if np.isnan(distance).all():
+        return None
+    return int(np.nanargmin(distance))
@@ -1,19 +1,36 @@
 # region imports
 from AlgorithmImports import *
+import numpy as np
+from option_greeks import delta, nearest
+from instrumentation import Instrumentation, instrumented
+from telemetry import Telemetry
 # endregion
 
 class SwimmingBlackTermite(QCAlgorithm):
 
+    # Order statuses after which a ticket receives no more order events
+    CLOSED_ORDER_STATUSES = (OrderStatus.Filled, OrderStatus.Canceled, OrderStatus.Invalid)
+
     def Initialize(self):
         self.SetStartDate(2020, 1, 1)
         self.SetEndDate(2022, 12, 1)
         self.SetCash(100000)
 
+        # Opt-in timing of the callbacks (see instrumentation.py), with the parameter instrumentation=on
+        self.instrumentation = Instrumentation(self, enabled=self.GetParameter('instrumentation') == 'on')
+
+        # Log/Debug/Plot go through a buffered sink (see telemetry.py), which formats them off the algorithm thread in live
+        # mode and there limits the contract selection messages to 20 a day
+        self.telemetry = Telemetry(self, limits={'contract selection': (20, timedelta(days=1))})
+
         bar_size = timedelta(hours=1)
         trailing_stop_pct = 0.1
 
         self.SetSecurityInitializer(BrokerageModelSecurityInitializer(self.BrokerageModel, FuncSecuritySeeder(self.GetLastKnownPrices)))
 
+        self.owner_by_order_id = {}
+        self.option_chain_cache = OptionChainCache(self)
+        self.option_subscriptions = OptionSubscriptionManager(self)
         self.symbol_data_by_asset = {}
         tickers = ['SPY', 'QQQ']
         for ticker in tickers:
@@ -22,25 +39,42 @@ class SwimmingBlackTermite(QCAlgorithm):
 
         self.SetWarmUp(timedelta(days=100))
 
+    @instrumented
     def OnData(self, data: Slice):
         for symbol_data in self.symbol_data_by_asset.values():
-            ids_to_remove = []
-            for i, trade in enumerate(symbol_data.trade_collection):
-                trade.scan(data)
-                if trade.completed:
-                    ids_to_remove.append(i)
-
-            # Remove completed trades
-            for id_ in ids_to_remove[::-1]:
-                del symbol_data.trade_collection[id_]
+            symbol_data.scan(data)
         
+    @instrumented
     def OnOrderEvent(self, orderEvent: OrderEvent) -> None:
+        # Only stop loss tickets are registered; entry and exit market orders have no owner
+        trade = self.owner_by_order_id.get(orderEvent.OrderId)
+        if trade is None:
+            return
+        if orderEvent.Status in self.CLOSED_ORDER_STATUSES:
+            del self.owner_by_order_id[orderEvent.OrderId]
+        self.route_order_event(trade, orderEvent)
+
+    def route_order_event(self, trade, orderEvent):
         security = self.Securities[orderEvent.Symbol.Underlying]
-        self.symbol_data_by_asset[security].on_order_event(orderEvent)
+        self.symbol_data_by_asset[security].on_order_event(trade, orderEvent)
+
+    def register_ticket(self, ticket, owner):
+        # Route the order events of `ticket` to `owner` until the order is closed. A ticket that is already closed (a
+        # stop that filled on submission) raised its events before it had an owner, so the owner gets the ticket itself,
+        # which carries the OrderId, Symbol and final Status of its last order event.
+        if ticket.Status in self.CLOSED_ORDER_STATUSES:
+            self.route_order_event(owner, ticket)
+        else:
+            self.owner_by_order_id[ticket.OrderId] = owner
     
     def OnEndOfDay(self, symbol):
         for symbol_data in self.symbol_data_by_asset.values():
-            self.Plot("Open Trades", "Count", len(symbol_data.trade_collection))
+            self.telemetry.plot("Open Trades", "Count", len(symbol_data.trade_book))
+        self.telemetry.plot("Option Subscriptions", "Count", len(self.option_subscriptions))
+
+    def OnEndOfAlgorithm(self):
+        self.telemetry.close()
+        self.instrumentation.dump()
 
         
 
@@ -54,10 +88,14 @@ class SymbolData:
         self.PUT_BB_THRESHOLD = 0.9
         self.ENTRY_DAYS = [0, 1, 2] # Monday - Wednesday
         self.TRADE_WEIGHT = 0.03 # Percentage of portfolio
+        self.TARGET_DELTA = None # |delta| of the contract to buy (e.g. 0.4); None buys the ATM contract
 
         # Create indicators
         self.ema = algorithm.EMA(security.Symbol, 20, Resolution.Daily)
         self.bb = algorithm.BB(security.Symbol, 20, 2, Resolution.Daily)
+        if self.TARGET_DELTA is not None:
+            # Annualized below; used as the volatility of every contract when computing deltas
+            self.volatility = IndicatorExtensions.Of(StandardDeviation(20), algorithm.LOGR(security.Symbol, 1, Resolution.Daily))
 
         # Add consolidator to create n-minute bars
         self.consolidator = TradeBarConsolidator(bar_size)
@@ -69,8 +107,9 @@ class SymbolData:
         self.trailing_closes = RollingWindow[float](3)
 
         # Define a collection to manage the independent trades
-        self.trade_collection = []
+        self.trade_book = TradeBook()
 
+    @instrumented
     def consolidation_handler(self, sender: object, consolidated_bar: TradeBar) -> None:
         # Update trialing history
         self.trailing_ema.Add(self.ema.Current.Value)
@@ -81,7 +120,8 @@ class SymbolData:
             return
         
         if self.algorithm.LiveMode:
-            self.algorithm.Log(f"Trailing EMAs: {list(self.trailing_ema)}; Trailing closes: {list(self.trailing_closes)}")
+            self.algorithm.telemetry.log('trailing windows', "Trailing EMAs: {}; Trailing closes: {}",
+                                         values=lambda: (list(self.trailing_ema), list(self.trailing_closes)))
 
         if not self.should_trade:
             return
@@ -101,7 +141,7 @@ class SymbolData:
             and self.trailing_closes[0] > self.trailing_ema[0] \
             and bb_location <= self.CALL_BB_THRESHOLD:
             # Enter LONG position
-            self.trade_collection.append(Trade(self.algorithm, self.security, OrderDirection.Buy, self.trailing_stop_pct, self.TRADE_WEIGHT))
+            self.add_trade(Trade(self.algorithm, self.security, OrderDirection.Buy, self.trailing_stop_pct, self.TRADE_WEIGHT, self.target_delta, self.annualized_volatility))
         
         # Check for SHORT entry condition; EMA signal: 1 close above EMA and then 2 closes below EMA; BB signal: within top 10% of BB
         elif self.trailing_closes[2] > self.trailing_ema[2] \
@@ -109,31 +149,229 @@ class SymbolData:
             and self.trailing_closes[0] < self.trailing_ema[0] \
             and bb_location >= self.PUT_BB_THRESHOLD:
             # Enter SHORT position
-            self.trade_collection.append(Trade(self.algorithm, self.security, OrderDirection.Sell, self.trailing_stop_pct, self.TRADE_WEIGHT))
+            self.add_trade(Trade(self.algorithm, self.security, OrderDirection.Sell, self.trailing_stop_pct, self.TRADE_WEIGHT, -self.target_delta if self.target_delta is not None else None, self.annualized_volatility))
 
         
 
+    @property
+    def target_delta(self):
+        # Delta targeting needs a volatility; until it is ready, trades fall back to the ATM contract
+        if self.TARGET_DELTA is None or not self.volatility.IsReady:
+            return None
+        return self.TARGET_DELTA
+
+    @property
+    def annualized_volatility(self):
+        if self.TARGET_DELTA is None or not self.volatility.IsReady:
+            return None
+        return self.volatility.Current.Value * np.sqrt(252)
+
     @property
     def should_trade(self):
-        return len(self.trade_collection) < int(1 / self.TRADE_WEIGHT)
+        return len(self.trade_book) < int(1 / self.TRADE_WEIGHT)
+
+    def add_trade(self, trade):
+        if not trade.completed:
+            self.trade_book.add(trade)
+
+    def scan(self, data: Slice):
+        # If it's Friday 10 AM EST and we have open positions, close them
+        if len(self.trade_book) and data.Time.weekday() == Trade.EXIT_DAY and data.Time.time() >= Trade.EXIT_TIME:
+            for trade in self.trade_book:
+                trade.close(data.Time)
+                self.trade_book.remove(trade)
+            return
+
+        # Update the trailing stop losses
+        self.trade_book.update(data)
+
+    def on_order_event(self, trade, orderEvent: OrderEvent) -> None:
+        trade.on_order_event(orderEvent)
+        if trade.completed and trade.book_key is not None:
+            self.trade_book.remove(trade)
+
+
+class TradeBook:
+    def __init__(self):
+        # Open trades grouped by (contract, direction) so each quote updates a whole group at once
+        self.groups = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # Iterate over a snapshot so trades can be removed while iterating
+        for group in list(self.groups.values()):
+            yield from list(group.trades)
+
+    def add(self, trade):
+        key = (trade.contract_symbol, trade.order_direction)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = TradeGroup(trade.contract_symbol)
+        group.add(trade)
+        trade.book_key = key
+        self.count += 1
+
+    def remove(self, trade):
+        group = self.groups[trade.book_key]
+        group.remove(trade)
+        if not group.trades:
+            del self.groups[trade.book_key]
+        trade.book_key = None
+        self.count -= 1
+
+    def update(self, data: Slice):
+        # Calls and puts are both held long, so every group trails the bid
+        for group in self.groups.values():
+            if group.contract_symbol in data.QuoteBars:
+                group.update(data.QuoteBars[group.contract_symbol].Bid.Close)
+
+
+class TradeGroup:
+    def __init__(self, contract_symbol, capacity=8):
+        self.contract_symbol = contract_symbol
+        self.trades = []
+        self.high_water_marks = np.empty(capacity)
+        self.stop_prices = np.empty(capacity)
+
+    def add(self, trade):
+        slot = len(self.trades)
+        if slot == len(self.high_water_marks):
+            self.high_water_marks = np.resize(self.high_water_marks, 2 * slot)
+            self.stop_prices = np.resize(self.stop_prices, 2 * slot)
+        self.trades.append(trade)
+        self.high_water_marks[slot] = trade.high_water_mark
+        self.stop_prices[slot] = trade.stop_price
+        trade.book_slot = slot
+
+    def remove(self, trade):
+        # Swap the last trade into the freed slot so removal is O(1)
+        slot = trade.book_slot
+        last_slot = len(self.trades) - 1
+        last_trade = self.trades.pop()
+        if slot != last_slot:
+            self.trades[slot] = last_trade
+            self.high_water_marks[slot] = self.high_water_marks[last_slot]
+            self.stop_prices[slot] = self.stop_prices[last_slot]
+            last_trade.book_slot = slot
+        trade.book_slot = None
+
+    def update(self, current_price):
+        high_water_marks = self.high_water_marks[:len(self.trades)]
+        moved = high_water_marks < current_price
+        if not moved.any():
+            return
+        high_water_marks[moved] = current_price
+
+        # Every trade that moved now shares the same high-water mark, so they share the same stop price. Only the
+        # tickets whose rounded stop level actually changes are updated.
+        stop_price = self.trades[0].get_stop_loss_price(current_price)
+        stop_prices = self.stop_prices[:len(self.trades)]
+        for slot in np.flatnonzero(moved & (stop_prices != stop_price)):
+            stop_prices[slot] = stop_price
+            self.trades[slot].stop_loss_ticket.UpdateStopPrice(stop_price)
 
-    def on_order_event(self, orderEvent: OrderEvent) -> None:
-        for trade in self.trade_collection:
-            trade.on_order_event(orderEvent)
+
+class OptionChainCache:
+    def __init__(self, algorithm):
+        # The contract list of every underlying is loaded at most once per day and indexed by (expiry, right), with the
+        # contracts of each index entry sorted by strike so the ATM contract is a binary search
+        self.algorithm = algorithm
+        self.chains = {}
+
+    def get(self, underlying_symbol):
+        current_date = self.algorithm.Time.date()
+        chain = self.chains.get(underlying_symbol)
+        if chain is None or chain[0] != current_date:
+            chain = self.chains[underlying_symbol] = (current_date, self.load(underlying_symbol))
+        return chain[1]
+
+    @instrumented
+    def load(self, underlying_symbol):
+        contracts_by_key = {}
+        for contract_symbol in self.algorithm.OptionChainProvider.GetOptionContractList(underlying_symbol, self.algorithm.Time):
+            contracts_by_key.setdefault((contract_symbol.ID.Date, contract_symbol.ID.OptionRight), []).append(contract_symbol)
+
+        index = {}
+        for key, contract_symbols in contracts_by_key.items():
+            contract_symbols.sort(key=lambda contract_symbol: contract_symbol.ID.StrikePrice)
+            strikes = np.array([float(contract_symbol.ID.StrikePrice) for contract_symbol in contract_symbols])
+            index[key] = (strikes, contract_symbols)
+        return index
+
+    def is_empty(self, underlying_symbol):
+        return len(self.get(underlying_symbol)) == 0
+
+    def expiries(self, underlying_symbol, option_right):
+        return sorted(expiry for expiry, right in self.get(underlying_symbol) if right == option_right)
+
+    def contracts(self, underlying_symbol, expiry, option_right):
+        # (strikes, contract symbols) sorted by strike, or None if there is no such expiry
+        return self.get(underlying_symbol).get((expiry, option_right))
+
+    def delta_contract(self, underlying_symbol, expiry, option_right, price, time_to_expiry, rate, sigma, target_delta):
+        # (contract, delta) of the contract whose delta is closest to `target_delta`, with one array call for all strikes
+        strikes, contract_symbols = self.contracts(underlying_symbol, expiry, option_right)
+        deltas = delta(price, strikes, time_to_expiry, rate, 0, sigma, option_right == OptionRight.Call)
+        i = nearest(deltas, target_delta)
+        if i is None:
+            return None, np.nan
+        return contract_symbols[i], deltas[i]
+
+    def atm_contract(self, underlying_symbol, expiry, option_right, price):
+        # Contract with the strike closest to `price`; the lower strike wins a tie
+        strikes, contract_symbols = self.contracts(underlying_symbol, expiry, option_right)
+        i = np.searchsorted(strikes, price)
+        if i == len(strikes) or (i > 0 and price - strikes[i - 1] <= strikes[i] - price):
+            i -= 1
+        return contract_symbols[i]
+
+
+class OptionSubscriptionManager:
+    def __init__(self, algorithm):
+        # Number of open trades using each option contract. A contract is subscribed when the first trade picks it and
+        # removed when the last one completes, so finished and expired contracts don't keep their data subscriptions.
+        self.algorithm = algorithm
+        self.trade_count_by_contract = {}
+
+    def __len__(self):
+        return len(self.trade_count_by_contract)
+
+    def acquire(self, contract_symbol):
+        count = self.trade_count_by_contract.get(contract_symbol, 0)
+        if count == 0:
+            self.algorithm.AddOptionContract(contract_symbol)
+        self.trade_count_by_contract[contract_symbol] = count + 1
+
+    def release(self, contract_symbol):
+        count = self.trade_count_by_contract[contract_symbol] - 1
+        if count > 0:
+            self.trade_count_by_contract[contract_symbol] = count
+            return
+        del self.trade_count_by_contract[contract_symbol]
+        self.algorithm.RemoveSecurity(contract_symbol)
 
 
 class Trade:
-    def __init__(self, algorithm, security, order_direction, trailing_stop_pct, trade_weight):
+    EXIT_DAY = 4 # Friday
+    EXIT_TIME = time(10)
+
+    def __init__(self, algorithm, security, order_direction, trailing_stop_pct, trade_weight, target_delta=None, volatility=None):
         self.algorithm = algorithm
         self.security = security
         self.order_direction = order_direction
         self.trailing_stop_pct = trailing_stop_pct
         self.trade_weight = trade_weight
-
-        self.EXIT_DAY = 4 # Friday
-        self.EXIT_TIME = time(10)
+        # Signed delta to target (positive for calls, negative for puts) and the annualized volatility to compute it
+        # with; without them the ATM contract is selected
+        self.target_delta = target_delta
+        self.volatility = volatility
 
         self.completed = False
+        self.subscribed = False
+        self.book_key = None # Set while the trade is in a TradeBook
 
         self.contract_symbol = self.get_contract(security)
         if self.contract_symbol:
@@ -142,11 +380,10 @@ class Trade:
             self.completed = True
 
     def get_contract(self, security): 
-        # Use OptionChainProvider to select the ATM contract that expires this week
-        contract_symbols = self.algorithm.OptionChainProvider.GetOptionContractList(security.Symbol, self.algorithm.Time)
-        original_symbols = contract_symbols
-        if len(contract_symbols) == 0:
-            self.algorithm.Debug(f"{self.algorithm.Time}: GetOptionContractList returned no contracts")
+        # Use the day's cached option chain to select the ATM contract that expires this week
+        option_chain_cache = self.algorithm.option_chain_cache
+        if option_chain_cache.is_empty(security.Symbol):
+            self.algorithm.telemetry.debug('contract selection', "{}: GetOptionContractList returned no contracts", self.algorithm.Time)
             self.completed = True
             return
 
@@ -154,69 +391,84 @@ class Trade:
         current_date = self.algorithm.Time.date()
         latest_expiry = datetime.combine(current_date + timedelta(days=5 - self.algorithm.Time.date().weekday()), time(0, 0)) # Saturday at 12 AM
         option_right = OptionRight.Call if self.order_direction == OrderDirection.Buy else OptionRight.Put
-        contract_symbols = [symbol for symbol in contract_symbols if symbol.ID.Date < latest_expiry and symbol.ID.Date.weekday() == self.EXIT_DAY and symbol.ID.OptionRight == option_right]
-        if len(contract_symbols) == 0:
-            self.algorithm.Debug(f"{self.algorithm.Time}: No contracts match the option right and expiry requirements")
+        expiries = [expiry for expiry in option_chain_cache.expiries(security.Symbol, option_right) if expiry < latest_expiry and expiry.weekday() == self.EXIT_DAY]
+        if len(expiries) == 0:
+            self.algorithm.telemetry.debug('contract selection', "{}: No contracts match the option right and expiry requirements",
+                                           self.algorithm.Time)
             self.completed = True
             return
 
+        if self.target_delta is not None:
+            # Select the contract with the delta closest to the target
+            rate = float(self.algorithm.RiskFreeInterestRateModel.GetInterestRate(self.algorithm.Time))
+            candidates = []
+            for expiry in expiries:
+                # Options stop trading at 4 PM on the expiry date
+                time_to_expiry = (expiry + timedelta(hours=16) - self.algorithm.Time).total_seconds() / (365 * 24 * 60 * 60)
+                candidates.append(option_chain_cache.delta_contract(security.Symbol, expiry, option_right, security.Price,
+                                                                    time_to_expiry, rate, self.volatility, self.target_delta))
+            candidates = [candidate for candidate in candidates if candidate[0] is not None]
+            if candidates:
+                return self.subscribe(min(candidates, key=lambda candidate: abs(candidate[1] - self.target_delta))[0])
+
         # Select ATM contract
-        contract_symbol = sorted(contract_symbols, key=lambda contract_symbol: abs(security.Price - contract_symbol.ID.StrikePrice))[0]
+        contract_symbols = [option_chain_cache.atm_contract(security.Symbol, expiry, option_right, security.Price) for expiry in expiries]
+        contract_symbol = min(contract_symbols, key=lambda contract_symbol: abs(security.Price - contract_symbol.ID.StrikePrice))
+        return self.subscribe(contract_symbol)
 
-        # Subscribe to Option contract
-        self.algorithm.AddOptionContract(contract_symbol)
+    def subscribe(self, contract_symbol):
+        # Subscribe to Option contract (or share the subscription of another open trade)
+        self.algorithm.option_subscriptions.acquire(contract_symbol)
+        self.subscribed = True
 
         return contract_symbol
 
     def place_orders(self, contract_symbol, order_direction):
         self.quantity = 0
-        self.high_water_mark = 0
+        self.high_water_mark = 0 # Once the trade is in a TradeBook, the book trails the high-water mark
+        self.stop_price = None
         self.stop_loss_ticket = None
 
         # Calculate order quantity (x% of portfolio value)
         self.quantity = self.algorithm.CalculateOrderQuantity(contract_symbol, self.trade_weight)
         if self.quantity == 0:
-            self.algorithm.Debug(f"{self.algorithm.Time}: Can't afford a single contract")
-            self.completed = True
+            self.algorithm.telemetry.debug('contract selection', "{}: Can't afford a single contract", self.algorithm.Time)
+            self.complete()
             return
 
         # Submit entry order
         self.high_water_mark = self.algorithm.MarketOrder(contract_symbol, self.quantity).AverageFillPrice
 
         # Submit stop loss order
-        self.stop_loss_ticket = self.algorithm.StopMarketOrder(contract_symbol, -self.quantity, self.get_stop_loss_price(order_direction)) 
+        self.stop_price = self.get_stop_loss_price(self.high_water_mark)
+        self.stop_loss_ticket = self.algorithm.StopMarketOrder(contract_symbol, -self.quantity, self.stop_price) 
+        self.algorithm.register_ticket(self.stop_loss_ticket, self)
 
-    def get_stop_loss_price(self, order_direction):
-        price = self.high_water_mark * (1 - self.trailing_stop_pct)
+    def get_stop_loss_price(self, high_water_mark):
+        price = high_water_mark * (1 - self.trailing_stop_pct)
         
         # Round the stop loss price level so we don't get errors from not following the MinimumPriceVariation  
         minimum_price_variation = self.algorithm.Securities[self.contract_symbol].SymbolProperties.MinimumPriceVariation
         precision = len(str(minimum_price_variation).split('.')[1])
         return round(int(price / minimum_price_variation) * minimum_price_variation, precision)
 
-    def scan(self, data: Slice):
-        if self.contract_symbol is None:
-            return
-
-        # If it's Friday 10 AM EST and we have an open position, close it
-        if data.Time.weekday() == self.EXIT_DAY and data.Time.time() >= self.EXIT_TIME:
-            self.stop_loss_ticket.Cancel()
-            self.algorithm.MarketOrder(self.contract_symbol, -self.quantity)
-            self.completed = True
-            self.algorithm.Debug(f"{data.Time}: {self.contract_symbol} position closed because it's the exit day")
-            return
-
-        # Update trailing stop loss
-        if self.contract_symbol in data.QuoteBars:
-            current_price = data.QuoteBars[self.contract_symbol].Bid.Close
-            if current_price > self.high_water_mark:
-                self.high_water_mark = current_price
-                self.stop_loss_ticket.UpdateStopPrice(self.get_stop_loss_price(self.order_direction))
+    def close(self, current_time):
+        self.stop_loss_ticket.Cancel()
+        self.algorithm.MarketOrder(self.contract_symbol, -self.quantity)
+        self.complete()
+        self.algorithm.telemetry.debug('close', "{}: {} position closed because it's the exit day", current_time, self.contract_symbol)
 
     def on_order_event(self, orderEvent: OrderEvent) -> None:
         # When the stop loss is hit, mark the trade as completed
         if orderEvent.Status == OrderStatus.Filled \
             and self.stop_loss_ticket is not None \
             and orderEvent.OrderId == self.stop_loss_ticket.OrderId:
-                self.completed = True
+                self.complete()
+
+    def complete(self):
+        # Release the contract subscription once the trade has no more position or orders
+        self.completed = True
+        if self.subscribed:
+            self.subscribed = False
+            self.algorithm.option_subscriptions.release(self.contract_symbol)
                 
@@ -0,0 +1,75 @@
+# Batched rebalancing to a dict of portfolio weights
+#
+# SetHoldings sizes and submits one order per call, recomputing the portfolio value and margin every time, so a loop
+# of SetHoldings/Liquidate calls sizes each order against a slightly different portfolio and may buy before the
+# sells that fund the buys. PortfolioRebalancer takes every target at once, computes all order quantities against one
+# snapshot of the portfolio, drops changes below the configured thresholds, and submits the orders that reduce
+# exposure before the ones that add to it.
+#
+# Example:
+#   self.rebalancer = PortfolioRebalancer(self, minimum_order_value=100)
+#   self.rebalancer.rebalance({spy: 0.65, ief: 0.35})
+#   self.rebalancer.rebalance(weight, liquidate_others=True)    # also liquidate holdings that have no target
+
+
+class PortfolioRebalancer:
+    def __init__(self, algorithm, minimum_order_value=0, minimum_weight_change=0, asynchronous=False, tag=""):
+        # Orders worth less than `minimum_order_value`, or moving a weight by less than `minimum_weight_change`, are
+        # skipped unless they close a position. With `asynchronous`, orders are submitted without waiting for fills.
+        self.algorithm = algorithm
+        self.minimum_order_value = minimum_order_value
+        self.minimum_weight_change = minimum_weight_change
+        self.asynchronous = asynchronous
+        self.tag = tag
+
+    def order_quantities(self, targets, liquidate_others=False):
+        # {symbol: quantity} that moves the portfolio to the target weights, sized against one snapshot
+        algorithm = self.algorithm
+        portfolio = algorithm.Portfolio
+        # Like SetHoldings, keep the free portfolio value the settings reserve for fees and slippage
+        portfolio_value = float(portfolio.TotalPortfolioValue) - float(algorithm.Settings.FreePortfolioValue)
+        if portfolio_value <= 0:
+            return {}
+
+        targets = dict(targets)
+        if liquidate_others:
+            for holding in portfolio.Values:
+                if holding.Invested and holding.Symbol not in targets:
+                    targets[holding.Symbol] = 0
+
+        quantities = {}
+        for symbol, target_weight in targets.items():
+            security = algorithm.Securities[symbol]
+            price = float(security.Price)
+            if price == 0:
+                continue
+            unit_value = price * float(security.SymbolProperties.ContractMultiplier)
+            lot_size = float(security.SymbolProperties.LotSize)
+            holdings = float(portfolio[symbol].Quantity)
+
+            # Round the target down to whole lots
+            target_quantity = int(target_weight * portfolio_value / unit_value / lot_size) * lot_size
+            quantity = target_quantity - holdings
+            if quantity == 0:
+                continue
+            if target_quantity != 0:
+                weight_change = abs(quantity) * unit_value / portfolio_value
+                if weight_change < self.minimum_weight_change or abs(quantity) * unit_value < self.minimum_order_value:
+                    continue
+            quantities[symbol] = quantity
+        return quantities
+
+    def rebalance(self, targets, liquidate_others=False):
+        # Targets are portfolio weights by symbol (negative for shorts). Symbols without a target are left alone
+        # unless `liquidate_others` is set. Returns the order tickets.
+        quantities = self.order_quantities(targets, liquidate_others)
+        portfolio = self.algorithm.Portfolio
+
+        def reduces_exposure(item):
+            symbol, quantity = item
+            holdings = float(portfolio[symbol].Quantity)
+            # Selling down a long or covering a short, including flips to the other side
+            return abs(holdings + quantity) < abs(holdings) or holdings * (holdings + quantity) < 0
+
+        orders = sorted(quantities.items(), key=lambda item: not reduces_exposure(item))
+        return [self.algorithm.MarketOrder(symbol, quantity, self.asynchronous, self.tag) for symbol, quantity in orders]
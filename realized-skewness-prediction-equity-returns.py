@@ -9,9 +9,10 @@
 
 #region imports
 from AlgorithmImports import *
-from collections import deque
 from scipy.stats import skew
 import numpy as np
+from portfolio_rebalancer import PortfolioRebalancer
+from instrumentation import Instrumentation, instrumented
 #endregion
 
 class RealizedSkewnessPredictsEquityReturns(QCAlgorithm):
@@ -20,13 +21,22 @@ class RealizedSkewnessPredictsEquityReturns(QCAlgorithm):
         self.SetStartDate(2019, 1, 1)
         self.SetCash(100000)
 
+        # Opt-in timing of the callbacks (see instrumentation.py), with the parameter instrumentation=on
+        self.instrumentation = Instrumentation(self, enabled=self.GetParameter('instrumentation') == 'on')
+
         self.symbol = self.AddEquity('SPY', Resolution.Minute).Symbol
 
         self.weight = {}
+        self.rebalancer = PortfolioRebalancer(self)
         
-        # 5Minute price data.
-        self.data = {}
+        # 5Minute price data, one ring buffer row per symbol. With moment accumulators, only running sums of the
+        # 5-minute returns since the last rebalance are kept instead, which takes constant memory per symbol.
         self.period = 5 * 78
+        self.use_moment_accumulators = False
+        if self.use_moment_accumulators:
+            self.data = MomentAccumulator(min_count=self.period - 1)
+        else:
+            self.data = PriceRingBuffer(self.period)
         
         self.coarse_count = 100
 
@@ -40,7 +50,9 @@ class RealizedSkewnessPredictsEquityReturns(QCAlgorithm):
         self.AddUniverse(self.CoarseSelectionFunction, self.FineSelectionFunction)
         self.Schedule.On(self.DateRules.MonthStart(self.symbol), self.TimeRules.AfterMarketOpen(self.symbol), self.Selection)
         
+    @instrumented
     def OnSecuritiesChanged(self, changes):
+        added_symbols = []
         for security in changes.AddedSecurities:
             symbol = security.Symbol
             
@@ -48,18 +60,34 @@ class RealizedSkewnessPredictsEquityReturns(QCAlgorithm):
             security.SetLeverage(5)
             
             if symbol not in self.data:
-                history = self.History(symbol, self.period * 5, Resolution.Minute)
-                closes_5M = []
-                if len(history) == self.period and 'close' in history:
-                    closes_1M = [x for x in history['close']]
-                    closes_5M = closes_1M[::5]
-                self.data[symbol] = deque(closes_5M, maxlen = self.period)
+                added_symbols.append(symbol)
+
+        if added_symbols:
+            if self.use_moment_accumulators:
+                for symbol in added_symbols:
+                    self.data.add(symbol)
+            else:
+                self.warm_up(added_symbols)
         
         # Remove old stocks from selected universe data.
         for security in changes.RemovedSecurities:
+            symbol = security.Symbol
             if symbol in self.data:
-                del self.data[symbol]
+                self.data.remove(symbol)
             
+    def warm_up(self, symbols):
+        # One minute history request for all added symbols. The closes are downsampled to the minutes OnData stores
+        # (bar end times on a multiple of 5 minutes), and the last `period` of each symbol go straight into its row.
+        closes_5M = {}
+        history = self.History(symbols, self.period * 5, Resolution.Minute)
+        if not history.empty and 'close' in history:
+            closes_1M = history['close']
+            times = closes_1M.index.get_level_values('time')
+            closes_5M = {symbol: closes.values for symbol, closes in
+                         closes_1M[times.minute % 5 == 0].groupby(level='symbol').tail(self.period).groupby(level='symbol')}
+        for symbol in symbols:
+            self.data.add(symbol, closes_5M.get(symbol, ()))
+
     def CoarseSelectionFunction(self, coarse):
         if not self.selection_flag: 
             return Universe.Unchanged
@@ -82,26 +110,36 @@ class RealizedSkewnessPredictsEquityReturns(QCAlgorithm):
         # return list(set(newly_added) | set(traded_symbols))
         return selected_symbols
         
+    @instrumented
     def OnData(self, data):
         if self.Time.minute % 5 == 0:
-            # Store 5 minute data.
-            for symbol in self.data:
-                if symbol in data and data[symbol]:
-                    price = data[symbol].Value
-                    self.data[symbol].append(price)
+            # Store 5 minute data of every symbol in the slice with one array write.
+            rows = []
+            prices = []
+            for symbol, bar in data.Bars.items():
+                row = self.data.row_by_symbol.get(symbol)
+                if row is not None:
+                    rows.append(row)
+                    prices.append(bar.Close)
+            self.data.append(rows, prices)
 
         if not (self.Time.hour == 16 and self.Time.minute == 0):
             return
 
         if self.days == 5:
+            # 5 Minute data is ready.
+            ready = [(symbol, market_cap, self.data.row_by_symbol[symbol]) for symbol, market_cap in self.selected_universe 
+                     if symbol in self.data and self.data.is_ready(symbol)]
+
+            # Skewness of every ready symbol with one call across the rows
             aggregate_skewness_market_cap = {}
-            for symbol, market_cap in self.selected_universe:
-                # 5 Minute data is ready.
-                if symbol in self.data and len(self.data[symbol]) == self.data[symbol].maxlen:
-                    closes_5M = np.array(self.data[symbol])
-                    returns_5M = (closes_5M[1:] - closes_5M[:-1]) / closes_5M[:-1]
-                    skewness = skew(returns_5M)
-                    aggregate_skewness_market_cap[symbol] = (skewness, market_cap)
+            if ready:
+                skewness = self.data.skewness([row for _, _, row in ready])
+                for (symbol, market_cap, _), symbol_skewness in zip(ready, skewness):
+                    aggregate_skewness_market_cap[symbol] = (symbol_skewness, market_cap)
+
+            # Start the next week's moments
+            self.data.reset()
                             
             if len(aggregate_skewness_market_cap) != 0:
                 # Aggregate skewness sorting.
@@ -123,20 +161,19 @@ class RealizedSkewnessPredictsEquityReturns(QCAlgorithm):
                     market_cap = skewness_market_cap_data[1]
                     weight[symbol] = -market_cap / total_market_cap_short            
 
-                # Trade execution.
+                # Trade execution: liquidate stocks without a weight and trade the ones with data, as one batch.
                 stocks_invested = [x.Key for x in self.Portfolio if x.Value.Invested]
-                for symbol in stocks_invested:
-                    if symbol not in weight:
-                        self.Liquidate(symbol)
-            
+                targets = {symbol: 0 for symbol in stocks_invested if symbol not in weight}
                 for symbol, w in weight.items():
                     if symbol in data and data[symbol]:
-                        self.SetHoldings(symbol, w)
+                        targets[symbol] = w
+                self.rebalancer.rebalance(targets)
         
         self.days += 1
         if self.days > 5:
             self.days = 1      
     
+    @instrumented
     def Selection(self):
         if self.month == 12:
             self.selection_flag = True
@@ -145,6 +182,168 @@ class RealizedSkewnessPredictsEquityReturns(QCAlgorithm):
         if self.month > 12:
             self.month = 1
 
+    def OnEndOfAlgorithm(self):
+        self.instrumentation.dump()
+
+class PriceRingBuffer:
+    def __init__(self, period, capacity=128):
+        # One row of `period` prices per symbol in a single preallocated array. Every row is a ring: `positions` holds
+        # the column the next price goes to and `counts` how many prices the row has (up to `period`). Rows of removed
+        # symbols are reused, and the array doubles when every row is taken.
+        self.period = period
+        self.prices = np.full((capacity, period), np.nan)
+        self.positions = np.zeros(capacity, dtype=int)
+        self.counts = np.zeros(capacity, dtype=int)
+        self.row_by_symbol = {}
+        self.free_rows = list(range(capacity - 1, -1, -1))
+
+    def __contains__(self, symbol):
+        return symbol in self.row_by_symbol
+
+    def __len__(self):
+        return len(self.row_by_symbol)
+
+    def add(self, symbol, prices=()):
+        # Start a row for `symbol` with its last `period` prices (oldest first)
+        if not self.free_rows:
+            self.grow()
+        row = self.free_rows.pop()
+        self.row_by_symbol[symbol] = row
+        prices = np.asarray(prices, dtype=float)[-self.period:]
+        self.prices[row] = np.nan
+        self.prices[row, :len(prices)] = prices
+        self.positions[row] = len(prices) % self.period
+        self.counts[row] = len(prices)
+        return row
+
+    def remove(self, symbol):
+        self.free_rows.append(self.row_by_symbol.pop(symbol))
+
+    def grow(self):
+        capacity = len(self.prices)
+        self.prices = np.vstack((self.prices, np.full((capacity, self.period), np.nan)))
+        self.positions = np.concatenate((self.positions, np.zeros(capacity, dtype=int)))
+        self.counts = np.concatenate((self.counts, np.zeros(capacity, dtype=int)))
+        self.free_rows = list(range(2 * capacity - 1, capacity - 1, -1)) + self.free_rows
+
+    def append(self, rows, prices):
+        # Append one price to each of `rows` (a row may only appear once per call)
+        if len(rows) == 0:
+            return
+        rows = np.asarray(rows)
+        positions = self.positions[rows]
+        self.prices[rows, positions] = prices
+        self.positions[rows] = (positions + 1) % self.period
+        self.counts[rows] = np.minimum(self.counts[rows] + 1, self.period)
+
+    def is_ready(self, symbol):
+        return self.counts[self.row_by_symbol[symbol]] == self.period
+
+    def ordered(self, rows):
+        # Prices of full `rows`, oldest first
+        rows = np.asarray(rows)
+        columns = (self.positions[rows, None] + np.arange(self.period)) % self.period
+        return np.take_along_axis(self.prices[rows], columns, axis=1)
+
+    def skewness(self, rows):
+        # Skewness of the 5-minute returns of full `rows`
+        closes_5M = self.ordered(rows)
+        returns_5M = (closes_5M[:, 1:] - closes_5M[:, :-1]) / closes_5M[:, :-1]
+        return skew(returns_5M, axis=1)
+
+    def reset(self):
+        # The window rolls on its own
+        pass
+
+
+class MomentAccumulator:
+    def __init__(self, min_count, capacity=128):
+        # Running count and sums of r, r^2, r^3 and r^4 of every symbol's returns since the last reset, plus the last
+        # price to compute the next return from. Updates are O(1) per symbol and memory doesn't grow with the period.
+        # Rows are managed like PriceRingBuffer's.
+        self.min_count = min_count
+        self.last_prices = np.full(capacity, np.nan)
+        self.counts = np.zeros(capacity, dtype=int)
+        self.sums = np.zeros((4, capacity))
+        self.row_by_symbol = {}
+        self.free_rows = list(range(capacity - 1, -1, -1))
+
+    def __contains__(self, symbol):
+        return symbol in self.row_by_symbol
+
+    def __len__(self):
+        return len(self.row_by_symbol)
+
+    def add(self, symbol, prices=()):
+        if not self.free_rows:
+            self.grow()
+        row = self.free_rows.pop()
+        self.row_by_symbol[symbol] = row
+        self.last_prices[row] = prices[-1] if len(prices) else np.nan
+        self.counts[row] = 0
+        self.sums[:, row] = 0
+        return row
+
+    def remove(self, symbol):
+        self.free_rows.append(self.row_by_symbol.pop(symbol))
+
+    def grow(self):
+        capacity = len(self.last_prices)
+        self.last_prices = np.concatenate((self.last_prices, np.full(capacity, np.nan)))
+        self.counts = np.concatenate((self.counts, np.zeros(capacity, dtype=int)))
+        self.sums = np.hstack((self.sums, np.zeros((4, capacity))))
+        self.free_rows = list(range(2 * capacity - 1, capacity - 1, -1)) + self.free_rows
+
+    def append(self, rows, prices):
+        # Add the return from the last price of each of `rows` (a row may only appear once per call)
+        if len(rows) == 0:
+            return
+        rows = np.asarray(rows)
+        prices = np.asarray(prices, dtype=float)
+        last_prices = self.last_prices[rows]
+        self.last_prices[rows] = prices
+
+        has_return = ~np.isnan(last_prices)
+        rows = rows[has_return]
+        returns = (prices[has_return] - last_prices[has_return]) / last_prices[has_return]
+        self.counts[rows] += 1
+        power = returns
+        for sums in self.sums:
+            sums[rows] += power
+            power = power * returns
+
+    def is_ready(self, symbol):
+        return self.counts[self.row_by_symbol[symbol]] >= self.min_count
+
+    def moments(self, rows):
+        # Mean and the 2nd, 3rd and 4th central moments (population, like scipy.stats with bias=True)
+        rows = np.asarray(rows)
+        n = self.counts[rows]
+        mean, raw_2, raw_3, raw_4 = self.sums[:, rows] / n
+        m2 = raw_2 - mean ** 2
+        m3 = raw_3 - 3 * mean * raw_2 + 2 * mean ** 3
+        m4 = raw_4 - 4 * mean * raw_3 + 6 * mean ** 2 * raw_2 - 3 * mean ** 4
+        return mean, m2, m3, m4
+
+    def variance(self, rows):
+        return self.moments(rows)[1]
+
+    def skewness(self, rows):
+        _, m2, m3, _ = self.moments(rows)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return m3 / m2 ** 1.5
+
+    def kurtosis(self, rows):
+        # Excess kurtosis
+        _, m2, _, m4 = self.moments(rows)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return m4 / m2 ** 2 - 3
+
+    def reset(self):
+        # Keep the last prices so the first return of the next period spans the rebalance
+        self.counts[:] = 0
+        self.sums[:] = 0
+
 # Custom fee model
 class CustomFeeModel(FeeModel):
     def GetOrderFee(self, parameters):
@@ -0,0 +1,205 @@
+# Offline, vectorized version of futures-contracts.py
+#
+# The strategy trades a continuous future on a daily EMA(20) and n-minute consolidated closes. It goes LONG after 1 close
+# below the EMA followed by 2 closes above it (SHORT for the mirror image), one contract per trade, and protects every
+# trade with a trailing stop that is `trailing_stop_pct / ContractMultiplier` away from the high-water mark. At most
+# int(1 / trailing_stop_pct) trades are open at the same time.
+#
+# Instead of replaying every minute through the event engine, the entry signals for all consolidated bars are computed
+# at once and every trade's exit is found with array operations. Fills follow the LEAN defaults the live strategy runs
+# with: market orders fill at the ask (buys) or bid (sells) close of the decision bar, and a sell stop fills at
+# min(stop, bid close) once the bid low trades through it (buy stops mirror this on the ask). Orders are filled before
+# OnData, which then trails the high-water mark with the same bar, so the stop a bar can fill was set from the
+# high-water mark through the bar before it (the entry's high-water mark for the first bar after the entry).
+# Rollovers are not simulated, so the input should be a back-adjusted continuous series.
+#
+# Example:
+#   bars = MinuteBars.from_frame(df)    # DataFrame indexed by bar end time
+#   trades = run_backtest(bars, timedelta(minutes=60), 0.05, contract_multiplier=5, minimum_price_variation=1)
+#   results = screen(bars, [timedelta(minutes=m) for m in (30, 60, 120)], np.linspace(0.01, 0.2, 20), 5, 1)
+
+import numpy as np
+import pandas as pd
+
+
+class MinuteBars:
+    def __init__(self, end_time, close, bid_low, bid_close, ask_high, ask_close):
+        # `end_time` is a datetime64 array of bar end times; every other argument is a float array of the same length
+        self.end_time = np.asarray(end_time, dtype='datetime64[ns]')
+        self.close = np.asarray(close, dtype=float)
+        self.bid_low = np.asarray(bid_low, dtype=float)
+        self.bid_close = np.asarray(bid_close, dtype=float)
+        self.ask_high = np.asarray(ask_high, dtype=float)
+        self.ask_close = np.asarray(ask_close, dtype=float)
+
+    @classmethod
+    def from_frame(cls, frame):
+        # Expects the columns close, bidlow, bidclose, askhigh and askclose (the names LEAN uses in History DataFrames)
+        return cls(frame.index.values, frame['close'].values, frame['bidlow'].values, frame['bidclose'].values,
+                   frame['askhigh'].values, frame['askclose'].values)
+
+    def __len__(self):
+        return len(self.end_time)
+
+
+def daily_closes(end_time, close):
+    # Calendar-day bars built from the minute closes; each daily bar ends at the following midnight
+    days = end_time.astype('datetime64[D]')
+    last_of_day = np.flatnonzero(np.r_[days[1:] != days[:-1], True])
+    return (days[last_of_day] + np.timedelta64(1, 'D')).astype('datetime64[ns]'), close[last_of_day]
+
+
+def exponential_moving_average(values, period):
+    # Same recursion as LEAN's ExponentialMovingAverage: the first sample seeds the average and the indicator is ready
+    # after `period` samples. Values before that are NaN.
+    k = 2 / (period + 1)
+    ema = np.empty(len(values))
+    current = np.nan
+    for i, value in enumerate(values):
+        current = value if i == 0 else value * k + current * (1 - k)
+        ema[i] = current
+    ema[:period - 1] = np.nan
+    return ema
+
+
+def consolidate(end_time, close, bar_size):
+    # Time-based TradeBarConsolidator: minute bars are grouped by the period their start time falls in, and the
+    # consolidated bar is emitted on the first minute bar that ends at or after the period end. Returns the
+    # consolidated closes and the index of the minute bar each one is emitted on.
+    period = np.timedelta64(bar_size).astype('timedelta64[ns]').astype(np.int64)
+    start_ns = (end_time - np.timedelta64(1, 'm')).astype(np.int64)
+    window = start_ns // period
+    last_in_window = np.flatnonzero(np.r_[window[1:] != window[:-1], True])
+    window_end = ((window[last_in_window] + 1) * period).astype('datetime64[ns]')
+    decision_index = np.searchsorted(end_time, window_end, side='left')
+
+    # A window whose end is past the last minute bar has not been emitted yet
+    emitted = decision_index < len(end_time)
+    return close[last_in_window][emitted], decision_index[emitted]
+
+
+def entry_signals(closes, emas):
+    # +1 for LONG (1 close below the EMA and then 2 closes above), -1 for SHORT (the mirror image), 0 otherwise
+    signals = np.zeros(len(closes), dtype=np.int8)
+    if len(closes) < 3:
+        return signals
+    above = closes > emas
+    below = closes < emas
+    signals[2:][below[:-2] & above[1:-1] & above[2:]] = 1
+    signals[2:][above[:-2] & below[1:-1] & below[2:]] = -1
+    return signals
+
+
+def round_to_tick(prices, minimum_price_variation):
+    # Vectorized version of the strategy's round_price: truncate to the tick and round away floating point noise
+    precision = len(str(minimum_price_variation).split('.')[1]) if '.' in str(minimum_price_variation) else 0
+    return np.round(np.floor(prices / minimum_price_variation) * minimum_price_variation, precision)
+
+
+def find_stop_exit(bars, entry_index, direction, fill_price, stop_distance, minimum_price_variation, chunk_size=1024):
+    # Returns (exit_index, exit_price) of the trailing stop, or (None, None) if the stop is never hit. The search runs
+    # over growing chunks so short trades don't pay for scanning the rest of the history.
+    if direction > 0:
+        trail, trigger, fill = bars.bid_close, bars.bid_low, bars.bid_close
+        high_water_mark = max(fill_price, trail[entry_index])
+    else:
+        trail, trigger, fill = bars.ask_close, bars.ask_high, bars.ask_close
+        high_water_mark = min(fill_price, trail[entry_index])
+
+    start = entry_index + 1
+    while start < len(bars):
+        end = min(len(bars), start + chunk_size)
+        # high_water_marks[k] is the high-water mark through the bar before start + k
+        if direction > 0:
+            high_water_marks = np.maximum.accumulate(np.r_[high_water_mark, trail[start:end - 1]])
+            stop_prices = round_to_tick(high_water_marks * (1 - stop_distance), minimum_price_variation)
+            hits = np.flatnonzero(trigger[start:end] < stop_prices)
+        else:
+            high_water_marks = np.minimum.accumulate(np.r_[high_water_mark, trail[start:end - 1]])
+            stop_prices = round_to_tick(high_water_marks * (1 + stop_distance), minimum_price_variation)
+            hits = np.flatnonzero(trigger[start:end] > stop_prices)
+
+        if hits.size:
+            hit = hits[0]
+            exit_index = start + hit
+            if direction > 0:
+                return exit_index, min(stop_prices[hit], fill[exit_index])
+            return exit_index, max(stop_prices[hit], fill[exit_index])
+
+        if direction > 0:
+            high_water_mark = max(high_water_marks[-1], trail[end - 1])
+        else:
+            high_water_mark = min(high_water_marks[-1], trail[end - 1])
+        start = end
+        chunk_size *= 2
+    return None, None
+
+
+def simulate(bars, decision_index, signals, trailing_stop_pct, contract_multiplier, minimum_price_variation):
+    # Walks the (sparse) entry signals in time order; each trade's exit comes from the vectorized stop search
+    stop_distance = trailing_stop_pct / contract_multiplier
+    max_open_trades = int(1 / trailing_stop_pct)
+    last_index = len(bars) - 1
+
+    trades = []
+    open_exit_indices = []
+    for index, direction in zip(decision_index[signals != 0], signals[signals != 0]):
+        # Trades that exit on the decision bar are only removed after the consolidation handler ran
+        open_exit_indices = [exit_index for exit_index in open_exit_indices if exit_index >= index]
+        if len(open_exit_indices) >= max_open_trades:
+            continue
+
+        fill_price = bars.ask_close[index] if direction > 0 else bars.bid_close[index]
+        exit_index, exit_price = find_stop_exit(bars, index, direction, fill_price, stop_distance, minimum_price_variation)
+        exit_reason = 'stop'
+        if exit_index is None:
+            exit_index = last_index
+            exit_price = bars.bid_close[last_index] if direction > 0 else bars.ask_close[last_index]
+            exit_reason = 'open'
+
+        open_exit_indices.append(exit_index)
+        trades.append((bars.end_time[index], bars.end_time[exit_index], int(direction), fill_price, exit_price, exit_reason))
+
+    trades = pd.DataFrame(trades, columns=['entry_time', 'exit_time', 'quantity', 'entry_price', 'exit_price', 'exit_reason'])
+    trades['pnl'] = (trades['exit_price'] - trades['entry_price']) * trades['quantity'] * contract_multiplier
+    return trades
+
+
+def prepare_signals(bars, bar_size, daily_end_time=None, daily_close=None, ema_period=20):
+    # Consolidated closes, the EMA value visible when each one is emitted, and the resulting entry signals
+    if daily_end_time is None:
+        daily_end_time, daily_close = daily_closes(bars.end_time, bars.close)
+    daily_end_time = np.asarray(daily_end_time, dtype='datetime64[ns]')
+    daily_ema = exponential_moving_average(np.asarray(daily_close, dtype=float), ema_period)
+
+    closes, decision_index = consolidate(bars.end_time, bars.close, bar_size)
+    latest_daily_bar = np.searchsorted(daily_end_time, bars.end_time[decision_index], side='right') - 1
+    emas = np.where(latest_daily_bar >= 0, daily_ema[np.maximum(latest_daily_bar, 0)], np.nan)
+    return decision_index, entry_signals(closes, emas)
+
+
+def run_backtest(bars, bar_size, trailing_stop_pct, contract_multiplier, minimum_price_variation,
+                 daily_end_time=None, daily_close=None, ema_period=20):
+    # Trade list for one parameter set. Daily bars default to calendar days built from the minute closes.
+    decision_index, signals = prepare_signals(bars, bar_size, daily_end_time, daily_close, ema_period)
+    return simulate(bars, decision_index, signals, trailing_stop_pct, contract_multiplier, minimum_price_variation)
+
+
+def screen(bars, bar_sizes, trailing_stop_pcts, contract_multiplier, minimum_price_variation,
+           daily_end_time=None, daily_close=None, ema_period=20):
+    # Summary statistics for every (bar_size, trailing_stop_pct) combination. Signals are computed once per bar size.
+    rows = []
+    for bar_size in bar_sizes:
+        decision_index, signals = prepare_signals(bars, bar_size, daily_end_time, daily_close, ema_period)
+        for trailing_stop_pct in trailing_stop_pcts:
+            trades = simulate(bars, decision_index, signals, trailing_stop_pct, contract_multiplier, minimum_price_variation)
+            equity = trades['pnl'].cumsum()
+            rows.append({
+                'bar_size': bar_size,
+                'trailing_stop_pct': trailing_stop_pct,
+                'trades': len(trades),
+                'pnl': trades['pnl'].sum(),
+                'win_rate': (trades['pnl'] > 0).mean() if len(trades) else np.nan,
+                'max_drawdown': (equity.cummax().clip(lower=0) - equity).max() if len(trades) else 0.0
+            })
+    return pd.DataFrame(rows)
@@ -0,0 +1,254 @@
+# Full-history signal precompute and walk-forward harness for in-out-strategy.py
+#
+# The in-out decision only depends on daily closes: every day the strategy compares the latest return of each signal
+# ETF (and of three reverse-coded pairs) against the 55-65 day lagged average with the 1st percentile of the last 252
+# days, goes 'out' on any extreme observation and stays out for a number of wait days that decays from
+# INI_WAIT_DAYS. Instead of replaying that one scheduled day at a time, the returns sample and the rolling percentiles
+# of the whole history are computed in one vectorized pass (for every percentile level at once). Only the wait days,
+# be_in and the holdings, which are path-dependent, are walked day by day, which is cheap enough to run for every
+# parameter set.
+#
+# Timing: the decision made from the closes of day t is traded on day t + 1 (two hours after the open), and the
+# research mode lets the new weights earn the returns from the close of day t + 1 on. Weights are held constant
+# between trades, so drift and commissions are not modelled.
+#
+# Example (daily closes in a CSV with a date column and one column per ticker):
+#   closes = load_closes('in_out_closes.csv')
+#   signals = precompute(closes, percentiles=[0.5, 1, 2, 5])
+#   returns = sweep(signals, ini_wait_days=[5, 10, 15, 20], percentiles=[0.5, 1, 2, 5])
+#   out_of_sample, selections = walk_forward(returns, train_days=3 * 252, test_days=252)
+
+import argparse
+import itertools
+import warnings
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Tickers by the role they have in InOut.Initialize
+MRKT = 'SPY'  # market
+PRDC = 'XLI'  # production (industrials)
+METL = 'DBB'  # input prices (metals)
+NRES = 'IGE'  # input prices (natural res)
+DEBT = 'SHY'  # cost of debt (bond yield)
+USDX = 'UUP'  # safe haven (USD)
+GOLD = 'GLD'  # gold
+SLVA = 'SLV'  # VS silver
+UTIL = 'XLU'  # utilities
+INDU = PRDC  # vs industrials
+SHCU = 'FXF'  # safe haven currency (CHF)
+RICU = 'FXA'  # vs risk currency (AUD)
+
+FORPAIRS = [GOLD, SLVA, UTIL, SHCU, RICU]
+SIGNALS = [PRDC, METL, NRES, DEBT, USDX]
+PAIRLIST = ['G_S', 'U_I', 'C_A']
+
+# Holdings and the weights the strategy starts with
+STKS = 'TQQQ'
+TLT = 'TMF'
+IEF = 'TYD'
+HOLDINGS = [STKS, TLT, IEF]
+INITIAL_WEIGHTS = {STKS: 1, TLT: .5, IEF: .5}
+
+LOOKBACK = 252
+LAG_START = 55
+LAG_END = 65
+
+
+def load_closes(path):
+    # CSV with a date column and one column of daily closes per ticker
+    return pd.read_csv(path, parse_dates=['date'], index_col='date').sort_index()
+
+
+def returns_sample(closes, lag_start=LAG_START, lag_end=LAG_END):
+    # The strategy's returns_sample for every day at once: returns against the average of the closes lag_start to
+    # lag_end rows back (from a cumulative sum), USDX reverse coded, and the reverse-coded pair differentials. Only
+    # dates on which every signal ticker has a close are kept, like the dropna of the History frame.
+    symbols = SIGNALS + [MRKT] + FORPAIRS
+    signal_closes = closes[symbols].dropna()
+    values = signal_closes.values
+    cumulative = np.vstack((np.zeros(len(symbols)), np.cumsum(values, axis=0)))
+    rows = np.arange(lag_end, len(values))
+    lagged_average = np.full(values.shape, np.nan)
+    lagged_average[rows] = (cumulative[rows - lag_start + 1] - cumulative[rows - lag_end]) / (lag_end - lag_start + 1)
+
+    sample = pd.DataFrame(values / lagged_average - 1, index=signal_closes.index, columns=symbols)
+    sample[USDX] = sample[USDX] * (-1)
+    sample['G_S'] = -(sample[GOLD] - sample[SLVA])
+    sample['U_I'] = -(sample[UTIL] - sample[INDU])
+    sample['C_A'] = -(sample[SHCU] - sample[RICU])
+    return sample
+
+
+def rolling_percentiles(values, percentiles, window=LOOKBACK - LAG_END):
+    # Percentiles (ignoring NaNs) of the last `window` rows of every column, for every percentile level at once.
+    # Returns an array of shape (len(percentiles), len(values), columns).
+    padded = np.vstack((np.full((window - 1, values.shape[1]), np.nan), values))
+    windows = sliding_window_view(padded, window, axis=0)
+    with warnings.catch_warnings():
+        # Columns without a single value yet give NaN, which never flags an extreme observation
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanpercentile(windows, percentiles, axis=-1)
+
+
+def safe_haven_flags(sample):
+    # Days on which any safe haven outperformed the day after its counterpart rose (the wait-day trigger)
+    flags = np.zeros(len(sample), dtype=bool)
+    for safe, risky in ((GOLD, SLVA), (UTIL, INDU), (SHCU, RICU)):
+        previous = sample[risky].shift(1).values
+        flags |= (sample[safe].values > 0) & (sample[risky].values < 0) & (previous > 0)
+    return flags
+
+
+def week_ends(index):
+    # Last date of every week in the index (DateRules.WeekEnd); the final date is not known to end its week
+    weeks = index.to_period('W').asi8
+    return np.r_[weeks[1:] != weeks[:-1], False]
+
+
+class Signals:
+    def __init__(self, sample, extreme, safe_haven, week_end, holding_returns):
+        # `extreme` maps each percentile level to the per-day flag of any extreme observation
+        self.sample = sample
+        self.extreme = extreme
+        self.safe_haven = safe_haven
+        self.week_end = week_end
+        self.holding_returns = holding_returns
+
+    @property
+    def index(self):
+        return self.sample.index
+
+
+def precompute(closes, percentiles=(1,)):
+    # Everything that does not depend on INI_WAIT_DAYS, for every percentile level
+    sample = returns_sample(closes)
+    signal_values = sample[SIGNALS + PAIRLIST].values
+    levels = rolling_percentiles(signal_values, list(percentiles))
+    extreme = {percentile: (signal_values < level).any(axis=1) for percentile, level in zip(percentiles, levels)}
+
+    # Holdings that did not trade yet earn nothing
+    holding_returns = closes.reindex(sample.index)[HOLDINGS].pct_change().fillna(0).values
+    return Signals(sample, extreme, safe_haven_flags(sample), week_ends(sample.index), holding_returns)
+
+
+def simulate(signals, ini_wait_days=15, percentile=1):
+    # Walks the wait days, be_in and holdings the way the scheduled rebalances do. Returns one row per day.
+    extreme = signals.extreme[percentile]
+    n = len(extreme)
+    wait_days = np.empty(n, dtype=int)
+    be_in_path = np.empty(n, dtype=bool)
+    held_path = np.empty((n, len(HOLDINGS)))
+
+    wait_days_adjusted = ini_wait_days
+    be_in = True
+    outday = 0
+    wt = dict(INITIAL_WEIGHTS)
+    held = dict.fromkeys(HOLDINGS, 0)
+    for dcount in range(n):
+        # Determine waitdays empirically via safe haven excess returns, 50% decay
+        wait_days_adjusted = int(max(0.50 * wait_days_adjusted, ini_wait_days * (ini_wait_days if signals.safe_haven[dcount] else 1)))
+        adjwaitdays = min(60, wait_days_adjusted)
+        if extreme[dcount]:
+            be_in = False
+            outday = dcount
+        if dcount >= outday + adjwaitdays:
+            be_in = True
+
+        # Swap to 'out' assets daily, to 'in' assets at the end of the week
+        if not be_in:
+            wt.update({STKS: 0, TLT: 1, IEF: .5})
+        trade(wt, held)
+        if signals.week_end[dcount] and be_in:
+            wt.update({STKS: 1, TLT: 0, IEF: 0})
+            trade(wt, held)
+
+        wait_days[dcount] = adjwaitdays
+        be_in_path[dcount] = be_in
+        held_path[dcount] = [held[holding] for holding in HOLDINGS]
+
+    # Weights decided on day t are traded on day t + 1 and earn the returns from day t + 2 on
+    weights = np.vstack((np.zeros((2, len(HOLDINGS))), held_path[:-2]))[:n]
+    result = pd.DataFrame(held_path, index=signals.index, columns=HOLDINGS)
+    result['wait_days'] = wait_days
+    result['be_in'] = be_in_path
+    result['returns'] = (weights * signals.holding_returns).sum(axis=1)
+    return result
+
+
+def trade(wt, held):
+    # Thomas's reducing unnecessary trades: only open or close positions
+    for holding, weight in wt.items():
+        if (held[holding] > 0 and weight == 0) or (held[holding] == 0 and weight > 0):
+            held[holding] = weight
+
+
+def sweep(signals, ini_wait_days, percentiles):
+    # Daily strategy returns of every (ini_wait_days, percentile) combination
+    runs = list(itertools.product(ini_wait_days, percentiles))
+    returns = {run: simulate(signals, *run)['returns'] for run in runs}
+    return pd.DataFrame(returns, index=signals.index).rename_axis(columns=['ini_wait_days', 'percentile'])
+
+
+def sharpe_ratio(returns):
+    deviation = returns.std()
+    return np.sqrt(252) * returns.mean() / deviation if deviation > 0 else np.nan
+
+
+def summarize(returns):
+    equity = (1 + returns).cumprod()
+    return {
+        'total_return': equity.iloc[-1] - 1 if len(equity) else 0.0,
+        'sharpe': sharpe_ratio(returns),
+        'max_drawdown': (1 - equity / equity.cummax()).max() if len(equity) else 0.0
+    }
+
+
+def walk_forward(returns, train_days, test_days, metric=sharpe_ratio):
+    # Re-fits the parameters on every `train_days` window (the column of `returns` with the best metric) and applies
+    # them to the following `test_days`. Every column is one continuous run, so the state entering a test window is
+    # the state the chosen parameters would have had. Returns the stitched out-of-sample returns and the selections.
+    out_of_sample = []
+    selections = []
+    for start in range(0, len(returns) - train_days, test_days):
+        train = returns.iloc[start:start + train_days]
+        test = returns.iloc[start + train_days:start + train_days + test_days]
+        scores = train.apply(metric)
+        if scores.isna().all():
+            continue
+        best = scores.idxmax()
+        out_of_sample.append(test[best])
+        selections.append({
+            'train_start': train.index[0],
+            'test_start': test.index[0],
+            'test_end': test.index[-1],
+            'ini_wait_days': best[0],
+            'percentile': best[1],
+            'train_score': scores[best],
+            'test_score': metric(test[best])
+        })
+    out_of_sample = pd.concat(out_of_sample) if out_of_sample else pd.Series(dtype=float)
+    return out_of_sample, pd.DataFrame(selections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Walk-forward the in-out strategy over locally cached daily closes")
+    parser.add_argument('closes', help="CSV with a date column and one column of daily closes per ticker")
+    parser.add_argument('--ini-wait-days', type=int, nargs='+', default=[5, 10, 15, 20, 25])
+    parser.add_argument('--percentiles', type=float, nargs='+', default=[0.5, 1, 2, 5])
+    parser.add_argument('--train-days', type=int, default=3 * 252)
+    parser.add_argument('--test-days', type=int, default=252)
+    parser.add_argument('--output', default='in_out_walk_forward.csv')
+    args = parser.parse_args()
+
+    signals = precompute(load_closes(args.closes), args.percentiles)
+    returns = sweep(signals, args.ini_wait_days, args.percentiles)
+    out_of_sample, selections = walk_forward(returns, args.train_days, args.test_days)
+    selections.to_csv(args.output, index=False)
+    print(selections.to_string(index=False))
+    print(summarize(out_of_sample))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# Parameter sweep for futures-mean-reversion.py
+#
+# The strategy enters a continuous future when the minute price is in the bottom (LONG) or top (SHORT) part of the
+# hourly BB(24, 2), sizes the position so a stop `stop_loss_std_multiple` daily STD(22) away loses at most `max_loss`,
+# takes profit `profit_target_multiple` times as far as the stop, closes after `max_holding_time`, and waits 7 days
+# before re-entering after a stop loss.
+#
+# The sweep writes the minute bars and the parameter-independent indicators to .npy files once. Every worker process
+# memory-maps those files, so the pool shares a single copy of the data no matter how many processes run. Each
+# parameter set is simulated by jumping from entry to exit with vectorized searches, and the per-run PnL, drawdown
+# and trade counts are collected into one DataFrame. Margin is not modelled and rollovers are not simulated, so the
+# input should be a back-adjusted continuous series.
+#
+# Example (no network needed, bars come from a local CSV with time,open,high,low,close columns):
+#   python -m research.mean_reversion_sweep ym_minute.csv --contract-multiplier 5 --minimum-price-variation 1 --output sweep.csv
+
+import argparse
+import itertools
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from research.ema_crossover_backtest import consolidate, daily_closes, round_to_tick
+
+BAR_DTYPE = np.dtype([('time', 'datetime64[ns]'), ('open', 'f8'), ('high', 'f8'), ('low', 'f8'), ('close', 'f8')])
+INDICATOR_DTYPE = np.dtype([('z_score', 'f8'), ('std', 'f8')])
+
+# The values hard-coded in SwimmingBlackTermite.Initialize
+DEFAULT_PARAMETERS = {
+    'max_loss': 3000,
+    'stop_loss_std_multiple': 1,
+    'profit_target_multiple': 0.5,
+    'max_holding_time': timedelta(days=8),
+    'long_bb_threshold': 0.2,
+    'short_bb_threshold': 0.8
+}
+
+DEFAULT_GRID = {
+    'max_loss': [1000, 2000, 3000, 5000],
+    'stop_loss_std_multiple': [0.5, 1, 1.5, 2],
+    'profit_target_multiple': [0.25, 0.5, 1, 2],
+    'max_holding_time': [timedelta(days=d) for d in (2, 4, 8, 16)],
+    'long_bb_threshold': [0, 0.1, 0.2],
+    'short_bb_threshold': [0.8, 0.9, 1]
+}
+
+STOP_LOSS_HIT_DELAY = np.timedelta64(7, 'D')
+
+
+def load_bars(path):
+    # Reads a structured .npy file written by `save_bars`, or a CSV with time,open,high,low,close columns
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    frame = pd.read_csv(path, parse_dates=['time'])
+    bars = np.empty(len(frame), dtype=BAR_DTYPE)
+    for field in BAR_DTYPE.names:
+        bars[field] = frame[field].values
+    return bars
+
+
+def save_bars(path, bars):
+    np.save(path, np.asarray(bars, dtype=BAR_DTYPE))
+
+
+def compute_indicators(bars, bb_period=24, bb_k=2, std_period=22):
+    # The BB(24, 2) on hourly bars gives the z-score of every minute's price; the daily STD(22) sizes the trades.
+    # Both use the population standard deviation, like LEAN's StandardDeviation indicator.
+    end_time = bars['time']
+    close = np.asarray(bars['close'])
+    indicators = np.full(len(bars), np.nan, dtype=INDICATOR_DTYPE)
+    if len(bars) == 0:
+        return indicators
+
+    hourly_closes, hourly_index = consolidate(end_time, close, timedelta(hours=1))
+    if len(hourly_closes) >= bb_period:
+        windows = sliding_window_view(hourly_closes, bb_period)
+        middle = np.full(len(hourly_closes), np.nan)
+        width = np.full(len(hourly_closes), np.nan)
+        middle[bb_period - 1:] = windows.mean(axis=1)
+        width[bb_period - 1:] = 2 * bb_k * windows.std(axis=1)
+        lower = middle - width / 2
+
+        # The hourly bar emitted on a minute is visible to OnData on that same minute
+        latest_hourly_bar = np.searchsorted(hourly_index, np.arange(len(bars)), side='right') - 1
+        has_bar = latest_hourly_bar >= 0
+        latest_hourly_bar = latest_hourly_bar[has_bar]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            indicators['z_score'][has_bar] = (close[has_bar] - lower[latest_hourly_bar]) / width[latest_hourly_bar]
+
+    daily_end_time, daily_close = daily_closes(end_time, close)
+    if len(daily_close) >= std_period:
+        daily_std = np.full(len(daily_close), np.nan)
+        daily_std[std_period - 1:] = sliding_window_view(daily_close, std_period).std(axis=1)
+        latest_daily_bar = np.searchsorted(daily_end_time, end_time, side='right') - 1
+        has_bar = latest_daily_bar >= 0
+        indicators['std'][has_bar] = daily_std[latest_daily_bar[has_bar]]
+    return indicators
+
+
+def first_hit(mask, start, end, chunk_size=1024):
+    # Index of the first True in mask[start:end], searched in growing chunks, or `end` if there is none
+    while start < end:
+        stop = min(end, start + chunk_size)
+        hits = np.flatnonzero(mask[start:stop])
+        if hits.size:
+            return start + hits[0]
+        start = stop
+        chunk_size *= 2
+    return end
+
+
+def simulate(bars, indicators, contract_multiplier, minimum_price_variation, max_loss, stop_loss_std_multiple,
+             profit_target_multiple, max_holding_time, long_bb_threshold, short_bb_threshold):
+    time = bars['time']
+    high, low, open_, close = bars['high'], bars['low'], bars['open'], bars['close']
+    z_score, std = indicators['z_score'], indicators['std']
+    n = len(bars)
+
+    stop_distance = stop_loss_std_multiple * std
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quantity = np.floor(max_loss / (stop_distance * contract_multiplier))
+    quantity = np.where(np.isfinite(quantity), quantity, 0)
+    direction = np.where(z_score <= long_bb_threshold, 1, np.where(z_score >= short_bb_threshold, -1, 0))
+    entries = np.flatnonzero((direction != 0) & (quantity > 0))
+    max_holding_time = np.timedelta64(max_holding_time).astype('timedelta64[ns]')
+
+    trades = []
+    if n == 0:
+        # No bars (e.g. an empty cached file) means no trades, rather than an IndexError that kills the pool worker
+        return trade_frame(trades, contract_multiplier)
+    index = 0
+    allowed_after = time[0] - np.timedelta64(1, 'ns')
+    while True:
+        # Next minute where an entry is allowed and the z-score is outside the thresholds
+        first_allowed = max(index, np.searchsorted(time, allowed_after, side='right'))
+        position = np.searchsorted(entries, first_allowed)
+        if position == len(entries):
+            break
+        entry_index = entries[position]
+        side = direction[entry_index]
+        size = side * quantity[entry_index]
+        entry_price = close[entry_index]
+        if side > 0:
+            stop_price = round_to_tick(entry_price - stop_distance[entry_index], minimum_price_variation)
+            target_price = round_to_tick(entry_price + stop_distance[entry_index] * profit_target_multiple, minimum_price_variation)
+        else:
+            stop_price = round_to_tick(entry_price + stop_distance[entry_index], minimum_price_variation)
+            target_price = round_to_tick(entry_price - stop_distance[entry_index] * profit_target_multiple, minimum_price_variation)
+
+        # The max holding time closes the trade in OnData, after the fill model scanned that minute's bar: a stop or
+        # target hit on the timeout bar fills first, and only otherwise is the trade closed at the timeout close
+        timeout_index = np.searchsorted(time, time[entry_index] + max_holding_time, side='right')
+        search_end = min(timeout_index + 1, n)
+        if side > 0:
+            stop_index = first_hit(low < stop_price, entry_index + 1, search_end)
+            target_index = first_hit(high > target_price, entry_index + 1, min(stop_index + 1, search_end))
+        else:
+            stop_index = first_hit(high > stop_price, entry_index + 1, search_end)
+            target_index = first_hit(low < target_price, entry_index + 1, min(stop_index + 1, search_end))
+
+        if stop_index < search_end and stop_index <= target_index:
+            exit_index, reason = stop_index, 'stop_loss'
+            exit_price = min(stop_price, close[exit_index]) if side > 0 else max(stop_price, close[exit_index])
+            allowed_after = time[exit_index] + STOP_LOSS_HIT_DELAY
+        elif target_index < search_end:
+            exit_index, reason = target_index, 'profit_target'
+            exit_price = max(target_price, open_[exit_index]) if side > 0 else min(target_price, open_[exit_index])
+        elif timeout_index < n:
+            exit_index, reason = timeout_index, 'max_holding_time'
+            exit_price = close[exit_index]
+        else:
+            exit_index, reason = n - 1, 'open'
+            exit_price = close[exit_index]
+
+        trades.append((time[entry_index], time[exit_index], size, entry_price, exit_price, reason))
+        # Liquidations happen in OnData, after that minute's entries were evaluated
+        index = exit_index + 1
+
+    return trade_frame(trades, contract_multiplier)
+
+
+def trade_frame(trades, contract_multiplier):
+    trades = pd.DataFrame(trades, columns=['entry_time', 'exit_time', 'quantity', 'entry_price', 'exit_price', 'exit_reason'])
+    trades['pnl'] = (trades['exit_price'] - trades['entry_price']) * trades['quantity'] * contract_multiplier
+    return trades
+
+
+def summarize(trades):
+    equity = trades['pnl'].cumsum()
+    reasons = trades['exit_reason'].value_counts()
+    return {
+        'pnl': trades['pnl'].sum(),
+        'max_drawdown': (equity.cummax().clip(lower=0) - equity).max() if len(trades) else 0.0,
+        'trades': len(trades),
+        'stop_losses': reasons.get('stop_loss', 0),
+        'profit_targets': reasons.get('profit_target', 0),
+        'timeouts': reasons.get('max_holding_time', 0)
+    }
+
+
+# Set by `_initialize_worker` in every pool process
+_shared = {}
+
+
+def _initialize_worker(bars_path, indicators_path, contract_multiplier, minimum_price_variation):
+    _shared['bars'] = np.load(bars_path, mmap_mode='r')
+    _shared['indicators'] = np.load(indicators_path, mmap_mode='r')
+    _shared['contract_multiplier'] = contract_multiplier
+    _shared['minimum_price_variation'] = minimum_price_variation
+
+
+def _run(parameters):
+    trades = simulate(_shared['bars'], _shared['indicators'], _shared['contract_multiplier'],
+                      _shared['minimum_price_variation'], **parameters)
+    return {**parameters, **summarize(trades)}
+
+
+def parameter_sets(grid):
+    # Every combination of the grid values; parameters missing from the grid keep the strategy's defaults
+    grid = {**{name: [value] for name, value in DEFAULT_PARAMETERS.items()}, **grid}
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def run_sweep(bars, grid, contract_multiplier, minimum_price_variation, processes=None, cache_dir=None):
+    # `bars` is a path (.npy or .csv) or a BAR_DTYPE array. Returns one row per parameter set.
+    with tempfile.TemporaryDirectory(dir=cache_dir) as directory:
+        if isinstance(bars, str) and bars.endswith('.npy'):
+            bars_path = bars
+        else:
+            bars_path = os.path.join(directory, 'bars.npy')
+            save_bars(bars_path, load_bars(bars) if isinstance(bars, str) else bars)
+        indicators_path = os.path.join(directory, 'indicators.npy')
+        np.save(indicators_path, compute_indicators(np.load(bars_path, mmap_mode='r')))
+
+        runs = parameter_sets(grid)
+        with ProcessPoolExecutor(max_workers=processes, initializer=_initialize_worker,
+                                 initargs=(bars_path, indicators_path, contract_multiplier, minimum_price_variation)) as pool:
+            results = list(pool.map(_run, runs, chunksize=max(1, len(runs) // (4 * (processes or os.cpu_count())))))
+    return pd.DataFrame(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep the futures-mean-reversion parameters over locally cached minute bars")
+    parser.add_argument('bars', help="Minute bars of one continuous future (.npy written by save_bars, or CSV with time,open,high,low,close)")
+    parser.add_argument('--contract-multiplier', type=float, required=True)
+    parser.add_argument('--minimum-price-variation', type=float, required=True)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--output', default='mean_reversion_sweep.csv')
+    args = parser.parse_args()
+
+    results = run_sweep(args.bars, DEFAULT_GRID, args.contract_multiplier, args.minimum_price_variation, args.processes)
+    results.sort_values('pnl', ascending=False).to_csv(args.output, index=False)
+    print(results.sort_values('pnl', ascending=False).head(20).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
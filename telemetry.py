@@ -0,0 +1,174 @@
+# Buffered Log/Debug/Plot sink that keeps logging off the order-decision path
+#
+# A strategy hands its messages to Telemetry as a kind, a str.format template and the arguments, instead of formatting
+# them and calling Log/Debug/Plot itself. Arguments that take work to build (e.g. the contents of a RollingWindow) are
+# passed as `values`, a function that's only called for the messages that are kept. The arguments must not change
+# after the call, since they're formatted later: pass numbers, strings, Symbols and times, or let `values` copy the
+# rest.
+#
+# In live mode every kind can be rate limited (at most `count` messages per `period` of algorithm time) and sampled
+# (every n-th message). A background thread formats the queued Log/Debug messages in batches, every `flush_interval`
+# seconds or sooner once `batch_size` are waiting, and the algorithm thread emits the formatted ones: from a scheduled
+# event every `emit_interval`, and before queuing the next message. LEAN's Log, Debug and Plot are only ever called
+# from the algorithm thread; a message that needs the time it was recorded at carries it in its arguments. Plots have
+# nothing to format, so they're emitted as soon as they're admitted, at the time they were recorded. A full queue
+# drops the newest messages rather than block the algorithm. close() emits what's left and logs how many messages of
+# each kind were skipped.
+#
+# In backtests nothing is limited, sampled or deferred: every message is formatted and emitted right away, so the
+# backtest's logs and charts are the same as with direct Log/Debug/Plot calls.
+#
+# Example:
+#   from telemetry import Telemetry
+#
+#   self.telemetry = Telemetry(self, limits={'rollover': (10, timedelta(days=1))}, sampling={'windows': 4})
+#   self.telemetry.debug('rollover', "{} - Contract rollover TRADED {} => {}", self.Time, old_symbol, new_symbol)
+#   self.telemetry.log('windows', "Trailing closes: {}", values=lambda: (list(self.trailing_closes),))
+#   self.telemetry.plot("Open Trades", "Count", len(self.trade_book))
+#   self.telemetry.close()    # in OnEndOfAlgorithm
+
+import threading
+from collections import deque
+from datetime import timedelta
+
+
+class Telemetry:
+    def __init__(self, algorithm, limits=None, sampling=None, threaded=None, flush_interval=1.0,
+                 emit_interval=timedelta(minutes=1), batch_size=100, capacity=10000):
+        # `limits` is {kind: (count, period)} with a timedelta period, `sampling` is {kind: n} to keep every n-th
+        # message. `threaded` (live mode) defaults to the live mode of the algorithm.
+        self.algorithm = algorithm
+        self.limits = dict(limits or {})
+        self.sampling = dict(sampling or {})
+        self.threaded = algorithm.LiveMode if threaded is None else threaded
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.capacity = capacity
+
+        # {kind: [start of the current period, messages admitted in it]} and {kind: messages seen}
+        self.windows = {}
+        self.seen = {}
+        # {kind: {reason: messages}} of the messages that weren't emitted, counted on the algorithm thread
+        self.skipped = {}
+
+        # (method, kind, template, args) waiting to be formatted, and (method, kind, message) waiting to be emitted.
+        # deque.append and popleft are atomic, so neither thread ever waits on the other.
+        self.queue = deque()
+        self.formatted = deque()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = None
+        if self.threaded:
+            self.thread = threading.Thread(target=self.run, name="telemetry", daemon=True)
+            self.thread.start()
+            algorithm.Schedule.On(algorithm.DateRules.EveryDay(), algorithm.TimeRules.Every(emit_interval),
+                                  self.emit_formatted)
+
+    def debug(self, kind, template, *args, values=None):
+        self.submit('Debug', kind, template, args, values)
+
+    def log(self, kind, template, *args, values=None):
+        self.submit('Log', kind, template, args, values)
+
+    def plot(self, chart, series, value):
+        # Plots are limited and sampled under the kind `chart`
+        if not self.threaded or self.admits(chart):
+            self.algorithm.Plot(chart, series, value)
+
+    def admits(self, kind):
+        # Whether a message of `kind` passes the sampling and the rate limit
+        every = self.sampling.get(kind)
+        if every is not None:
+            seen = self.seen.get(kind, 0)
+            self.seen[kind] = seen + 1
+            if seen % every:
+                self.skip(kind, 'sampled out')
+                return False
+
+        limit = self.limits.get(kind)
+        if limit is not None:
+            count, period = limit
+            now = self.algorithm.Time
+            window = self.windows.get(kind)
+            if window is None or now - window[0] >= period:
+                window = self.windows[kind] = [now, 0]
+            if window[1] >= count:
+                self.skip(kind, 'rate limited')
+                return False
+            window[1] += 1
+        return True
+
+    def skip(self, kind, reason):
+        skipped = self.skipped.setdefault(kind, {})
+        skipped[reason] = skipped.get(reason, 0) + 1
+
+    def submit(self, method, kind, template, args, values):
+        if not self.threaded:
+            self.emit(method, kind, self.format(template, values() if values is not None else args))
+            return
+        if self.formatted:
+            self.emit_formatted()
+        if not self.admits(kind):
+            return
+        if values is not None:
+            args = values()
+        if self.closed:
+            self.emit(method, kind, self.format(template, args))
+            return
+        if len(self.queue) >= self.capacity:
+            self.skip(kind, 'queue full')
+            return
+        self.queue.append((method, kind, template, args))
+        if len(self.queue) >= self.batch_size:
+            self.wake.set()
+
+    @staticmethod
+    def format(template, args):
+        # The message, or None if it can't be formatted (which mustn't stop the others, or the algorithm)
+        try:
+            return template.format(*args) if args else template
+        except Exception:
+            return None
+
+    def emit(self, method, kind, message):
+        # Only called on the algorithm thread
+        if message is None:
+            self.skip(kind, 'failed')
+        else:
+            getattr(self.algorithm, method)(message)
+
+    def format_queued(self):
+        # Formats every queued message, oldest first
+        while True:
+            try:
+                method, kind, template, args = self.queue.popleft()
+            except IndexError:
+                return
+            self.formatted.append((method, kind, self.format(template, args)))
+
+    def emit_formatted(self):
+        while True:
+            try:
+                method, kind, message = self.formatted.popleft()
+            except IndexError:
+                return
+            self.emit(method, kind, message)
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.format_queued()
+
+    def close(self):
+        # Stops the formatting thread, emits the messages still queued and logs what was skipped
+        self.closed = True
+        if self.thread is not None:
+            self.wake.set()
+            self.thread.join()
+            self.thread = None
+        self.format_queued()
+        self.emit_formatted()
+        for kind, skipped in self.skipped.items():
+            counts = ', '.join(f"{messages} {reason}" for reason, messages in skipped.items())
+            self.algorithm.Log(f"Telemetry: {kind}: {counts}")
@@ -0,0 +1,67 @@
+# Checks research/ema_crossover_backtest.py against futures-contracts.py run in the local engine
+#
+# The YM bars have no spread, since the local engine triggers stops on the trade bars while the strategy trails the
+# bid, and a 2% gap up at 11:30 on the first day whose bar trades back down to the previous close. The first trade is
+# open over the gap: its stop can only move up after the gap bar was filled against, so the trade survives it.
+
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.synthetic import SyntheticSource
+from local_engine import load_algorithm
+from local_engine.algorithm_imports import OrderStatus, OrderType
+from local_engine.engine import Engine
+from research.ema_crossover_backtest import MinuteBars, find_stop_exit
+
+START = datetime(2021, 1, 4)
+END = datetime(2021, 1, 8)
+GAP_TIME = np.datetime64('2021-01-04T11:30', 'ns')
+
+
+class GapSource(SyntheticSource):
+    def series(self, ticker):
+        if ticker in self.bars_by_ticker:
+            return self.bars_by_ticker[ticker]
+        bars = super().series(ticker)
+        columns = bars.columns
+        if ticker == 'YM':
+            gap = np.searchsorted(bars.time, GAP_TIME)
+            previous_close = columns['close'][gap - 1]
+            for field in ('open', 'high', 'low', 'close'):
+                columns[field][gap:] *= 1.02
+            columns['open'][gap] = columns['low'][gap] = previous_close
+        columns['bidclose'] = columns['askclose'] = columns['close']
+        return bars
+
+
+def test_stop_exit_matches_local_engine():
+    source = GapSource(START, END, futures=['YM'], history_days=130)
+    engine = Engine(load_algorithm('futures-contracts.py'), source, start=START, end=END, cash=1e6, quiet=True)
+    algorithm = engine.algorithm
+    fills = {}
+    on_order_event = algorithm.OnOrderEvent
+
+    def record_fills(order_event):
+        if order_event.Status == OrderStatus.Filled:
+            fills[order_event.OrderId] = (np.datetime64(algorithm.Time, 'ns'), order_event.FillPrice)
+        on_order_event(order_event)
+
+    algorithm.OnOrderEvent = record_fills
+    engine.run()
+
+    # The first trade: its entry and then its stop loss
+    entry, stop = sorted(engine.orders.values(), key=lambda order: order.Id)[:2]
+    assert entry.Type == OrderType.Market and stop.Type == OrderType.StopMarket
+    entry_time, entry_price = fills[entry.Id]
+    assert entry_time < GAP_TIME < fills[stop.Id][0]
+
+    symbol_data = next(iter(algorithm.symbol_data_by_future.values()))
+    properties = symbol_data.future.SymbolProperties
+    stop_distance = symbol_data.trailing_stop_pct / properties.ContractMultiplier
+    ym = source.series('YM')
+    bars = MinuteBars(ym.time, ym['close'], ym['low'], ym['close'], ym['high'], ym['close'])
+    entry_index = int(np.searchsorted(bars.end_time, entry_time))
+    exit_index, exit_price = find_stop_exit(bars, entry_index, np.sign(entry.Quantity), entry_price, stop_distance,
+                                            properties.MinimumPriceVariation)
+    assert (bars.end_time[exit_index], exit_price) == fills[stop.Id]